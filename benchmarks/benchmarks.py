@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the stages of the reduction, on synthetic frames.
+
+    asv run             # time_* and peakmem_* of each stage
+    asv dev -b Order    # a single suite, in the current environment
+
+The track_* benchmarks compare the fast paths with the reference ones.
+"""
+
+# python imports
+import tempfile
+from pathlib import Path
+
+# numpy imports
+import numpy as np
+
+# pipeline imports
+from pipeline.stability import synthetic
+from pipeline.stability.drift import cross_correlate
+from pipeline.stability.merge import MergeOperator, taper
+from pipeline.stability.rv import (
+    LineMask, MaskOperator, combine, fit_ccf, velocity_grid)
+from pipeline.stability.stability import (
+    HRS, Extract, ListOfFiles, Master, Normalise, calibrate_frame, getshape,
+    getshapes)
+
+from . import common
+
+
+class FindPeaks(object):
+    params = (common.CHIPS, ['cwt', 'fast'])
+    param_names = ['chip', 'detection']
+    timeout = 300
+
+    def setup(self, chip, detection):
+        self.order = common.order_stub(chip, detection=detection)
+
+    def time_find_peaks(self, chip, detection):
+        with common.quiet():
+            self.order.find_peaks(self.order.hrs)
+
+    def peakmem_find_peaks(self, chip, detection):
+        with common.quiet():
+            self.order.find_peaks(self.order.hrs)
+
+
+class FindOrders(object):
+    params = (common.CHIPS, ['astropy', 'batched'])
+    param_names = ['chip', 'fit']
+    timeout = 600
+
+    def setup(self, chip, fit):
+        self.order = common.order_stub(chip, fit=fit)
+        self.op = common.order(chip).order
+
+    def time_find_orders(self, chip, fit):
+        self.order.find_orders(self.op)
+
+    def peakmem_find_orders(self, chip, fit):
+        self.order.find_orders(self.op)
+
+
+class ExtractOrders(object):
+    params = (common.CHIPS, ['loop', 'sparse'])
+    param_names = ['chip', 'method']
+    timeout = 300
+
+    def setup(self, chip, method):
+        self.order = common.order(chip)
+        self.data = common.hrs('science', chip).data
+        self.extract = Extract.__new__(Extract)
+        self.extract.step = self.order.step
+        self.extract.hrsfile = common.hrs('science', chip)
+        if method == 'sparse':
+            # The operator is built once per flat, not per frame.
+            self.operator = self.order.operator(self.data.shape)
+
+    def time_extract_orders(self, chip, method):
+        if method == 'sparse':
+            self.operator(self.data)
+        else:
+            with common.quiet():
+                self.extract._extract_orders(self.order.trace, self.data)
+
+    def peakmem_extract_orders(self, chip, method):
+        if method == 'sparse':
+            self.operator(self.data)
+        else:
+            with common.quiet():
+                self.extract._extract_orders(self.order.trace, self.data)
+
+
+class CosmicRays(object):
+    params = (common.CHIPS, ['astropy', 'vectorized'])
+    param_names = ['chip', 'clipping']
+    timeout = 300
+
+    def setup(self, chip, clipping):
+        self.extract = Extract.__new__(Extract)
+        self.extract.clipping = clipping
+        self.worders = common.extraction('science', chip).worders
+
+    def time_cosmicrays(self, chip, clipping):
+        self.extract._cosmicrays(self.worders)
+
+    def peakmem_cosmicrays(self, chip, clipping):
+        self.extract._cosmicrays(self.worders)
+
+
+class Normalisation(object):
+    params = (common.CHIPS, ['lowess', 'binned'])
+    param_names = ['chip', 'smoother']
+    timeout = 600
+
+    def setup(self, chip, smoother):
+        common.normalise_inputs(chip)
+
+    def time_normalise(self, chip, smoother):
+        Normalise(*common.normalise_inputs(chip), smoother=smoother)
+
+    def peakmem_normalise(self, chip, smoother):
+        Normalise(*common.normalise_inputs(chip), smoother=smoother)
+
+
+class MasterBias(object):
+    params = ['average', 'median', 'sigmaclip']
+    param_names = ['method']
+    timeout = 300
+
+    def setup_cache(self):
+        # Written once for all the parameters.
+        path = Path(tempfile.mkdtemp(prefix='hrs-biases-'))
+        synthetic.write_night(path, nbias=5, nflat=0, nthar=0, nscience=0,
+                              nspecphot=0)
+        return str(path)
+
+    def setup(self, path, method):
+        with common.quiet():
+            self.lof = ListOfFiles(path)
+
+    def time_makemasterbias(self, path, method):
+        with common.quiet():
+            Master.makemasterbias(self.lof, method=method)
+
+    def peakmem_makemasterbias(self, path, method):
+        with common.quiet():
+            Master.makemasterbias(self.lof, method=method)
+
+
+class Calibration(object):
+    params = (common.CHIPS, ['operators', 'fused', 'buffer'])
+    param_names = ['chip', 'method']
+
+    def setup(self, chip, method):
+        self.file = common.frame('science', chip)
+        shape = common.hrs('science', chip).shape
+        self.bias = np.full(shape, synthetic.CHIPS[chip]['bias'],
+                            dtype=np.float32)
+        flat = np.random.RandomState(0).uniform(0.5, 1.5, shape)
+        self.flat = flat.astype(np.float32)
+        self.out = np.empty(shape, dtype=np.float32)
+
+    def calibrate(self, method):
+        if method == 'operators':
+            return (HRS(self.file) - self.bias) / self.flat
+        if method == 'fused':
+            return HRS(self.file).calibrate(self.bias, self.flat)
+        return calibrate_frame(self.file, self.bias, self.flat, out=self.out)
+
+    def time_calibrate(self, chip, method):
+        self.calibrate(method)
+
+    def peakmem_calibrate(self, chip, method):
+        self.calibrate(method)
+
+
+class CrossCorrelation(object):
+    params = common.CHIPS
+    param_names = ['chip']
+
+    def setup(self, chip):
+        # A batch of 64 ThAr frames, shifted copies of the synthetic one.
+        self.reference = common.thar_orders(chip)
+        self.frames = np.stack([np.roll(self.reference, k % 7 - 3, axis=1)
+                                for k in range(64)])
+
+    def time_cross_correlate(self, chip):
+        cross_correlate(self.frames, self.reference)
+
+    def peakmem_cross_correlate(self, chip):
+        cross_correlate(self.frames, self.reference)
+
+
+class GetShape(object):
+    params = (common.CHIPS, ['loop', 'batched'])
+    param_names = ['chip', 'method']
+
+    def setup(self, chip, method):
+        self.orders = common.thar_orders(chip)
+
+    def time_getshape(self, chip, method):
+        if method == 'batched':
+            getshapes(self.orders)
+        else:
+            for k in range(len(self.orders) - 2):
+                getshape(self.orders[k], self.orders[k + 2])
+
+
+def merge_loop(orders, grid):
+    """
+    The orders interpolated one by one on the grid, and averaged with the
+    weights of MergeOperator.
+    """
+    numerator, denominator = np.zeros(len(grid)), np.zeros(len(grid))
+    for o, rows in orders.groupby('Order'):
+        rows = rows.sort_values('Wavelength')
+        flux = rows.Normalised.values
+        weights = taper(len(rows)) * np.isfinite(flux)
+        inside = ((grid >= rows.Wavelength.min())
+                  & (grid <= rows.Wavelength.max()))
+        weighted = weights * np.nan_to_num(flux)
+        numerator += np.where(inside,
+                              np.interp(grid, rows.Wavelength, weighted), 0)
+        denominator += np.where(inside,
+                                np.interp(grid, rows.Wavelength, weights), 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+class Merge(object):
+    params = (common.CHIPS, ['loop', 'sparse', 'stack'])
+    param_names = ['chip', 'method']
+
+    def setup(self, chip, method):
+        self.orders = common.normalised(chip)
+        # The operator is built once per chip and mode, not per frame.
+        self.operator = MergeOperator(self.orders.Wavelength.values,
+                                      self.orders.Order.values)
+        self.stack = np.tile(self.orders.Normalised.values, (64, 1))
+
+    def merge(self, method):
+        if method == 'loop':
+            return merge_loop(self.orders, self.operator.grid)
+        if method == 'sparse':
+            return self.operator(self.orders.Normalised.values)
+        return self.operator(self.stack)
+
+    def time_merge(self, chip, method):
+        self.merge(method)
+
+    def peakmem_merge(self, chip, method):
+        self.merge(method)
+
+    def time_operator(self, chip, method):
+        MergeOperator(self.orders.Wavelength.values, self.orders.Order.values)
+
+
+class RadialVelocities(object):
+    params = (common.CHIPS, [1, 64])
+    param_names = ['chip', 'frames']
+
+    def setup(self, chip, frames):
+        orders = synthetic.normalised_orders(chip, velocity=12.3, snr=100)
+        self.mask = LineMask(*synthetic.stellar_lines(chip))
+        self.wavelength = orders.Wavelength.values
+        self.order = orders.Order.values
+        self.velocities = velocity_grid(0., 50., 1.)
+        # The operator is built once per chip and mode, not per frame.
+        self.operator = MaskOperator(self.wavelength, self.order, self.mask,
+                                     self.velocities)
+        self.stack = np.tile(orders.Normalised.values, (frames, 1))
+
+    def measure(self):
+        ccf, continuum = self.operator(self.stack)
+        combined = combine(ccf, continuum)
+        return fit_ccf(self.velocities,
+                       np.concatenate([combined[:, None], ccf], axis=1))
+
+    def time_rv(self, chip, frames):
+        self.measure()
+
+    def peakmem_rv(self, chip, frames):
+        self.measure()
+
+    def time_operator(self, chip, frames):
+        MaskOperator(self.wavelength, self.order, self.mask, self.velocities)
+
+
+class Agreement(object):
+    """
+    Differences between the fast paths and the reference implementations.
+    """
+    params = common.CHIPS
+    param_names = ['chip']
+    timeout = 900
+
+    def track_find_peaks(self, chip):
+        # Fraction of the peaks of find_peaks_cwt() found within 5 pixels.
+        flat = common.hrs('flat', chip)
+        with common.quiet():
+            reference = common.order_stub(chip,
+                                          detection='cwt').find_peaks(flat)
+            fast = common.order_stub(chip, detection='fast').find_peaks(flat)
+        found = []
+        for column in range(reference.shape[1]):
+            expected = reference[:, column][reference[:, column] > 0]
+            detected = fast[:, column][fast[:, column] > 0]
+            if len(detected):
+                distance = np.abs(expected[:, None] - detected[None, :])
+                found.extend(distance.min(axis=1) <= 5)
+            else:
+                found.extend([False] * len(expected))
+        return np.mean(found)
+    track_find_peaks.unit = 'fraction'
+
+    def track_find_orders(self, chip):
+        # Median difference of the centres fitted with astropy and batched.
+        op = common.order(chip).order
+        reference, _ = common.order_stub(chip, fit='astropy').find_orders(op)
+        batched, _ = common.order_stub(chip, fit='batched').find_orders(op)
+        return np.nanmedian(np.abs(reference[..., 1] - batched[..., 1]))
+    track_find_orders.unit = 'pixels'
+
+    def track_extract_orders(self, chip):
+        # Largest relative difference between the loop and the operator,
+        # with the same whole pixel limits.
+        order = common.order(chip)
+        extract = Extract.__new__(Extract)
+        extract.step = order.step
+        extract.hrsfile = common.hrs('science', chip)
+        data = extract.hrsfile.data
+        with common.quiet():
+            reference = extract._extract_orders(order.trace, data)
+        sparse = order.operator(data.shape, fractional=False)(data)
+        return (np.nanmax(np.abs(reference - sparse))
+                / np.nanmax(np.abs(reference)))
+    track_extract_orders.unit = 'relative'
+
+    def track_cosmicrays(self, chip):
+        # Fraction of the pixels astropy and the vectorised clipping flag
+        # differently.
+        worders = common.extraction('science', chip).worders
+        extract = Extract.__new__(Extract)
+        extract.clipping = 'astropy'
+        reference = extract._cosmicrays(worders)
+        extract.clipping = 'vectorized'
+        vectorized = extract._cosmicrays(worders)
+        return np.mean(reference.CosmicRaysObject.isna().values
+                       != vectorized.CosmicRaysObject.isna().values)
+    track_cosmicrays.unit = 'fraction'
+
+    def track_getshape(self, chip):
+        # Largest relative difference between getshape() and getshapes().
+        orders = common.thar_orders(chip)
+        reference = np.stack([getshape(orders[k], orders[k + 2])
+                              for k in range(len(orders) - 2)])
+        return (np.max(np.abs(getshapes(orders) - reference))
+                / np.max(np.abs(reference)))
+    track_getshape.unit = 'relative'
+
+    def track_merge(self, chip):
+        # Largest relative difference between merge_loop() and the operator.
+        orders = common.normalised(chip)
+        operator = MergeOperator(orders.Wavelength.values, orders.Order.values)
+        reference = merge_loop(orders, operator.grid)
+        merged = operator(orders.Normalised.values)
+        return np.nanmax(np.abs(reference - merged) / np.abs(reference))
+    track_merge.unit = 'relative'
+
+    def track_normalise(self, chip):
+        # Median difference of the flux normalised with lowess and binned.
+        with common.quiet():
+            reference = Normalise(*common.normalise_inputs(chip),
+                                  smoother='lowess').normalised.wlcrorders
+            binned = Normalise(*common.normalise_inputs(chip),
+                               smoother='binned').normalised.wlcrorders
+        return np.nanmedian(np.abs(reference.Normalised.values
+                                   - binned.Normalised.values))
+    track_normalise.unit = 'flux'
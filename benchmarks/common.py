@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic frames shared by the benchmarks, written once per process.
+"""
+
+# python imports
+import contextlib
+import logging
+import tempfile
+import types
+from pathlib import Path
+
+# numpy imports
+import numpy as np
+
+# astropy imports
+from astropy.io import fits
+
+# pipeline imports
+from pipeline.stability import synthetic
+from pipeline.stability.stability import HRS, Extract, Normalise, Order
+
+CHIPS = ['HBDET', 'HRDET']
+
+_directory = None
+_products = {}
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Silences the logging of the stages, which would go to the output of asv.
+    """
+    logger = logging.getLogger('pipeline')
+    level = logger.level
+    logger.setLevel(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        logger.setLevel(level)
+
+
+def directory():
+    global _directory
+    if _directory is None:
+        _directory = tempfile.TemporaryDirectory(prefix='hrs-benchmarks-')
+    return Path(_directory.name)
+
+
+def _cached(key, function):
+    if key not in _products:
+        _products[key] = function()
+    return _products[key]
+
+
+def frame(kind, chip):
+    """
+    Path of a synthetic frame, with the pyhrs file of the science frames.
+    """
+    def write():
+        path = directory() / '{letter}201704120{kind:03d}.fits'.format(
+            letter=synthetic.CHIPS[chip]['letter'],
+            kind=sorted(synthetic.KINDS).index(kind))
+        synthetic.write_frame(path, kind, chip=chip, seed=len(kind))
+        if kind in ('science', 'specphot'):
+            pyhrsfile = path.parent / ('p' + path.stem + '_obj.fits')
+            table = synthetic.pyhrs_table(chip)
+            fits.HDUList([fits.PrimaryHDU(), table]).writeto(
+                str(pyhrsfile), overwrite=True)
+        return path
+    return _cached(('frame', kind, chip), write)
+
+
+def hrs(kind, chip):
+    """
+    HRS object of a synthetic frame, with its data loaded.
+    """
+    def load():
+        frame_ = HRS(hrsfile=frame(kind, chip))
+        frame_.data
+        return frame_
+    return _cached(('hrs', kind, chip), load)
+
+
+def order(chip):
+    """
+    Order found on the synthetic flat with the fast paths.
+    """
+    def find():
+        with quiet():
+            return Order(hrs=hrs('flat', chip), fit='batched',
+                         detection='fast')
+    return _cached(('order', chip), find)
+
+
+def order_stub(chip, **attributes):
+    """
+    Order object that has not run, to time its methods one by one.
+    """
+    stub = Order.__new__(Order)
+    stub.hrs = hrs('flat', chip)
+    stub.step = 50
+    stub.sigma = 5.0
+    stub.fit = 'astropy'
+    stub.detection = 'cwt'
+    stub.processes = None
+    stub.spversion = ''
+    stub.got_flat = True
+    for name, value in attributes.items():
+        setattr(stub, name, value)
+    return stub
+
+
+def extraction(kind, chip):
+    """
+    Extract of a synthetic frame, with its wavelengths and cosmic rays.
+    """
+    def extract():
+        with quiet():
+            extracted = Extract(order(chip), hrs(kind, chip), sparse=True)
+            extracted.worders = extracted._wavelength(extracted.orders)
+        return extracted
+    return _cached(('extraction', kind, chip), extract)
+
+
+def cleaned(kind, chip):
+    """
+    Extracted orders of a synthetic frame without their cosmic rays.
+    """
+    def clean():
+        extracted = extraction(kind, chip)
+        extracted.clipping = 'vectorized'
+        return extracted._cosmicrays(extracted.worders)
+    return _cached(('cleaned', kind, chip), clean)
+
+
+def thar_orders(chip):
+    """
+    Object fibre of the orders of the synthetic ThAr frame.
+    """
+    def extract():
+        data = hrs('thar', chip).data
+        orders = order(chip).operator(data.shape)(data)[3::2]
+        valid = np.isfinite(orders).all(axis=1) & (orders.sum(axis=1) > 0)
+        return orders[valid]
+    return _cached(('thar', chip), extract)
+
+
+def normalise_inputs(chip):
+    return (types.SimpleNamespace(wlcrorders=cleaned('science', chip)),
+            types.SimpleNamespace(wlcrorders=cleaned('specphot', chip)))
+
+
+def normalised(chip):
+    """
+    Normalised orders of the synthetic science frame.
+    """
+    def normalise():
+        with quiet():
+            result = Normalise(*normalise_inputs(chip), smoother='binned')
+        return result.normalised.wlcrorders
+    return _cached(('normalised', chip), normalise)
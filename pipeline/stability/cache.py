@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python imports
+from pathlib import Path
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+
+class Cache(object):
+    """
+    Content-addressed on-disk cache of the calibration and intermediate
+    products. The key of a product is the hash of the checksums of its input
+    files, some keywords of their header, the parameters of the stage and the
+    keys of its parents.
+
+    Parameters:
+    -----------
+    path : directory of the products. Defaults to ~/.cache/pipeline
+
+    maxsize : size in bytes above which the least recently used products
+              are evicted.
+
+    Usage:
+    ------
+
+    key = cache.key('order', files=[flat.file], sigma=5.)
+    if key in cache:
+        product = cache.get(key)
+    else:
+        cache.put(key, product)
+    """
+    def __init__(self,
+                 path=None,
+                 maxsize=4 * 1024 ** 3):
+        if path is None:
+            path = Path.home() / '.cache' / 'pipeline'
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.maxsize = maxsize
+        self._checksums = {}
+
+    def __repr__(self):
+        return 'Cache in {path}\nSize : {size} bytes\nEntries : {n}'.format(
+            path=self.path,
+            size=self.size(),
+            n=len(list(self._entries())))
+
+    def __contains__(self, key):
+        return self._file(key).exists()
+
+    def checksum(self, file):
+        """
+        SHA1 of a file, kept while its size and mtime do not change.
+        """
+        file = Path(file)
+        stat = file.stat()
+        signature = (str(file.resolve()), stat.st_size, stat.st_mtime_ns)
+        if signature not in self._checksums:
+            sha = hashlib.sha1()
+            with open(file, 'rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    sha.update(block)
+            self._checksums[signature] = sha.hexdigest()
+        return self._checksums[signature]
+
+    def key(self, stage, files=(), header=None, keywords=(), parents=(),
+            **parameters):
+        """
+        Key of a product of stage. files are identified by their checksum,
+        parents are the keys of the products it is computed from.
+        """
+        if header is not None:
+            header = {k: str(header.get(k)) for k in keywords}
+        description = {
+            'stage': stage,
+            'files': [self.checksum(f) for f in files],
+            'header': header or {},
+            'parents': list(parents),
+            'parameters': parameters,
+        }
+        text = json.dumps(description, sort_keys=True, default=str)
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        return '{stage}-{digest}'.format(stage=stage, digest=digest)
+
+    def _file(self, key):
+        stage = key.rsplit('-', 1)[0]
+        return self.path / stage / (key + '.pkl')
+
+    def _entries(self):
+        return self.path.glob('*/*.pkl')
+
+    def get(self, key, default=None):
+        """
+        Product stored under key, or default.
+        """
+        file = self._file(key)
+        try:
+            with open(file, 'rb') as fh:
+                product = pickle.load(fh)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        # The mtime tells which products have been used recently.
+        os.utime(file)
+        return product
+
+    def put(self, key, product):
+        """
+        Stores product under key, and evicts the oldest products.
+        """
+        file = self._file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        # An interrupted run never leaves a truncated product.
+        fd, tmp = tempfile.mkstemp(dir=str(file.parent), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(product, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, str(file))
+        self.evict()
+        return key
+
+    def size(self):
+        return sum(f.stat().st_size for f in self._entries())
+
+    def evict(self, maxsize=None):
+        """
+        Removes the least recently used products down to maxsize.
+        """
+        maxsize = self.maxsize if maxsize is None else maxsize
+        entries = [(f.stat(), f) for f in self._entries()]
+        size = sum(stat.st_size for stat, f in entries)
+        for stat, f in sorted(entries, key=lambda e: e[0].st_mtime_ns):
+            if size <= maxsize:
+                break
+            f.unlink()
+            size -= stat.st_size
+
+    def invalidate(self, key=None, stage=None):
+        """
+        Removes a product, all the products of a stage, or everything.
+        """
+        if key is not None:
+            try:
+                self._file(key).unlink()
+            except FileNotFoundError:
+                pass
+        elif stage is not None:
+            shutil.rmtree(str(self.path / stage), ignore_errors=True)
+        else:
+            for directory in self.path.iterdir():
+                if directory.is_dir():
+                    shutil.rmtree(str(directory), ignore_errors=True)
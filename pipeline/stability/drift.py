@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Drift of the ThAr lines along the orders, night after night.
+
+    hrs-drift -d /data/2017* --orders reduced/ -o drift/
+
+The extracted orders of the ThAr frames are cross-correlated with those of
+a reference frame, with FFTs, and the shifts are kept in a time series per
+chip and mode (see DriftSeries).
+"""
+
+# python imports
+from pathlib import Path
+import logging
+import pickle
+
+# numpy imports
+import numpy as np
+
+# scipy imports
+from scipy import fft
+from scipy.signal.windows import tukey
+
+# astropy imports
+from astropy.io import fits
+
+# pandas imports
+import pandas as pd
+
+# pipeline imports
+from pipeline.stability.cache import Cache
+from pipeline.stability.instrument import instrument, timed
+from pipeline.stability.series import (
+    TimeSeries, command_line, interpolate_peak, mjd, parse_command_line,
+    worker_map)
+from pipeline.stability.stability import (
+    CHIP_PARAMETERS, HRS, Extract, ListOfFiles)
+
+log = logging.getLogger(__name__)
+
+
+def _prepare(orders, taper=0.1):
+    """
+    Orders without their median, tapered and normalised, and the mask of
+    the orders that are not empty.
+    """
+    orders = np.nan_to_num(np.array(orders, dtype=np.float64),
+                           nan=0., posinf=0., neginf=0.)
+    orders -= np.median(orders, axis=-1, keepdims=True)
+    orders *= tukey(orders.shape[-1], taper)
+    norm = np.sqrt(np.einsum('...i,...i->...', orders, orders))
+    valid = norm > 0
+    orders[valid] /= norm[valid][:, None]
+    return orders, valid
+
+
+@timed('cross_correlate')
+def cross_correlate(frames, reference, maxshift=10.):
+    """
+    Shifts of the orders of frames (N x norders x npixels, or one frame)
+    with respect to reference, all at once with real FFTs.
+
+    Output:
+    -------
+
+    shifts, peaks : the shifts in pixels, positive towards larger pixels,
+                    and the correlation coefficients at the peaks. NaN for
+                    the empty orders, and beyond maxshift.
+    """
+    frames = np.asarray(frames)
+    single = frames.ndim == 2
+    if single:
+        frames = frames[None]
+    npixels = frames.shape[-1]
+    lags = int(np.ceil(maxshift)) + 1
+    # Zero padding, so that the lags looked for do not wrap around.
+    nfft = fft.next_fast_len(npixels + lags)
+    x, xvalid = _prepare(frames)
+    r, rvalid = _prepare(reference)
+    spectrum = fft.rfft(x, nfft, axis=-1, workers=-1)
+    spectrum *= np.conj(fft.rfft(r, nfft, axis=-1, workers=-1))
+    correlation = fft.irfft(spectrum, nfft, axis=-1, workers=-1)
+    # Lags -lags..lags, the first and last only to interpolate the peak.
+    window = np.concatenate([correlation[..., -lags:],
+                             correlation[..., :lags + 1]], axis=-1)
+    best = np.argmax(window[..., 1:-1], axis=-1)[..., None] + 1
+    left, centre, right = (
+        np.take_along_axis(window, best + k, axis=-1)[..., 0]
+        for k in (-1, 0, 1))
+    shifts = best[..., 0] - lags + interpolate_peak(left, centre, right)
+    valid = xvalid & rvalid & (np.abs(shifts) <= maxshift)
+    shifts = np.where(valid, shifts, np.nan)
+    peaks = np.where(valid, centre, np.nan)
+    if single:
+        return shifts[0], peaks[0]
+    return shifts, peaks
+
+
+class DriftSeries(TimeSeries):
+    """
+    Drift of a chip and mode: the DRIFT table has a row per ThAr frame with
+    the shifts of the orders ORDER1, ORDER1 + 1... of both fibres, and the
+    REFERENCE image the extracted orders of the reference frame.
+    """
+    extension = 'DRIFT'
+    formats = [('File', '32A', None),
+               ('DATE-OBS', '10A', None),
+               ('TIME-OBS', '16A', None),
+               ('MJD', 'D', None),
+               ('Drift', 'D', 'pixel'),
+               ('Object', '{n}E', 'pixel'),
+               ('Sky', '{n}E', 'pixel'),
+               ('PeakObject', '{n}E', None),
+               ('PeakSky', '{n}E', None)]
+    columns = [name for name, format, unit in formats]
+    keywords = ('DETNAM', 'OBSMODE', 'ORDER1')
+
+    def reference(self):
+        """
+        Extracted orders of the reference frame and its name, or None, None.
+        """
+        if not self.file.exists():
+            return None, None
+        with fits.open(str(self.file)) as hdulist:
+            image = hdulist['REFERENCE']
+            return np.array(image.data), image.header['FRAME']
+
+    def shifts(self, fibre='Object'):
+        """
+        Shifts of a fibre, one row per frame and one column per order.
+        """
+        first = self.header()['ORDER1']
+        series = self.read()
+        if len(series):
+            values = np.stack(series[fibre].values)
+        else:
+            values = np.empty((0, 0))
+        return pd.DataFrame(values, index=series.index,
+                            columns=first + np.arange(values.shape[1]))
+
+    def append(self, rows, reference=None, header=None):
+        """
+        Adds rows (a dictionary of columns) to the series. The reference
+        (orders, name) is only used when the series is created.
+        """
+        if self.file.exists():
+            with fits.open(str(self.file)) as hdulist:
+                image = hdulist['REFERENCE'].copy()
+        else:
+            if reference is None:
+                raise ValueError('A new drift series needs a reference')
+            image = fits.ImageHDU(np.asarray(reference[0], dtype=np.float32),
+                                  name='REFERENCE')
+            image.header['FRAME'] = reference[1]
+        columns, theader = self._merge(rows, header)
+        self._write(columns, theader, image)
+
+
+# Order the workers extract the ThAr frames with.
+_order = None
+
+
+def _initialise(order):
+    global _order
+    if isinstance(order, (str, Path)):
+        with open(str(order), 'rb') as fh:
+            order = pickle.load(fh)
+    _order = order
+
+
+def _extract(file, cachepath=None):
+    """
+    Extracted orders (float32) and header of a ThAr frame.
+    """
+    cache = Cache(cachepath) if cachepath is not None else None
+    with HRS(hrsfile=Path(file)) as hrs:
+        extract = Extract(_order, hrs, sparse=True, cache=cache)
+        header = hrs.header
+    return np.asarray(extract.orders, dtype=np.float32), header
+
+
+def fibres(shifts):
+    """
+    Splits the extracted lines (... x nlines) in the object and sky fibres of
+    the orders, lines 1, 3... and 2, 4... as Extract lays them out.
+    """
+    nlines = shifts.shape[-1]
+    norders = (nlines - 1) // 2
+    return shifts[..., 1:2 * norders:2], shifts[..., 2:2 * norders + 1:2]
+
+
+class Drift(object):
+    """
+    Measures the drift of the ThAr frames of a chip and mode.
+
+    Parameters:
+    -----------
+    order : Order of the chip and mode, or the file it is pickled in.
+
+    store : file of the DriftSeries.
+
+    reference : ThAr file of a new series. Defaults to the first frame.
+
+    maxshift : largest shift looked for, in pixels.
+
+    workers : number of processes. 0 extracts the frames in this process.
+
+    cache : directory of the Cache of the extracted orders, or None.
+
+    batch : number of frames correlated, and written, at once.
+
+    Usage:
+    ------
+
+    drift = Drift('order_HRDET_HIGH.pkl', 'drift_HRDET_HIGH.fits')
+    drift.measure(files)
+    """
+    def __init__(self,
+                 order,
+                 store,
+                 reference=None,
+                 maxshift=10.,
+                 workers=0,
+                 cache=None,
+                 batch=64):
+        self.order = order
+        self.series = DriftSeries(store)
+        self.referencefile = reference
+        self.maxshift = maxshift
+        self.workers = workers
+        self.cachepath = str(cache) if cache is not None else None
+        self.batch = batch
+
+    def _extracted(self, files):
+        return worker_map(_extract, (files, [self.cachepath] * len(files)),
+                          _initialise, (self.order,), workers=self.workers,
+                          chunksize=4)
+
+    def measure(self, files):
+        """
+        Adds the frames that are not in the series yet.
+        Returns the number of frames measured.
+        """
+        done = self.series.frames()
+        files = [Path(f) for f in files if Path(f).stem not in done]
+        if not files:
+            return 0
+        reference, name = self.series.reference()
+        if reference is None:
+            referencefile = files[0]
+            if self.referencefile is not None:
+                referencefile = Path(self.referencefile)
+            (reference, header), = self._extracted([referencefile])
+            name = referencefile.stem
+            log.info('Reference of the drift: %s', name)
+        else:
+            header = None
+        frames, headers, names = [], [], []
+        for file, (orders, h) in zip(files, self._extracted(files)):
+            frames.append(orders)
+            headers.append(h)
+            names.append(file.stem)
+            if len(frames) == self.batch:
+                self._add(names, frames, headers, (reference, name), header)
+                frames, headers, names = [], [], []
+        if frames:
+            self._add(names, frames, headers, (reference, name), header)
+        return len(files)
+
+    def _add(self, names, frames, headers, reference, header):
+        with instrument.frame('drift'):
+            shifts, peaks = cross_correlate(np.stack(frames), reference[0],
+                                            maxshift=self.maxshift)
+        ordershift = CHIP_PARAMETERS[headers[0]['DETNAM']]['OrderShift']
+        obj, sky = fibres(shifts)
+        pobj, psky = fibres(peaks)
+        dates = [h['DATE-OBS'] for h in headers]
+        times = [h['TIME-OBS'] for h in headers]
+        drift = [np.nanmedian(o) if np.isfinite(o).any() else np.nan
+                 for o in obj]
+        rows = {'File': names,
+                'DATE-OBS': dates,
+                'TIME-OBS': times,
+                'MJD': mjd(dates, times),
+                'Drift': np.array(drift),
+                'Object': obj, 'Sky': sky, 'PeakObject': pobj, 'PeakSky': psky}
+        if header is not None:
+            header = header.copy()
+            header['ORDER1'] = ordershift + 1
+        self.series.append(rows, reference=reference, header=header)
+        log.info('%d ThAr frames added to %s', len(frames), self.series.file)
+
+
+def thar_frames(directories, start=None, end=None):
+    """
+    ThAr frames of the directories by chip and mode, sorted by time, from
+    start to end ('YYYY-MM-DD', inclusive).
+    """
+    groups = {}
+    for directory in directories:
+        lof = ListOfFiles(directory)
+        for f in lof.thar:
+            record = lof.index.record(f)
+            date = record['DATE-OBS']
+            if ((start is not None and date < start)
+                    or (end is not None and date > end)):
+                continue
+            chip = 'HBDET' if f.name.startswith('H') else 'HRDET'
+            mode = (record['OBSMODE'] or 'UNKNOWN').split()[0]
+            groups.setdefault((chip, mode), []).append(
+                (date, record['TIME-OBS'], f))
+        lof.index.close()
+    return {key: [f for date, time, f in sorted(frames)]
+            for key, frames in groups.items()}
+
+
+def main(argv=None):
+    parser = command_line(
+        'Drift of the HRS ThAr frames',
+        datadir='Directories of the ThAr frames, for instance one per night',
+        outdir='Directory of the time series (drift_{chip}_{mode}.fits)',
+        workers='Number of processes. 0 extracts the frames in this process')
+    parser.add_argument('--orders',
+                        help='Directory of the order_{chip}_{mode}.pkl files '
+                             'of hrs-night',
+                        default='.')
+    parser.add_argument('--reference',
+                        help='Reference ThAr frame of a new series. '
+                             'Defaults to the first one',
+                        default=None)
+    parser.add_argument('--maxshift',
+                        type=float,
+                        default=10.,
+                        help='Largest shift looked for, in pixels')
+    parser.add_argument('-c',
+                        '--cache',
+                        help='Directory of the cache of the extracted orders',
+                        default=None)
+    args = parse_command_line(parser, argv)
+    groups = thar_frames(args.datadir, start=args.start, end=args.end)
+    references = {}
+    if args.reference is not None:
+        wanted = Path(args.reference).resolve()
+        references = {group: f for group, files in groups.items()
+                      for f in files if f.resolve() == wanted}
+        if not references:
+            parser.error('{reference} is not a ThAr frame of {datadir}'.format(
+                reference=args.reference, datadir=', '.join(args.datadir)))
+    measured = {}
+    for (chip, mode), files in sorted(groups.items()):
+        name = '{chip}_{mode}'.format(chip=chip, mode=mode)
+        orderfile = Path(args.orders) / 'order_{name}.pkl'.format(name=name)
+        if not orderfile.exists():
+            log.warning('No Order for %s %s (%s), its ThAr frames are '
+                        'skipped', chip, mode, orderfile)
+            continue
+        store = Path(args.outdir) / 'drift_{name}.fits'.format(name=name)
+        drift = Drift(orderfile,
+                      store,
+                      reference=references.get((chip, mode)),
+                      maxshift=args.maxshift,
+                      workers=args.workers,
+                      cache=args.cache)
+        measured[(chip, mode)] = drift.measure(files)
+        log.info('%s %s: %d new ThAr frames', chip, mode,
+                 measured[(chip, mode)])
+    return measured
+
+
+if __name__ == '__main__':
+    main()
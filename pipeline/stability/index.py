@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python imports
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
+
+# astropy imports
+from astropy.io import fits
+
+BLOCK = 2880
+CARD = 80
+
+# Keywords of the primary header that are copied in the index.
+KEYWORDS = ['PROPID', 'TIME-OBS', 'DATE-OBS', 'OBSMODE', 'OBSTYPE', 'OBJECT',
+            'DETNAM', 'DATASEC', 'EXPTIME']
+
+
+def read_header(path):
+    """
+    Reads the primary header of a FITS file, up to its END card only.
+    """
+    blocks = []
+    with open(str(path), 'rb') as fh:
+        while True:
+            block = fh.read(BLOCK)
+            if len(block) < BLOCK:
+                raise OSError('{path} is not a FITS file, or it is '
+                              'truncated'.format(path=path))
+            blocks.append(block)
+            cards = [block[i:i + CARD] for i in range(0, BLOCK, CARD)]
+            if any(c.startswith(b'END') and not c[3:].strip() for c in cards):
+                break
+    text = b''.join(blocks).decode('ascii', errors='replace')
+    return fits.Header.fromstring(text)
+
+
+class FileIndex(object):
+    """
+    Persistent index of the primary headers of the FITS files of a directory.
+    Scanning it again only reads the headers of the new or modified files,
+    in a pool of threads.
+
+    Parameters:
+    -----------
+    database : sqlite file of the index. In memory if it can not be written.
+
+    workers : number of threads that read the headers.
+    """
+    def __init__(self,
+                 database,
+                 workers=8):
+        self.workers = workers
+        try:
+            self.connection = sqlite3.connect(str(database))
+            self._create()
+        except sqlite3.OperationalError:
+            self.connection = sqlite3.connect(':memory:')
+            self._create()
+
+    def _create(self):
+        columns = ', '.join('"{k}" TEXT'.format(k=k) for k in KEYWORDS)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+            'size INTEGER, mtime INTEGER, header TEXT, {columns})'.format(
+                columns=columns))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self, item):
+        path, stat = item
+        try:
+            header = read_header(path)
+        except OSError:
+            header = None
+        return path, stat, header
+
+    def _store(self, results):
+        rows = []
+        for path, stat, header in results:
+            if header is None:
+                values, text = [None] * len(KEYWORDS), None
+            else:
+                values = [header.get(k) for k in KEYWORDS]
+                values = [str(v) if v is not None else None for v in values]
+                text = header.tostring()
+            rows.append([path, stat.st_size, stat.st_mtime_ns, text] + values)
+        marks = ', '.join('?' * (len(KEYWORDS) + 4))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO files VALUES ({marks})'.format(
+                marks=marks), rows)
+        self.connection.commit()
+
+    def scan(self, directory, prefixes=('H', 'R'), suffix='.fits',
+             paths=False):
+        """
+        Indexes the new or modified files of directory whose name starts
+        with one of the prefixes, and forgets those that have disappeared.
+        Returns the number of headers read, or their paths if paths is True.
+        """
+        directory = os.path.abspath(str(directory))
+        cursor = self.connection.execute(
+            'SELECT path, size, mtime FROM files WHERE path LIKE ?',
+            (os.path.join(directory, '%'),))
+        known = {path: (size, mtime) for path, size, mtime in cursor}
+        todo = []
+        seen = set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if (not entry.name.endswith(suffix)
+                        or not entry.name.startswith(prefixes)
+                        or not entry.is_file()):
+                    continue
+                stat = entry.stat()
+                seen.add(entry.path)
+                if known.get(entry.path) != (stat.st_size, stat.st_mtime_ns):
+                    todo.append((entry.path, stat))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            self._store(pool.map(self._read, todo))
+        gone = [(path,) for path in known
+                if os.path.dirname(path) == directory and path not in seen]
+        self.connection.executemany('DELETE FROM files WHERE path = ?', gone)
+        self.connection.commit()
+        return [path for path, stat in todo] if paths else len(todo)
+
+    def update(self, path):
+        """
+        Reads the header of a single file and stores it in the index.
+        """
+        path = os.path.abspath(str(path))
+        self._store([self._read((path, os.stat(path)))])
+        return self.record(path)
+
+    def record(self, path):
+        """
+        Indexed keywords of a file, as a dictionary, or None.
+        """
+        cursor = self.connection.execute(
+            'SELECT * FROM files WHERE path = ?',
+            (os.path.abspath(str(path)),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([c[0] for c in cursor.description], row))
+
+    def records(self, directory):
+        """
+        Records of all the files of directory, sorted by path.
+        """
+        directory = os.path.abspath(str(directory))
+        cursor = self.connection.execute(
+            'SELECT * FROM files WHERE path LIKE ? ORDER BY path',
+            (os.path.join(directory, '%'),))
+        names = [c[0] for c in cursor.description]
+        return [dict(zip(names, row)) for row in cursor
+                if os.path.dirname(row[0]) == directory]
+
+    def header(self, path):
+        """
+        Primary header of a file, from the index only.
+        """
+        record = self.record(path)
+        if record is None or record['header'] is None:
+            return None
+        return fits.Header.fromstring(record['header'])
+
+
+def default_database(directory):
+    return Path(directory) / '.hrsindex.sqlite'
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python imports
+from pathlib import Path
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+log = logging.getLogger(__name__)
+
+
+def maxrss():
+    """
+    Largest resident memory of the process so far, in bytes.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS bytes.
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+
+class Instrument(object):
+    """
+    Measures the wall time, the CPU time and the memory of the stages of
+    the reduction, frame by frame. A stage started inside another one is
+    recorded as 'outer/inner'. The stages are logged at the DEBUG level,
+    the frames at the INFO level.
+
+    Parameters:
+    -----------
+    memory : trace the allocations with tracemalloc, and record the peak of
+             each stage. The largest resident memory is always recorded.
+
+    profile : profile each frame with cProfile (see write()).
+
+    Usage:
+    ------
+
+    instrument = Instrument(memory=True)
+    with instrument.frame('R201701010012.fits'):
+        with instrument.stage('extract'):
+            ...
+    instrument.write('timings')
+    """
+    def __init__(self, memory=False, profile=False):
+        self.memory = memory
+        self.profile = profile
+        self.records = {}
+        self.profiles = {}
+        self._local = threading.local()
+
+    def configure(self, memory=None, profile=None):
+        if memory is not None:
+            self.memory = memory
+        if profile is not None:
+            self.profile = profile
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def current(self):
+        """
+        Name of the frame being reduced, or None.
+        """
+        return getattr(self._local, 'frame', None)
+
+    @contextlib.contextmanager
+    def frame(self, name):
+        """
+        Records the stages run in this context for the frame name.
+        Inside another frame, it is a stage of that frame.
+        """
+        if self.current is not None:
+            with self.stage(str(name)):
+                yield
+            return
+        self._local.frame = str(name)
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with self.stage('total'):
+                yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiles[self._local.frame] = profiler
+            total = self.records[self._local.frame][-1]
+            log.info('%s reduced in %.3f s (%.3f s CPU)', self._local.frame,
+                     total['wall'], total['cpu'])
+            self._local.frame = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measures the stage name of the current frame.
+        """
+        stack = self._stack
+        entry = {'peak': 0, 'started': False}
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            entry['started'] = True
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak is reset for this stage, the outer one is kept aside.
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'],
+                                        peak - stack[-1]['memory'])
+            tracemalloc.reset_peak()
+            entry['memory'] = current
+        path = '/'.join([e['name'] for e in stack] + [name])
+        entry['name'] = name
+        stack.append(entry)
+        start = datetime.datetime.now().isoformat()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            stack.pop()
+            record = {'stage': path, 'start': start, 'wall': wall,
+                      'cpu': cpu, 'peak': None, 'maxrss': maxrss()}
+            if tracing and tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1] - entry['memory']
+                record['peak'] = max(entry['peak'], peak)
+                if stack:
+                    outer = stack[-1]
+                    outer['peak'] = max(outer['peak'], record['peak']
+                                        + entry['memory'] - outer['memory'])
+            if entry['started']:
+                tracemalloc.stop()
+            if self.current is not None:
+                self.records.setdefault(self.current, []).append(record)
+            log.debug('%s %s: %.3f s, %.3f s CPU, peak %s bytes',
+                      self.current or '-', path, wall, cpu, record['peak'])
+
+    def report(self, frame=None):
+        """
+        Timing report of a frame: its stages, in the order they ended.
+        """
+        return {'frame': frame, 'stages': list(self.records.get(frame, []))}
+
+    def write(self, directory, frame=None):
+        """
+        Writes the report of each frame, or of frame, in directory as
+        {frame}.timing.json (added to an existing one), and its profile as
+        {frame}.prof, then forgets them. Returns the files written.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        frames = [frame] if frame is not None else list(self.records)
+        files = []
+        for f in frames:
+            name = Path(f).stem
+            file = directory / '{name}.timing.json'.format(name=name)
+            report = self.report(f)
+            try:
+                with open(str(file)) as fh:
+                    stages = json.load(fh)['stages']
+                report['stages'] = stages + report['stages']
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+            with open(str(file), 'w') as fh:
+                json.dump(report, fh, indent=1)
+            files.append(file)
+            self.records.pop(f, None)
+            profiler = self.profiles.pop(f, None)
+            if profiler is not None:
+                prof = directory / '{name}.prof'.format(name=name)
+                profiler.dump_stats(str(prof))
+                files.append(prof)
+        return files
+
+
+# The instrument of the process, used by the stages of pipeline.stability.
+instrument = Instrument()
+
+
+def timed(name):
+    """
+    Decorator that measures a function as the stage name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with instrument.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
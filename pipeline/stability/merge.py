@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Merging of the orders of a frame into one spectrum, with a sparse operator
+built once per wavelength grid (see MergeOperator).
+"""
+
+# python imports
+import hashlib
+import logging
+
+# numpy imports
+import numpy as np
+
+# scipy imports
+from scipy import sparse
+
+# pandas imports
+import pandas as pd
+
+# pipeline imports
+from pipeline.stability.instrument import timed
+
+log = logging.getLogger(__name__)
+
+# Speed of light, in km/s.
+C = 299792.458
+
+
+def log_grid(start, stop, velocity):
+    """
+    Wavelengths from start to stop evenly spaced in log, every velocity km/s.
+    """
+    step = np.log1p(velocity / C)
+    size = int(np.floor(np.log(stop / start) / step + 1e-9)) + 1
+    return start * np.exp(step * np.arange(size))
+
+
+def taper(length):
+    """
+    sin^2 weights along an order, so that its edges hardly count.
+    """
+    return np.sin(np.pi * (np.arange(length) + 0.5) / length) ** 2
+
+
+def _key(wavelength, order):
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    order = np.asarray(order, dtype=np.int64)
+    return hashlib.sha1(wavelength.tobytes() + order.tobytes()).hexdigest()
+
+
+class MergeOperator(object):
+    """
+    Sparse operator that resamples the orders of a table on a common
+    wavelength grid, and averages them where they overlap.
+
+    Parameters:
+    -----------
+    wavelength, order : Wavelength and Order columns of the extracted orders.
+
+    grid : wavelengths of the merged spectrum. Defaults to a grid evenly
+           spaced in log (see log_grid()), with the median step of the
+           pixels, or velocity.
+
+    velocity : step of the default grid, in km/s.
+
+    weighting : 'taper' (see taper()), 'uniform', or the weights of the rows.
+
+    Output:
+    -------
+
+    Called on a column (npixels), or a stack of columns (N x npixels),
+    returns the merged spectra on .grid. The pixels that are not finite are
+    left out, the wavelengths no order covers are NaN.
+    """
+    def __init__(self,
+                 wavelength,
+                 order,
+                 grid=None,
+                 velocity=None,
+                 weighting='taper'):
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+        order = np.asarray(order)
+        if wavelength.shape != order.shape or wavelength.ndim != 1:
+            raise ValueError('The Wavelength and Order columns must have the '
+                             'same length')
+        self.npixels = len(wavelength)
+        self.key = _key(wavelength, order)
+        rows = self._rows(wavelength, order)
+        if grid is None:
+            grid = self._grid(wavelength, rows, velocity)
+        self.grid = np.asarray(grid, dtype=np.float64)
+        weights = self._weights(weighting, rows)
+        self.matrix = self._build(wavelength, rows, weights)
+
+    @staticmethod
+    def _rows(wavelength, order):
+        # Rows of each order sorted by wavelength, with two pixels at least.
+        index = np.argsort(order, kind='stable')
+        unique, starts = np.unique(order[index], return_index=True)
+        rows = {}
+        for o, r in zip(unique.tolist(), np.split(index, starts[1:])):
+            r = r[np.isfinite(wavelength[r])]
+            if len(r) > 1:
+                rows[o] = r[np.argsort(wavelength[r], kind='stable')]
+        if not rows:
+            raise ValueError('No order with valid wavelengths to merge')
+        return rows
+
+    @staticmethod
+    def _grid(wavelength, rows, velocity):
+        if velocity is None:
+            steps = [np.diff(np.log(wavelength[r])) for r in rows.values()]
+            velocity = C * np.expm1(np.median(np.concatenate(steps)))
+        start = min(wavelength[r[0]] for r in rows.values())
+        stop = max(wavelength[r[-1]] for r in rows.values())
+        return log_grid(start, stop, velocity)
+
+    def _weights(self, weighting, rows):
+        if isinstance(weighting, str):
+            if weighting not in ('taper', 'uniform'):
+                raise ValueError('Unknown weighting {weighting}'.format(
+                    weighting=weighting))
+            weights = np.zeros(self.npixels)
+            for r in rows.values():
+                weights[r] = taper(len(r)) if weighting == 'taper' else 1.
+            return weights
+        weights = np.asarray(weighting, dtype=np.float64)
+        if weights.shape != (self.npixels,):
+            raise ValueError('The weights must have one value per row of the '
+                             'tables')
+        return np.where(np.isfinite(weights) & (weights > 0), weights, 0.)
+
+    @timed('merge_operator')
+    def _build(self, wavelength, rows, weights):
+        # Row k holds the interpolation coefficients of grid[k] in each order
+        # that covers it, times the weights of the pixels.
+        grid_rows, columns, values = [], [], []
+        for r in rows.values():
+            w = wavelength[r]
+            inside = np.flatnonzero((self.grid >= w[0]) & (self.grid <= w[-1]))
+            j = np.searchsorted(w, self.grid[inside], side='right')
+            j = np.clip(j, 1, len(w) - 1)
+            span = w[j] - w[j - 1]
+            t = np.divide(self.grid[inside] - w[j - 1], span,
+                          out=np.zeros(len(inside)), where=span > 0)
+            grid_rows.append(np.concatenate([inside, inside]))
+            columns.append(np.concatenate([r[j - 1], r[j]]))
+            values.append(np.concatenate([(1 - t) * weights[r[j - 1]],
+                                          t * weights[r[j]]]))
+        matrix = sparse.csr_matrix(
+            (np.concatenate(values),
+             (np.concatenate(grid_rows), np.concatenate(columns))),
+            shape=(len(self.grid), self.npixels))
+        matrix.eliminate_zeros()
+        return matrix
+
+    def __call__(self, flux):
+        """
+        Merges a column of a table, or a stack of columns.
+        """
+        flux = np.asarray(flux, dtype=np.float64)
+        if flux.shape[-1] != self.npixels or flux.ndim > 2:
+            raise ValueError('{n} pixels do not match the {op} rows of the '
+                             'operator'.format(n=flux.shape[-1],
+                                               op=self.npixels))
+        stack = np.atleast_2d(flux)
+        valid = np.isfinite(stack)
+        n = len(stack)
+        # The masks are merged with the fluxes, to normalise the weights.
+        columns = np.empty((self.npixels, 2 * n))
+        columns[:, :n] = np.where(valid, stack, 0.).T
+        columns[:, n:] = valid.T
+        product = self.matrix @ columns
+        weights = product[:, n:]
+        merged = np.full(weights.shape, np.nan)
+        np.divide(product[:, :n], weights, out=merged, where=weights > 0)
+        return merged.T[0] if flux.ndim == 1 else merged.T
+
+    def matches(self, orders):
+        """
+        Tells if the operator was built for the wavelengths of orders.
+        """
+        return (len(orders) == self.npixels
+                and _key(orders['Wavelength'], orders['Order']) == self.key)
+
+
+def merge(orders, columns=('Normalised',), operator=None, **options):
+    """
+    Merges the columns of a table of orders into one spectrum, with operator,
+    or a MergeOperator built with options. Returns the merged table, with
+    the Wavelength of the grid, and the operator.
+    """
+    columns = [c for c in columns if c in orders]
+    if not columns:
+        raise ValueError('None of the columns to merge is in the table')
+    if operator is None or not operator.matches(orders):
+        operator = MergeOperator(orders['Wavelength'].values,
+                                 orders['Order'].values, **options)
+    merged = operator(np.stack([orders[c].values for c in columns]))
+    table = pd.DataFrame({'Wavelength': operator.grid},
+                         columns=['Wavelength'] + columns)
+    for c, values in zip(columns, merged):
+        table[c] = values
+    return table, operator
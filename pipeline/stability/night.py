@@ -0,0 +1,632 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python imports
+from pathlib import Path
+from concurrent.futures import (
+    Executor, Future, ProcessPoolExecutor, FIRST_COMPLETED, wait)
+import argparse
+import logging
+import os
+import pickle
+import tempfile
+import types
+
+# pipeline imports
+from pipeline.stability.cache import Cache
+from pipeline.stability.instrument import instrument
+from pipeline.stability.merge import merge
+from pipeline.stability.stability import (
+    HRS, Extract, ListOfFiles, Master, Normalise, Order, append_extraction,
+    extraction_frames, read_extraction)
+from pipeline.stability.thar import LineList, read_guess, solve
+
+log = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+    A node of the graph of a night.
+
+    Parameters:
+    -----------
+    name : unique name of the stage, like 'extract-R201701010012'.
+
+    function : function that does the work, in a process of the pool.
+               It must be picklable, as its arguments and what it returns.
+
+    arguments : arguments of function, or a function that returns them
+                once the stages it depends on are done.
+
+    depends : names of the stages that must be done before this one.
+
+    done : function that tells if the outputs of the stage exist.
+
+    finish : function called in the main process with what function
+             returned, to store it.
+
+    local : if True, the stage runs in the main process.
+    """
+    def __init__(self,
+                 name,
+                 function,
+                 arguments=(),
+                 depends=(),
+                 done=None,
+                 finish=None,
+                 local=False):
+        self.name = name
+        self.function = function
+        self.arguments = arguments
+        self.depends = list(depends)
+        self.done = done if done is not None else (lambda: False)
+        self.finish = finish
+        self.local = local
+
+    def __repr__(self):
+        return 'Stage {name} (depends on {depends})'.format(
+            name=self.name, depends=', '.join(self.depends) or '-')
+
+    def args(self):
+        if callable(self.arguments):
+            return self.arguments()
+        return self.arguments
+
+
+class SerialExecutor(Executor):
+    """
+    Executor that runs the stages one after the other in this process.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def dump(product, target):
+    """
+    Pickles an Order or a wavelength solution in target, atomically.
+    """
+    fd, tmp = tempfile.mkstemp(dir=str(Path(target).parent), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+        pickle.dump(product, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, str(target))
+
+
+# Products loaded by a worker, which keep their operators between frames.
+_products = {}
+
+
+def load(file):
+    """
+    Unpickles the product in file, once as long as the file does not change.
+    """
+    stat = os.stat(str(file))
+    key = (str(file), stat.st_mtime_ns)
+    if key not in _products:
+        with open(str(file), 'rb') as fh:
+            _products[key] = pickle.load(fh)
+    return _products[key]
+
+
+def _cache(cachepath):
+    return Cache(cachepath) if cachepath is not None else None
+
+
+# Directory of the timing reports of the frames, or None.
+_timings = None
+
+
+def configure(timings=None, memory=False, profile=False,
+              level=logging.WARNING):
+    """
+    Sets up the logging and the instrument of a process.
+    """
+    global _timings
+    _timings = str(timings) if timings is not None else None
+    instrument.configure(memory=memory, profile=profile)
+    logging.basicConfig(level=level,
+                        format='%(asctime)s %(processName)s %(name)s '
+                               '%(levelname)s %(message)s')
+
+
+def _report():
+    if _timings is not None:
+        instrument.write(_timings)
+
+
+def order_stage(flatfile, target, options, cachepath=None):
+    """
+    Finds the orders on a master flat, and pickles the Order in target.
+    """
+    with HRS(hrsfile=Path(flatfile)) as flat:
+        order = Order(hrs=flat, cache=_cache(cachepath), **options)
+    dump(order, target)
+    _report()
+
+
+def wavelength_stage(orderfile, tharfiles, target, options, cachepath=None):
+    """
+    Pickles in target the wavelength solution of the sum of the ThAr frames.
+    options are the linelist and guess files, and the arguments of solve().
+    """
+    options = dict(options)
+    linelist, guess = options.pop('linelist'), options.pop('guess')
+    order = load(orderfile)
+    cache = _cache(cachepath)
+    key = None
+    solution = None
+    if cache is not None and getattr(order, 'cachekey', None) is not None:
+        files = list(tharfiles) + [linelist, guess]
+        key = cache.key('wavelength', files=files, parents=[order.cachekey],
+                        **options)
+        solution = cache.get(key)
+    if solution is None:
+        with instrument.frame(Path(tharfiles[0]).stem[:9] + '_wavelength'):
+            extracted = None
+            for file in tharfiles:
+                with HRS(hrsfile=Path(file)) as hrs:
+                    orders = Extract(order, hrs, sparse=True,
+                                     cache=cache).orders
+                    chip, mode = hrs.chip, hrs.mode
+                if extracted is None:
+                    extracted = orders
+                else:
+                    extracted = extracted + orders
+            solution = solve(extracted, LineList.read(linelist),
+                             read_guess(guess), chip, mode, **options)
+        if key is not None:
+            cache.put(key, solution)
+    dump(solution, target)
+    _report()
+
+
+def extract_stage(orderfile, sciencefile, options, cachepath=None,
+                  wavelengthfile=None):
+    """
+    Extracted orders and header of a science frame, with the wavelengths of
+    wavelengthfile, or of the pyhrs reduced file.
+    """
+    wavelength = None
+    if wavelengthfile is not None:
+        wavelength = load(wavelengthfile)
+    with HRS(hrsfile=Path(sciencefile)) as hrs:
+        extract = Extract(load(orderfile), hrs, extract=True,
+                          cache=_cache(cachepath), wavelength=wavelength,
+                          **options)
+    _report()
+    return extract.wlcrorders, hrs.header
+
+
+def normalise_stage(frame, science, specphot, options):
+    """
+    Normalises the orders of a science frame, (table, header), with those
+    of the spectrophotometric standard.
+    """
+    science, header = science
+    with instrument.frame(frame):
+        normalised = Normalise(types.SimpleNamespace(wlcrorders=science),
+                               types.SimpleNamespace(wlcrorders=specphot),
+                               **options)
+    _report()
+    return normalised.normalised.wlcrorders, header
+
+
+def merge_stage(frame, normalised, options):
+    """
+    Merges the normalised orders of a science frame, (table, header), with
+    the operator of the last frame when the wavelengths match.
+    """
+    normalised, header = normalised
+    options = dict(options)
+    columns = options.pop('columns', ('Normalised',))
+    key = ('merge', repr(sorted(options.items())))
+    with instrument.frame(frame):
+        merged, _products[key] = merge(normalised, columns=columns,
+                                       operator=_products.get(key),
+                                       **options)
+    _report()
+    return merged, header
+
+
+class Night(object):
+    """
+    Reduces a night: masterbias -> masterflat -> order -> (wavelength) ->
+    extract -> normalise -> merge, by chip and mode, in a pool of
+    processes. The stages whose outputs exist are not run again.
+
+    Parameters:
+    -----------
+    datadir : directory of the data, and of the master frames.
+
+    outdir : directory of the reduced files. Defaults to datadir.
+
+    workers : number of processes. 0 reduces everything in this process.
+
+    cache : directory of the Cache of the intermediate products, or None.
+
+    order, extract, normalise : keyword arguments of Order, Extract and
+                                Normalise.
+
+    merge : keyword arguments of merge(), and the 'columns' merged.
+
+    wavelength : 'linelist' and 'guess' files of the wavelength calibration
+                 with the ThAr frames. Without them, the wavelengths of the
+                 pyhrs files are used.
+
+    timings : directory of the JSON timing reports of the frames, or None.
+
+    memory, profile : trace the memory with tracemalloc, profile the frames.
+
+    Usage:
+    ------
+
+    night = Night('/data/20170101', workers=8)
+    night.run()
+    """
+    def __init__(self,
+                 datadir,
+                 outdir=None,
+                 workers=4,
+                 cache=None,
+                 order=None,
+                 extract=None,
+                 normalise=None,
+                 merge=None,
+                 wavelength=None,
+                 timings=None,
+                 memory=False,
+                 profile=False):
+        self.datadir = Path(datadir)
+        self.outdir = Path(outdir) if outdir is not None else self.datadir
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.cachepath = str(cache) if cache is not None else None
+        self.options = {
+            'order': dict(order or {}),
+            'extract': dict(extract or {}),
+            'normalise': dict(normalise or {}),
+            'merge': dict(merge or {}),
+            'wavelength': dict(wavelength or {})}
+        self.instrumentation = {'timings': timings,
+                                'memory': memory,
+                                'profile': profile}
+        self.lof = ListOfFiles(self.datadir)
+        self.stages = {}
+        self._frames = {}
+        self.build()
+
+    def __repr__(self):
+        return 'Night {datadir}\n'.format(datadir=self.datadir) + '\n'.join(
+            repr(s) for s in self.stages.values())
+
+    def add(self, stage):
+        self.stages[stage.name] = stage
+        return stage
+
+    def group(self, files):
+        """
+        Groups files by chip and mode, with the keywords of the index.
+        """
+        groups = {}
+        for f in files:
+            record = self.lof.index.record(f)
+            if record is None or not f.name.startswith(('H', 'R')):
+                continue
+            chip = 'HBDET' if f.name.startswith('H') else 'HRDET'
+            mode = (record['OBSMODE'] or 'UNKNOWN').split()[0]
+            groups.setdefault((chip, mode), []).append(f)
+        return groups
+
+    def nightfile(self, frame, kind='extracted'):
+        # R201701010012.fits: the chip letter and the night come first.
+        return self.outdir / '{night}_{kind}.fits'.format(
+            night=Path(frame).stem[:9], kind=kind)
+
+    def stored(self, file):
+        """
+        Names of the frames in a file of the night, read once.
+        """
+        if file not in self._frames:
+            frames = extraction_frames(file) if file.exists() else []
+            self._frames[file] = set(frames)
+        return self._frames[file]
+
+    def _store(self, file, frame):
+        def finish(product):
+            if isinstance(product, tuple):
+                orders, header = product
+            else:
+                orders, header = product, None
+            append_extraction(file, orders, frame, header=header)
+            self.stored(file).add(frame)
+        return finish
+
+    def build(self):
+        """
+        Builds the graph of the stages of the night.
+        """
+        colors = {'HBDET': 'blue', 'HRDET': 'red'}
+        biases = self.group(self.lof.bias)
+        masterbias = [self.datadir / '{color}masterbias.fits'.format(
+                          color=colors[chip])
+                      for chip in {c for c, m in biases}]
+        self.add(Stage(
+            'masterbias', Master.makemasterbias,
+            (self.lof, _cache(self.cachepath)),
+            done=lambda: all(f.exists() for f in masterbias), local=True))
+        flats = self.group(self.lof.flat)
+        masterflats = [self.datadir / '{color}masterflat_{mode}.fits'.format(
+                           color=colors[chip], mode=mode)
+                       for chip, mode in flats]
+        self.add(Stage(
+            'masterflat', Master.makemasterflat,
+            (self.lof, _cache(self.cachepath)), depends=['masterbias'],
+            done=lambda: all(f.exists() for f in masterflats), local=True))
+
+        science = self.group(self.lof.science)
+        specphot = self.group(self.lof.specphot)
+        thar = self.group(self.lof.thar)
+        for (chip, mode), frames in sorted(science.items()):
+            flatfile = self.datadir / '{color}masterflat_{mode}.fits'.format(
+                color=colors[chip], mode=mode)
+            orderfile = self.outdir / 'order_{chip}_{mode}.pkl'.format(
+                chip=chip, mode=mode)
+            order = self.add(Stage(
+                'order-{chip}-{mode}'.format(chip=chip, mode=mode),
+                order_stage,
+                (flatfile, orderfile, self.options['order'], self.cachepath),
+                depends=['masterflat'],
+                done=lambda orderfile=orderfile: orderfile.exists()))
+            standards = specphot.get((chip, mode), [])
+            wavelength = self._calibration(chip, mode,
+                                           thar.get((chip, mode), []),
+                                           frames, orderfile, order)
+            for frame in sorted(set(frames) | set(standards)):
+                self._extraction(frame, orderfile, order, wavelength)
+            if not standards:
+                log.warning('No spectrophotometric standard for %s %s, the '
+                            'frames are not normalised', chip, mode)
+                continue
+            standard = standards[0]
+            for frame in frames:
+                self._normalisation(frame, standard)
+                self._merging(frame)
+
+    def _calibration(self, chip, mode, tharfiles, frames, orderfile, order):
+        """
+        Adds the wavelength stage of a chip and mode. Returns the stage and
+        its file, or None, None to use the pyhrs wavelengths.
+        """
+        options = dict(self.options['wavelength'])
+        if options.get('linelist') is None or not tharfiles:
+            return None, None
+        if options.get('guess') is None:
+            pyhrs = [f.parent / ('p' + f.stem + '_obj' + f.suffix)
+                     for f in sorted(frames)]
+            pyhrs = [f for f in pyhrs if f.exists()]
+            if not pyhrs:
+                log.warning('No initial wavelengths for %s %s, the pyhrs '
+                            'files are used', chip, mode)
+                return None, None
+            options['guess'] = pyhrs[0]
+        target = self.outdir / 'wavelength_{chip}_{mode}.pkl'.format(
+            chip=chip, mode=mode)
+        stage = self.add(Stage(
+            'wavelength-{chip}-{mode}'.format(chip=chip, mode=mode),
+            wavelength_stage,
+            (orderfile, sorted(tharfiles), target, options, self.cachepath),
+            depends=[order.name],
+            done=lambda: target.exists()))
+        return stage, target
+
+    def _extraction(self, frame, orderfile, order, wavelength=(None, None)):
+        extracted = self.nightfile(frame)
+        stage, wavelengthfile = wavelength
+        depends = [order.name]
+        if stage is not None:
+            depends.append(stage.name)
+        self.add(Stage(
+            'extract-{frame}'.format(frame=frame.stem), extract_stage,
+            (orderfile, frame, self.options['extract'], self.cachepath,
+             wavelengthfile),
+            depends=depends,
+            done=lambda: frame.stem in self.stored(extracted),
+            finish=self._store(extracted, frame.stem)))
+
+    def _normalisation(self, frame, standard):
+        extracted = self.nightfile(frame)
+        normalised = self.nightfile(frame, kind='normalised')
+        self.add(Stage(
+            'normalise-{frame}'.format(frame=frame.stem), normalise_stage,
+            lambda: (frame.name,
+                     read_extraction(extracted, frame.stem, header=True),
+                     read_extraction(self.nightfile(standard),
+                                     standard.stem),
+                     self.options['normalise']),
+            depends=['extract-{frame}'.format(frame=f.stem)
+                     for f in sorted({frame, standard})],
+            done=lambda: frame.stem in self.stored(normalised),
+            finish=self._store(normalised, frame.stem)))
+
+    def _merging(self, frame):
+        normalised = self.nightfile(frame, kind='normalised')
+        merged = self.nightfile(frame, kind='merged')
+        self.add(Stage(
+            'merge-{frame}'.format(frame=frame.stem), merge_stage,
+            lambda: (frame.name,
+                     read_extraction(normalised, frame.stem, header=True),
+                     self.options['merge']),
+            depends=['normalise-{frame}'.format(frame=frame.stem)],
+            done=lambda: frame.stem in self.stored(merged),
+            finish=self._store(merged, frame.stem)))
+
+    def run(self):
+        """
+        Runs the stages whose outputs do not exist yet. A stage that fails
+        only skips the stages that depend on it. Returns the names of the
+        stages done, run, failed and skipped.
+        """
+        completed = {name for name, stage in self.stages.items()
+                     if stage.done()}
+        pending = {name: stage for name, stage in self.stages.items()
+                   if name not in completed}
+        report = {'done': sorted(completed), 'run': [], 'failed': [],
+                  'skipped': []}
+        settings = (self.instrumentation['timings'],
+                    self.instrumentation['memory'],
+                    self.instrumentation['profile'],
+                    logging.getLogger().getEffectiveLevel())
+        if self.workers:
+            executor = ProcessPoolExecutor(max_workers=self.workers,
+                                           initializer=configure,
+                                           initargs=settings)
+        else:
+            configure(*settings)
+            executor = SerialExecutor()
+        running = {}
+        with executor:
+            while pending or running:
+                for name, stage in sorted(pending.items()):
+                    if any(d in report['failed'] or d in report['skipped']
+                           for d in stage.depends):
+                        log.warning('Skipping %s', name)
+                        report['skipped'].append(name)
+                        del pending[name]
+                    elif all(d in completed for d in stage.depends):
+                        del pending[name]
+                        if stage.local:
+                            self._finish(stage, stage.function, stage.args(),
+                                         completed, report)
+                        else:
+                            try:
+                                future = executor.submit(stage.function,
+                                                         *stage.args())
+                                running[future] = stage
+                            except Exception:
+                                self._fail(stage, report)
+                        break
+                else:
+                    if not running:
+                        # What is left depends on stages not in the graph.
+                        report['skipped'].extend(sorted(pending))
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self._finish(running.pop(future), future.result, (),
+                                     completed, report)
+        return report
+
+    def _finish(self, stage, function, args, completed, report):
+        try:
+            product = function(*args)
+            if stage.finish is not None:
+                stage.finish(product)
+        except Exception:
+            self._fail(stage, report)
+            return
+        log.info('%s done', stage.name)
+        completed.add(stage.name)
+        report['run'].append(stage.name)
+
+    def _fail(self, stage, report):
+        log.exception('%s failed', stage.name)
+        report['failed'].append(stage.name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HRS Data Reduction pipeline')
+    parser.add_argument('-d',
+                        '--datadir',
+                        help='Directory where the data to be reduced are',
+                        default='.')
+    parser.add_argument('-o',
+                        '--outdir',
+                        help='Directory where the reduced data are written. '
+                             'Defaults to the data directory',
+                        default=None)
+    parser.add_argument('-w',
+                        '--workers',
+                        help='Number of processes. 0 reduces everything in '
+                             'this process',
+                        type=int,
+                        default=os.cpu_count())
+    parser.add_argument('-c',
+                        '--cache',
+                        help='Directory of the cache of the intermediate '
+                             'products',
+                        default=None)
+    parser.add_argument('--fit', choices=['astropy', 'batched'],
+                        default='astropy')
+    parser.add_argument('--detection', choices=['cwt', 'fast'],
+                        default='cwt')
+    parser.add_argument('--sparse',
+                        action='store_true',
+                        help='Extract the orders with the sparse operator')
+    parser.add_argument('--clipping', choices=['astropy', 'vectorized'],
+                        default='astropy')
+    parser.add_argument('--smoother', choices=['lowess', 'binned'],
+                        default='lowess')
+    parser.add_argument('--velocity',
+                        type=float,
+                        help='Step of the merged spectra in km/s. Defaults '
+                             'to the sampling of the orders',
+                        default=None)
+    parser.add_argument('--linelist',
+                        help='ThAr line list (wavelengths in Angstroms). '
+                             'Calibrates the night with its ThAr frames',
+                        default=None)
+    parser.add_argument('--guess',
+                        help='Initial wavelengths: a wavelength solution of '
+                             'another night (.pkl) or a pyhrs file',
+                        default=None)
+    parser.add_argument('-t',
+                        '--timings',
+                        help='Directory where the JSON timing report of each '
+                             'frame is written',
+                        default=None)
+    parser.add_argument('--trace-memory',
+                        action='store_true',
+                        help='Record the peak memory of each stage with '
+                             'tracemalloc (slower)')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Profile each frame with cProfile, the '
+                             'statistics are written with the timing reports')
+    parser.add_argument('-l',
+                        '--log-level',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        default='INFO')
+    parser.add_argument('-n',
+                        '--dry-run',
+                        action='store_true',
+                        help='Only log the stages of the night')
+    args = parser.parse_args(argv)
+    configure(level=getattr(logging, args.log_level))
+    night = Night(args.datadir,
+                  outdir=args.outdir,
+                  workers=args.workers,
+                  cache=args.cache,
+                  order={'fit': args.fit, 'detection': args.detection},
+                  extract={'sparse': args.sparse, 'clipping': args.clipping},
+                  normalise={'smoother': args.smoother},
+                  merge={'velocity': args.velocity},
+                  wavelength={'linelist': args.linelist, 'guess': args.guess},
+                  timings=args.timings,
+                  memory=args.trace_memory,
+                  profile=args.profile)
+    log.info('%s', night)
+    if args.dry_run:
+        return None
+    report = night.run()
+    log.info('%d stages run, %d already done, %d failed, %d skipped',
+             len(report['run']), len(report['done']), len(report['failed']),
+             len(report['skipped']))
+    return report
+
+
+if __name__ == '__main__':
+    main()
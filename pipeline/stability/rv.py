@@ -0,0 +1,596 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Radial velocities of the science frames.
+
+    hrs-rv -d reduced/2017* --mask G2.mas -o rv/
+
+The normalised orders of the frames are cross-correlated with a line mask,
+a sparse matrix over the pixels (see MaskOperator), a gaussian is fitted to
+the CCFs (see fit_ccf()) and the velocities are kept in a time series per
+chip and mode (see RVSeries).
+"""
+
+# python imports
+from pathlib import Path
+import hashlib
+import logging
+
+# numpy imports
+import numpy as np
+
+# scipy imports
+from scipy import sparse
+
+# astropy imports
+from astropy.io import fits
+
+# pipeline imports
+from pipeline.stability.instrument import instrument, timed
+from pipeline.stability.merge import C
+from pipeline.stability.series import (
+    TimeSeries, command_line, interpolate_peak, mjd, parse_command_line,
+    worker_map)
+from pipeline.stability.stability import read_extractions
+
+log = logging.getLogger(__name__)
+
+
+class LineMask(object):
+    """
+    Rest wavelengths (Angstroms) and weights of the lines of a mask.
+    """
+    def __init__(self,
+                 wavelengths,
+                 weights=None):
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        if weights is None:
+            weights = np.ones(len(wavelengths))
+        weights = np.asarray(weights, dtype=np.float64)
+        index = np.argsort(wavelengths)
+        self.wavelengths = wavelengths[index]
+        self.weights = weights[index]
+
+    def __len__(self):
+        return len(self.wavelengths)
+
+    @classmethod
+    def read(cls, file):
+        """
+        Reads a mask: wavelength and weight, or start, end and weight of the
+        lines like the masks of HARPS.
+        """
+        table = np.atleast_2d(np.loadtxt(str(file), ndmin=2))
+        if table.shape[1] >= 3:
+            return cls(0.5 * (table[:, 0] + table[:, 1]), table[:, 2])
+        if table.shape[1] == 2:
+            return cls(table[:, 0], table[:, 1])
+        return cls(table[:, 0])
+
+
+def velocity_grid(centre=0., span=100., step=1.):
+    """
+    Velocities (km/s) from centre - span to centre + span, every step.
+    """
+    n = int(np.floor(span / step + 1e-9))
+    return centre + step * np.arange(-n, n + 1)
+
+
+class MaskOperator(object):
+    """
+    Sparse operator that cross-correlates the orders of a table with a line
+    mask, at a grid of velocities. The lines are boxes of width km/s, and
+    only those that stay in an order at every velocity are kept.
+
+    Parameters:
+    -----------
+    wavelength, order : Wavelength and Order columns of the tables.
+
+    mask : LineMask.
+
+    velocities : velocities of the CCFs, in km/s.
+
+    width : width of the lines, in km/s. Defaults to the size of a pixel.
+
+    Output:
+    -------
+
+    Called on a column (npixels), or a stack of columns (N x npixels),
+    returns the CCFs of .orders (... x norders x nvelocities), divided by
+    their continuum, and the continuum.
+    """
+    def __init__(self,
+                 wavelength,
+                 order,
+                 mask,
+                 velocities,
+                 width=None):
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+        order = np.asarray(order)
+        if wavelength.shape != order.shape or wavelength.ndim != 1:
+            raise ValueError('The Wavelength and Order columns must have the '
+                             'same length')
+        self.npixels = len(wavelength)
+        self.key = layout_key(wavelength, order)
+        self.velocities = np.asarray(velocities, dtype=np.float64)
+        rows = {}
+        for o in np.unique(order).tolist():
+            r = np.flatnonzero((order == o) & np.isfinite(wavelength))
+            if len(r) > 1:
+                rows[o] = r[np.argsort(wavelength[r], kind='stable')]
+        self.orders = np.array(sorted(rows, reverse=True), dtype=np.int64)
+        if width is None:
+            steps = [np.diff(np.log(wavelength[r])) for r in rows.values()]
+            width = C * np.median(np.concatenate(steps))
+        self.width = width
+        self.matrix = self._build(wavelength, [rows[o] for o in self.orders],
+                                  mask)
+
+    @timed('mask_operator')
+    def _build(self, wavelength, rows, mask):
+        nvel = len(self.velocities)
+        shifts = 1 + self.velocities / C
+        half = 0.5 * self.width / C
+        ccf_rows, columns, values = [], [], []
+        for k, r in enumerate(rows):
+            w = wavelength[r]
+            edges = np.concatenate([[1.5 * w[0] - 0.5 * w[1]],
+                                    0.5 * (w[1:] + w[:-1]),
+                                    [1.5 * w[-1] - 0.5 * w[-2]]])
+            inside = ((mask.wavelengths * shifts.min() * (1 - half)
+                       >= edges[0])
+                      & (mask.wavelengths * shifts.max() * (1 + half)
+                         <= edges[-1]))
+            if not inside.any():
+                continue
+            centres = mask.wavelengths[inside][:, None] * shifts[None, :]
+            lo, hi = centres * (1 - half), centres * (1 + half)
+            first = np.clip(np.searchsorted(edges, lo, side='right') - 1,
+                            0, len(w) - 1)
+            npix = int(np.max(np.searchsorted(edges, hi) - first)) + 1
+            p = np.minimum(first[..., None] + np.arange(npix), len(w) - 1)
+            covered = np.clip(np.minimum(edges[p + 1], hi[..., None])
+                              - np.maximum(edges[p], lo[..., None]), 0, None)
+            # A pixel repeated at the end of the order covers nothing.
+            covered[..., 1:][p[..., 1:] == p[..., :-1]] = 0
+            weight = (mask.weights[inside][:, None, None] * covered
+                      / (edges[p + 1] - edges[p]))
+            keep = weight > 0
+            index = (k * nvel + np.arange(nvel))[None, :, None]
+            ccf_rows.append(np.broadcast_to(index, p.shape)[keep])
+            columns.append(r[p][keep])
+            values.append(weight[keep])
+        if not values:
+            raise ValueError('No line of the mask falls in the orders')
+        return sparse.csr_matrix(
+            (np.concatenate(values),
+             (np.concatenate(ccf_rows), np.concatenate(columns))),
+            shape=(len(self.orders) * nvel, self.npixels))
+
+    def __call__(self, flux):
+        """
+        Cross-correlates a column of a table, or a stack of columns.
+        """
+        flux = np.asarray(flux, dtype=np.float64)
+        if flux.shape[-1] != self.npixels or flux.ndim > 2:
+            raise ValueError('{n} pixels do not match the {op} rows of the '
+                             'operator'.format(n=flux.shape[-1],
+                                               op=self.npixels))
+        stack = np.atleast_2d(flux)
+        valid = np.isfinite(stack)
+        n = len(stack)
+        # The masks of the valid pixels give the continuum.
+        columns = np.empty((self.npixels, 2 * n))
+        columns[:, :n] = np.where(valid, stack, 0.).T
+        columns[:, n:] = valid.T
+        product = (self.matrix @ columns).T.reshape(
+            2 * n, len(self.orders), len(self.velocities))
+        continuum = product[n:]
+        ccf = np.full(continuum.shape, np.nan)
+        np.divide(product[:n], continuum, out=ccf, where=continuum > 0)
+        if flux.ndim == 1:
+            return ccf[0], continuum[0]
+        return ccf, continuum
+
+    def matches(self, orders):
+        """
+        Tells if the operator was built for the wavelengths of orders.
+        """
+        return (len(orders) == self.npixels
+                and layout_key(orders['Wavelength'],
+                               orders['Order']) == self.key)
+
+
+def layout_key(wavelength, order):
+    """
+    Digest of the wavelengths of the orders of a table.
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    order = np.asarray(order, dtype=np.int64)
+    return hashlib.sha1(wavelength.tobytes() + order.tobytes()).hexdigest()
+
+
+@timed('fit_ccf')
+def fit_ccf(velocities, ccf, iterations=10, window=3.):
+    """
+    Fits c - a exp(-(v - v0)^2 / 2 s^2) to CCFs (... x nvelocities) at once,
+    within window s of the minimum. Returns v0, the FWHM and the contrast
+    a / c, NaN where the fit failed.
+    """
+    v = np.asarray(velocities, dtype=np.float64)
+    ccf = np.asarray(ccf, dtype=np.float64)
+    n = len(v)
+    dv = np.median(np.diff(v))
+    valid = np.isfinite(ccf)
+    edge = max(n // 8, 1)
+    outer = np.concatenate([ccf[..., :edge], ccf[..., -edge:]], axis=-1)
+    good = np.isfinite(outer).any(axis=-1)
+    continuum = np.full(ccf.shape[:-1], np.nan)
+    continuum[good] = np.nanmedian(outer[good], axis=-1)
+    depth = np.where(valid, continuum[..., None] - ccf, -np.inf)
+    m = np.clip(np.argmax(depth, axis=-1), 1, n - 2)
+    left, centre, right = (
+        np.take_along_axis(depth, (m + k)[..., None], axis=-1)[..., 0]
+        for k in (-1, 0, 1))
+    left, right = (np.where(np.isfinite(x), x, 0.) for x in (left, right))
+    centre = np.where(np.isfinite(centre), centre, 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvature = 2 * np.log(centre) - np.log(left) - np.log(right)
+        sigma = dv / np.sqrt(curvature)
+        area = np.sum(np.clip(np.where(valid, depth, 0.), 0, None),
+                      axis=-1) * dv
+        sigma = np.where(np.isfinite(sigma) & (sigma > 0), sigma,
+                         area / (centre * np.sqrt(2 * np.pi)))
+    params = np.stack([continuum, centre,
+                       v[m] + dv * interpolate_peak(left, centre, right),
+                       np.clip(np.nan_to_num(sigma, nan=dv), dv / 2,
+                               n * dv / 4)], axis=-1)
+    failed = ~np.isfinite(params).all(axis=-1) | (centre <= 0)
+    params[failed] = [1., 1., v[n // 2], dv]
+    fitted = (valid & ~failed[..., None]
+              & (np.abs(v - params[..., 2:3]) <= window * params[..., 3:4]))
+    y = np.where(fitted, ccf, 0.)
+    eye = np.eye(4)
+    for _ in range(iterations):
+        c, a, mu, s = (params[..., k:k + 1] for k in range(4))
+        x = (v - mu) / s
+        e = np.exp(-0.5 * x ** 2)
+        jacobian = np.stack([np.ones_like(e), -e, -a * e * x / s,
+                             -a * e * x ** 2 / s], axis=-1)
+        jacobian *= fitted[..., None]
+        residual = (y - (c - a * e)) * fitted
+        normal = np.einsum('...ki,...kj->...ij', jacobian, jacobian)
+        # A little damping, the CCFs that cannot be fitted stay put.
+        normal += 1e-3 * normal * eye + 1e-12 * eye
+        gradient = np.einsum('...ki,...k->...i', jacobian, residual)
+        step = np.linalg.solve(normal, gradient[..., None])[..., 0]
+        params += np.nan_to_num(step)
+    c, a, mu, s = (params[..., k] for k in range(4))
+    ok = (~failed & (a > 0) & (c > 0) & (fitted.sum(axis=-1) >= 5)
+          & (mu >= v[0]) & (mu <= v[-1]) & np.isfinite(params).all(axis=-1))
+    fwhm = 2 * np.sqrt(2 * np.log(2)) * np.abs(s)
+    return (np.where(ok, mu, np.nan), np.where(ok, fwhm, np.nan),
+            np.where(ok, a / c, np.nan))
+
+
+def combine(ccf, continuum, weights=None):
+    """
+    Combines the CCFs of the orders (... x norders x nvelocities), weighted
+    by their continua and the weights of the orders.
+    """
+    if weights is None:
+        weights = np.ones(ccf.shape[:-1])
+    w = np.where(np.isfinite(ccf),
+                 np.asarray(weights)[..., None] * continuum, 0.)
+    total = w.sum(axis=-2)
+    combined = np.full(total.shape, np.nan)
+    np.divide(np.sum(w * np.nan_to_num(ccf), axis=-2), total, out=combined,
+              where=total > 0)
+    return combined
+
+
+def order_snr(orders, column='Object'):
+    """
+    Signal to noise squared of the orders of a table, {order: median counts
+    of column}, or None.
+    """
+    if column not in orders:
+        return None
+    return orders.groupby('Order')[column].median().clip(lower=0).to_dict()
+
+
+class RVSeries(TimeSeries):
+    """
+    Radial velocities of a chip and mode: the RV table has a row per science
+    frame with the velocity (km/s) of the combined CCF, its error, FWHM and
+    contrast, and those of the orders ORDER1, ORDER1 - 1...
+    """
+    extension = 'RV'
+    formats = [('File', '32A', None),
+               ('Night', '32A', None),
+               ('OBJECT', '32A', None),
+               ('DATE-OBS', '10A', None),
+               ('TIME-OBS', '16A', None),
+               ('MJD', 'D', None),
+               ('RV', 'D', 'km/s'),
+               ('Error', 'D', 'km/s'),
+               ('FWHM', 'D', 'km/s'),
+               ('Contrast', 'D', None),
+               ('Orders', '{n}D', 'km/s')]
+    columns = [name for name, format, unit in formats]
+    keywords = ('DETNAM', 'OBSMODE', 'ORDER1', 'NORDERS')
+    strip = ('File', 'Night', 'OBJECT')
+
+    def orders(self):
+        """
+        Orders of the Orders column, or None if the series is empty.
+        """
+        header = self.header()
+        if header is None:
+            return None
+        return header['ORDER1'] - np.arange(header['NORDERS'])
+
+    def append(self, rows, orders, header=None):
+        """
+        Adds rows (a dictionary of columns) to the series, the velocities of
+        orders laid out on the orders of the series.
+        """
+        velocities = np.asarray(rows['Orders'], dtype=np.float64)
+        series = self.orders()
+        if series is None:
+            series = np.arange(int(np.max(orders)), int(np.min(orders)) - 1,
+                               -1)
+            header = fits.Header() if header is None else header.copy()
+            header['ORDER1'] = int(series[0])
+            header['NORDERS'] = len(series)
+        laid = np.full((len(velocities), len(series)), np.nan)
+        index = int(series[0]) - np.asarray(orders)
+        inside = (index >= 0) & (index < len(series))
+        laid[:, index[inside]] = velocities[:, inside]
+        columns, theader = self._merge(dict(rows, Orders=laid), header)
+        self._write(columns, theader)
+
+
+# Mask and options of the workers, and their operators by layout.
+_mask = None
+_options = {}
+_operators = {}
+
+
+def _initialise(mask, options):
+    global _mask, _options
+    if isinstance(mask, (str, Path)):
+        mask = LineMask.read(mask)
+    _mask = mask
+    _options = dict(options)
+    _operators.clear()
+
+
+def _operator(orders):
+    key = layout_key(orders['Wavelength'], orders['Order'])
+    if key not in _operators:
+        _operators[key] = MaskOperator(orders['Wavelength'].values,
+                                       orders['Order'].values, _mask,
+                                       _options['velocities'],
+                                       width=_options.get('width'))
+    return _operators[key]
+
+
+def _measure(file, frames):
+    """
+    Rows (see RVSeries), orders and headers of frames of a file of
+    normalised orders, those with the same wavelengths measured together.
+    """
+    column = _options.get('column', 'Normalised')
+    groups = {}
+    for frame, orders, header in read_extractions(file, frames, header=True):
+        operator = _operator(orders)
+        snr = order_snr(orders)
+        weights = None
+        if snr is not None:
+            weights = np.array([snr.get(o, 0.) for o in operator.orders])
+        groups.setdefault(operator.key, []).append(
+            (frame, orders[column].values, weights, header))
+    results = []
+    with instrument.frame(Path(file).stem):
+        for key, group in groups.items():
+            operator = _operators[key]
+            ccf, continuum = operator(np.stack([flux for frame, flux, w, h
+                                                in group]))
+            ones = np.ones(len(operator.orders))
+            weights = np.stack([w if w is not None else ones
+                                for frame, flux, w, h in group])
+            combined = combine(ccf, continuum, weights)
+            # The combined CCFs and those of the orders are fitted together.
+            rv, fwhm, contrast = fit_ccf(
+                operator.velocities,
+                np.concatenate([combined[:, None], ccf], axis=1))
+            for k, (frame, flux, w, header) in enumerate(group):
+                orders = rv[k, 1:]
+                finite = np.isfinite(orders)
+                error = np.nan
+                if finite.sum() > 1:
+                    deviation = np.abs(orders[finite]
+                                       - np.median(orders[finite]))
+                    error = (1.4826 * np.median(deviation)
+                             / np.sqrt(finite.sum()))
+                results.append(({'File': frame,
+                                 'Night': Path(file).stem,
+                                 'OBJECT': str(header.get('OBJECT', '')),
+                                 'DATE-OBS': header.get('DATE-OBS', ''),
+                                 'TIME-OBS': header.get('TIME-OBS', ''),
+                                 'RV': rv[k, 0],
+                                 'Error': error,
+                                 'FWHM': fwhm[k, 0],
+                                 'Contrast': contrast[k, 0],
+                                 'Orders': orders},
+                                operator.orders, header))
+    return results
+
+
+def science_frames(directories, start=None, end=None):
+    """
+    Frames of the *_normalised.fits files of the directories by chip and
+    mode, sorted by time, from start to end ('YYYY-MM-DD', inclusive).
+    """
+    groups = {}
+    for directory in directories:
+        for file in sorted(Path(directory).glob('*_normalised.fits')):
+            with fits.open(str(file), memmap=True) as hdulist:
+                headers = [(hdu.name, hdu.header) for hdu in hdulist[1:]]
+            for frame, header in headers:
+                date = header.get('DATE-OBS', '')
+                if ((start is not None and date < start)
+                        or (end is not None and date > end)):
+                    continue
+                chip = 'HBDET' if frame.startswith('H') else 'HRDET'
+                mode = (header.get('OBSMODE') or 'UNKNOWN').split()[0]
+                groups.setdefault((chip, mode), []).append(
+                    (date, header.get('TIME-OBS', ''), file, frame))
+    return {key: [(f, frame) for date, time, f, frame in sorted(frames)]
+            for key, frames in groups.items()}
+
+
+class RadialVelocity(object):
+    """
+    Measures the radial velocities of the science frames of a chip and mode.
+
+    Parameters:
+    -----------
+    mask : LineMask, or its file.
+
+    store : file of the RVSeries.
+
+    velocities : velocities of the CCFs in km/s, or:
+
+    centre, span, step : grid of the velocities, in km/s.
+
+    width : width of the lines of the mask, in km/s.
+
+    column : column of the tables that is cross-correlated.
+
+    workers : number of processes. 0 measures the frames in this process.
+
+    batch : number of frames of a night a process measures at once.
+
+    Usage:
+    ------
+
+    rv = RadialVelocity('G2.mas', 'rv/rv_HRDET_HIGH.fits', workers=8)
+    rv.measure(science_frames(['reduced/20170412'])[('HRDET', 'HIGH')])
+    """
+    def __init__(self,
+                 mask,
+                 store,
+                 velocities=None,
+                 centre=0.,
+                 span=100.,
+                 step=None,
+                 width=None,
+                 column='Normalised',
+                 workers=0,
+                 batch=32):
+        self.mask = mask
+        self.series = RVSeries(store)
+        if velocities is None:
+            if step is None:
+                step = 0.5 * (width or 2.)
+            velocities = velocity_grid(centre, span, step)
+        self.options = {'velocities': np.asarray(velocities,
+                                                 dtype=np.float64),
+                        'width': width,
+                        'column': column}
+        self.workers = workers
+        self.batch = batch
+
+    def _measured(self, tasks):
+        return worker_map(_measure, zip(*tasks), _initialise,
+                          (self.mask, self.options), workers=self.workers)
+
+    def measure(self, frames):
+        """
+        Adds the (file, frame) pairs that are not in the series yet.
+        Returns the number of frames measured.
+        """
+        done = self.series.frames()
+        frames = [(Path(f), frame) for f, frame in frames
+                  if frame not in done]
+        if not frames:
+            return 0
+        nights = {}
+        for file, frame in frames:
+            nights.setdefault(file, []).append(frame)
+        tasks = [(file, names[k:k + self.batch])
+                 for file, names in nights.items()
+                 for k in range(0, len(names), self.batch)]
+        pending = {file: len(names) for file, names in nights.items()}
+        results = {file: [] for file in nights}
+        for (file, names), rows in zip(tasks, self._measured(tasks)):
+            results[file].extend(rows)
+            pending[file] -= len(names)
+            if not pending[file]:
+                self._add(results.pop(file))
+        return len(frames)
+
+    def _add(self, results):
+        # The frames of a night share their orders, unless pyhrs calibrated.
+        for orders in {tuple(o) for row, o, header in results}:
+            rows = [row for row, o, header in results if tuple(o) == orders]
+            header = [header for row, o, header in results
+                      if tuple(o) == orders][0]
+            columns = {c: [row[c] for row in rows]
+                       for c in RVSeries.columns if c != 'MJD'}
+            columns['MJD'] = mjd(columns['DATE-OBS'], columns['TIME-OBS'])
+            columns['Orders'] = np.stack(columns['Orders'])
+            self.series.append(columns, np.array(orders), header=header)
+        log.info('%d frames added to %s', len(results), self.series.file)
+
+
+def main(argv=None):
+    parser = command_line(
+        'Radial velocities of the HRS science frames',
+        datadir='Directories of the normalised files of hrs-night',
+        outdir='Directory of the time series (rv_{chip}_{mode}.fits)',
+        workers='Number of processes. 0 measures the frames in this process')
+    parser.add_argument('-m',
+                        '--mask',
+                        help='Line mask: wavelength and weight, or start, '
+                             'end and weight of each line',
+                        required=True)
+    parser.add_argument('--centre',
+                        type=float,
+                        default=0.,
+                        help='Centre of the velocities of the CCFs, in km/s')
+    parser.add_argument('--span',
+                        type=float,
+                        default=100.,
+                        help='Half width of the velocities, in km/s')
+    parser.add_argument('--step',
+                        type=float,
+                        default=None,
+                        help='Step of the velocities of the CCFs, in km/s')
+    parser.add_argument('--width',
+                        type=float,
+                        default=None,
+                        help='Width of the lines of the mask, in km/s')
+    args = parse_command_line(parser, argv)
+    mask = LineMask.read(args.mask)
+    groups = science_frames(args.datadir, start=args.start, end=args.end)
+    measured = {}
+    for (chip, mode), frames in sorted(groups.items()):
+        store = Path(args.outdir) / 'rv_{chip}_{mode}.fits'.format(
+            chip=chip, mode=mode)
+        rv = RadialVelocity(mask,
+                            store,
+                            centre=args.centre,
+                            span=args.span,
+                            step=args.step,
+                            width=args.width,
+                            workers=args.workers)
+        measured[(chip, mode)] = rv.measure(frames)
+        log.info('%s %s: %d new frames', chip, mode, measured[(chip, mode)])
+    return measured
+
+
+if __name__ == '__main__':
+    main()
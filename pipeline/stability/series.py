@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time series of measurements of frames kept in FITS files, and what the
+engines that measure them (hrs-drift, hrs-rv) share.
+"""
+
+# python imports
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import logging
+import os
+import tempfile
+
+# numpy imports
+import numpy as np
+
+# astropy imports
+from astropy.io import fits
+from astropy.time import Time
+
+# pandas imports
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+
+class TimeSeries(object):
+    """
+    Time series in a table of a FITS file, one row per frame, with at least
+    the File, DATE-OBS and TIME-OBS columns.
+
+    formats : (name, FITS format, unit) of the columns. '{n}' is the length
+              of the arrays of the column.
+
+    columns : names of the columns, in the order of formats.
+
+    keywords : keywords copied in the table from the first header.
+
+    strip : text columns whose trailing spaces are removed.
+    """
+    extension = None
+    formats = []
+    columns = []
+    keywords = ('DETNAM', 'OBSMODE')
+    strip = ('File',)
+
+    def __init__(self, file):
+        self.file = Path(file)
+
+    def exists(self):
+        return self.file.exists()
+
+    def header(self):
+        """
+        Header of the table, or None if the series is empty.
+        """
+        if not self.file.exists():
+            return None
+        with fits.open(str(self.file)) as hdulist:
+            return hdulist[self.extension].header.copy()
+
+    def frames(self):
+        """
+        Names of the frames of the series.
+        """
+        if not self.file.exists():
+            return set()
+        with fits.open(str(self.file)) as hdulist:
+            files = hdulist[self.extension].data['File']
+            return set(np.char.strip(files.astype(str)))
+
+    def read(self):
+        """
+        The series as a DataFrame, sorted by the time of the frames.
+        """
+        if not self.file.exists():
+            return pd.DataFrame(columns=self.columns)
+        with fits.open(str(self.file)) as hdulist:
+            table = hdulist[self.extension].data
+            # pandas wants the big-endian FITS columns in the native order.
+            columns = {c: table[c].astype(table[c].dtype.type)
+                       for c in self.columns}
+        series = pd.DataFrame({c: list(v) if v.ndim > 1 else v
+                               for c, v in columns.items()})
+        for c in self.strip:
+            series[c] = series[c].str.strip()
+        series.index = pd.to_datetime(series['DATE-OBS'] + 'T'
+                                      + series['TIME-OBS'])
+        series.index.name = 'Time'
+        return series.sort_index()
+
+    def _merge(self, rows, header=None):
+        """
+        Columns of the series with rows added (replacing the same frames),
+        and the header of its table.
+        """
+        if not self.file.exists():
+            theader = fits.Header()
+            for keyword in self.keywords:
+                if header is not None and keyword in header:
+                    theader[keyword] = header[keyword]
+            return {c: np.asarray(rows[c]) for c in self.columns}, theader
+        with fits.open(str(self.file)) as hdulist:
+            table = hdulist[self.extension].data
+            old = {c: np.array(table[c]) for c in self.columns}
+            theader = hdulist[self.extension].header.copy()
+        files = np.char.strip(old['File'].astype(str))
+        keep = ~np.isin(files, list(rows['File']))
+        return {c: np.concatenate([old[c][keep], np.asarray(rows[c])])
+                for c in self.columns}, theader
+
+    def _write(self, columns, header, *hdus):
+        """
+        Writes the table of columns, and hdus, through a temporary file.
+        """
+        table = fits.BinTableHDU.from_columns([
+            fits.Column(name=name,
+                        format=format.format(n=np.shape(columns[name])[-1]
+                                             if '{n}' in format else 0),
+                        unit=unit,
+                        array=columns[name])
+            for name, format, unit in self.formats],
+            header=header, name=self.extension)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(self.file.parent), suffix='.tmp')
+        os.close(fd)
+        hdulist = fits.HDUList([fits.PrimaryHDU(), table] + list(hdus))
+        hdulist.writeto(tmp, overwrite=True)
+        os.replace(tmp, str(self.file))
+
+
+def mjd(dates, times):
+    """
+    Modified julian dates of the DATE-OBS and TIME-OBS of frames.
+    """
+    return Time(['{d}T{t}'.format(d=d, t=t) for d, t in zip(dates, times)],
+                format='isot').mjd
+
+
+def interpolate_peak(left, centre, right):
+    """
+    Position of a peak relative to the centre sample, from a parabola on the
+    logarithm of the three samples (on the samples if one is not positive).
+    """
+    positive = (left > 0) & (centre > 0) & (right > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = [np.log(np.where(positive, v, 1.))
+                for v in (left, centre, right)]
+        gaussian = (0.5 * (logs[0] - logs[2])
+                    / (logs[0] - 2 * logs[1] + logs[2]))
+        parabola = 0.5 * (left - right) / (left - 2 * centre + right)
+    delta = np.where(positive, gaussian, parabola)
+    return np.where(np.isfinite(delta), np.clip(delta, -0.5, 0.5), 0.)
+
+
+def worker_map(function, iterables, initializer, initargs, workers=0,
+               chunksize=1):
+    """
+    Maps function over the iterables, in this process if workers is 0, or
+    in a pool of processes set up by initializer(*initargs).
+    """
+    if not workers:
+        initializer(*initargs)
+        yield from map(function, *iterables)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                             initargs=initargs) as pool:
+        yield from pool.map(function, *iterables, chunksize=chunksize)
+
+
+def command_line(description, datadir, outdir, workers):
+    """
+    Command line parser with the options the engines share. datadir, outdir
+    and workers are the help of their options.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-d',
+                        '--datadir',
+                        nargs='+',
+                        help=datadir,
+                        default=['.'])
+    parser.add_argument('-o',
+                        '--outdir',
+                        help=outdir,
+                        default='.')
+    parser.add_argument('--start', help='First date (YYYY-MM-DD)',
+                        default=None)
+    parser.add_argument('--end', help='Last date (YYYY-MM-DD)', default=None)
+    parser.add_argument('-w',
+                        '--workers',
+                        help=workers,
+                        type=int,
+                        default=os.cpu_count())
+    parser.add_argument('-l',
+                        '--log-level',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        default='INFO')
+    return parser
+
+
+def parse_command_line(parser, argv=None):
+    """
+    Parses the command line, and sets the logging up at the log level.
+    """
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.log_level),
+                        format='%(asctime)s %(processName)s %(name)s '
+                               '%(levelname)s %(message)s')
+    return args
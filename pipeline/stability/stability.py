@@ -6,11 +6,18 @@ import copy
 
 # python imports
 from pathlib import Path
-import argparse
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import logging
+import warnings
 
 # numpy imports
 import numpy as np
 
+# pipeline imports
+from pipeline.stability.index import FileIndex, default_database, read_header
+from pipeline.stability.instrument import instrument, timed
+
 # astropy imports
 from astropy.io import fits
 from astropy.stats import sigma_clip
@@ -22,8 +29,8 @@ from scipy.signal import savgol_filter
 from scipy.signal import find_peaks_cwt
 # Problems when the boundary order has some intense line, like order 65 and Hα.
 from scipy.signal import butter, filtfilt
-
-import numpy.ma as ma
+from scipy import sparse
+from scipy.interpolate import make_interp_spline
 
 from statsmodels.api import nonparametric
 
@@ -35,6 +42,8 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import matplotlib.colorbar as cb
 
+log = logging.getLogger(__name__)
+
 
 def getshape(orderinf, ordersup):
     """
@@ -57,146 +66,629 @@ def getshape(orderinf, ordersup):
     return ysh5
 
 
+@functools.lru_cache(maxsize=None)
+def _shape_filter():
+    return butter(10, 0.025)
+
+
+@functools.lru_cache(maxsize=8)
+def _shape_basis(length, degree=11):
+    """
+    Orthonormal basis Q of the polynomials of degree on length pixels: the
+    least squares fit of a stack of orders y is (y @ Q) @ Q.T. It is the QR
+    decomposition of a Legendre Vandermonde matrix, well conditioned.
+    """
+    x = np.linspace(-1, 1, length)
+    q, r = np.linalg.qr(np.polynomial.legendre.legvander(x, degree))
+    q.setflags(write=False)
+    return q
+
+
+def getshapes(orderinf, ordersup=None):
+    """
+    Batched getshape(): row k is getshape(orderinf[k], ordersup[k]). If
+    ordersup is None, orderinf is a stack of consecutive orders, and row k
+    is the shape of order k + 1, from its two neighbours.
+    """
+    orderinf = np.atleast_2d(np.asarray(orderinf, dtype=np.float64))
+    if ordersup is None:
+        orderinf, ordersup = orderinf[:-2], orderinf[2:]
+    b, a = _shape_filter()
+    shape = np.minimum(orderinf, np.atleast_2d(ordersup))
+    ysh2 = filtfilt(b, a, shape, axis=1)
+    q = _shape_basis(ysh2.shape[1])
+    ysh3 = (ysh2 @ q) @ q.T
+    ysh4 = np.minimum(ysh2, ysh3)
+    return (ysh4 @ q) @ q.T
+
+
+def fit_gaussians(data, centers, columns, halfwidth=25, niter=50):
+    """
+    Fits a gaussian on all the cuts data[centers - halfwidth:centers +
+    halfwidth, columns] at once, from Caruana's closed form, with a
+    Levenberg-Marquardt loop on the whole stack. Returns the amplitude, mean
+    and standard deviation (..., 3), NaN where the fit failed.
+    """
+    centers = np.asarray(centers, dtype=float)
+    shape = centers.shape
+    centers = centers.ravel()
+    columns = np.broadcast_to(columns, shape).ravel()
+    params = np.full((centers.size, 3), np.nan)
+    valid = (np.isfinite(centers) & (centers > 0)
+             & (centers - halfwidth >= 0)
+             & (centers + halfwidth <= data.shape[0]))
+    if not valid.any():
+        return params.reshape(shape + (3,))
+    a = centers[valid].astype(int)
+    y = (a[:, None] + np.arange(-halfwidth, halfwidth)[None, :]).astype(float)
+    cuts = np.asarray(data[y.astype(int), columns[valid, None]], dtype=float)
+    cuts /= cuts.max(axis=1)[:, None]
+
+    # Closed form initial guess, on the 7 pixels around the peak guess.
+    k = np.arange(halfwidth - 3, halfwidth + 4)
+    yp = y[:, k] - a[:, None]
+    zp = cuts[:, k]
+    w = np.clip(zp, 1e-6, None) ** 2
+    vander = np.stack([np.ones_like(yp), yp, yp ** 2], axis=-1)
+    lhs = np.einsum('mk,mki,mkj->mij', w, vander, vander)
+    rhs = np.einsum('mk,mki,mk->mi', w, vander,
+                    np.log(np.clip(zp, 1e-6, None)))
+    c = np.linalg.solve(lhs + 1e-12 * np.eye(3), rhs[:, :, None])[:, :, 0]
+    p = np.column_stack([np.ones_like(c[:, 0]), a.astype(float),
+                         np.full_like(c[:, 0], 5.)])
+    good = c[:, 2] < 0
+    var = -1 / (2 * c[good, 2])
+    p[good, 1] = a[good] + c[good, 1] * var
+    p[good, 2] = np.sqrt(var)
+    p[good, 0] = np.exp(c[good, 0] + c[good, 1] ** 2 * var / 2)
+    inwindow = np.abs(p[:, 1] - a) < halfwidth
+    p[~inwindow] = np.column_stack([np.ones_like(a), a,
+                                    np.full(a.shape, 5.)])[~inwindow]
+
+    def residuals(p):
+        g = np.exp(-0.5 * ((y - p[:, 1, None]) / p[:, 2, None]) ** 2)
+        return g, p[:, 0, None] * g - cuts
+
+    g, r = residuals(p)
+    cost = (r ** 2).sum(axis=1)
+    lam = np.full(a.shape, 1e-3)
+    for _ in range(niter):
+        u = (y - p[:, 1, None]) / p[:, 2, None]
+        jac = np.stack([g,
+                        p[:, 0, None] * g * u / p[:, 2, None],
+                        p[:, 0, None] * g * u ** 2 / p[:, 2, None]], axis=-1)
+        jtj = np.einsum('mki,mkj->mij', jac, jac)
+        jtr = np.einsum('mki,mk->mi', jac, r)
+        diag = np.einsum('mii->mi', jtj)
+        lhs = jtj + (lam[:, None] * diag + 1e-12)[:, :, None] * np.eye(3)
+        dp = -np.linalg.solve(lhs, jtr[:, :, None])[:, :, 0]
+        trial = p + dp
+        with np.errstate(all='ignore'):
+            gt, rt = residuals(trial)
+            trialcost = (rt ** 2).sum(axis=1)
+        better = np.isfinite(trialcost) & (trialcost < cost)
+        converged = better & ((cost - trialcost) <= 1e-10 * cost)
+        p[better], g[better] = trial[better], gt[better]
+        r[better], cost[better] = rt[better], trialcost[better]
+        lam = np.where(better, lam / 10, lam * 10)
+        if converged.all() or (lam > 1e10).all():
+            break
+    p[:, 2] = np.abs(p[:, 2])
+    failed = (~np.isfinite(p).all(axis=1)
+              | (np.abs(p[:, 1] - a) >= halfwidth) | (p[:, 2] == 0))
+    p[failed] = np.nan
+    params[valid] = p
+    return params.reshape(shape + (3,))
+
+
+def _cwt_peaks(column):
+    """
+    Continuous wavelet transform peak detection of a single column.
+    Older versions of scipy (< 0.19) output a list and not a numpy array.
+    """
+    return np.asarray(find_peaks_cwt(column, widths=np.arange(1, 20)),
+                      dtype=int)
+
+
+def local_maxima(filtered, data, distance=5, radius=20, snr=5.):
+    """
+    Peaks of every column of a smoothed 2D array at once: the maxima within
+    distance that rise snr times the noise of data above the lowest pixels
+    within radius. Returns a boolean array of the shape of filtered.
+    """
+    from scipy.ndimage import maximum_filter1d, minimum_filter1d
+    ismax = maximum_filter1d(filtered, 2 * distance + 1, axis=0,
+                             mode='nearest') == filtered
+    half = radius // 2
+    lowest = minimum_filter1d(filtered, 2 * half + 1, axis=0, mode='nearest')
+    left = np.concatenate([np.repeat(lowest[:1], half, axis=0),
+                           lowest[:-half]])
+    right = np.concatenate([lowest[half:],
+                            np.repeat(lowest[-1:], half, axis=0)])
+    prominence = filtered - np.maximum(left, right)
+    differences = np.diff(data, axis=0)
+    deviations = np.abs(differences - np.median(differences, axis=0))
+    noise = 1.4826 * np.median(deviations, axis=0) / np.sqrt(2)
+    return ismax & (prominence > snr * noise)
+
+
+def datasec(header):
+    """
+    Returns the limits X1, X2, Y1, Y2 of the DATASEC keyword ('[X1:X2,Y1:Y2]')
+    """
+    x, y = header['DATASEC'].strip('[] ').split(',')
+    return tuple(int(i) for i in x.split(':') + y.split(':'))
+
+
+def orient(data, chip, x1, x2):
+    """
+    Trims the overscan and orients the red and the blue frames the same
+    way, red is up and right. Only views of data are taken.
+    """
+    if chip == 'HRDET':
+        return data[:, x1-1:x2]
+    return data[::-1, x1-1:x2]
+
+
+class MappedFrame(object):
+    """
+    Memory-mapped and oriented data of a raw HRS file: frame[start:stop]
+    reads these rows only, as float64 with BSCALE and BZERO applied.
+    """
+    def __init__(self, hrsfile):
+        self.file = hrsfile
+        self.hdulist = fits.open(str(hrsfile), memmap=True,
+                                 do_not_scale_image_data=True)
+        self.header = self.hdulist[0].header
+        self.chip = self.header['DETNAM']
+        self.bscale = self.header.get('BSCALE', 1)
+        self.bzero = self.header.get('BZERO', 0)
+        x1, x2, y1, y2 = datasec(self.header)
+        self.raw = orient(self.hdulist[0].data, self.chip, x1, x2)
+        self.shape = self.raw.shape
+
+    def __getitem__(self, item):
+        block = np.array(self.raw[item], dtype=np.float64)
+        if self.bscale != 1:
+            block *= self.bscale
+        if self.bzero != 0:
+            block += self.bzero
+        return block
+
+    def close(self):
+        self.raw = None
+        self.hdulist.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def calibrate_rows(data, bias=None, flat=None, out=None, dtype=np.float32,
+                   rows=64, bscale=1, bzero=0):
+    """
+    Calibration kernel: (data * bscale + bzero - bias), clipped to zero,
+    divided by flat, in a single pass over blocks of rows, in place in out.
+
+    Parameters:
+    -----------
+    data : frame, any array whose rows can be sliced.
+
+    bias, flat : arrays of the shape of data, or numbers.
+
+    out : floating point buffer of the shape of data, data itself included.
+          A new array of type dtype if None.
+
+    Returns out.
+    """
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    elif out.shape != data.shape:
+        raise ValueError('The output buffer is {out}, the frame '
+                         '{frame}'.format(out=out.shape, frame=data.shape))
+    elif not np.issubdtype(out.dtype, np.floating):
+        raise ValueError('The output buffer must be a floating point array, '
+                         'not {dtype}'.format(dtype=out.dtype))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, data.shape[0], rows):
+            stop = min(start + rows, data.shape[0])
+            block = out[start:stop]
+            block[...] = data[start:stop]
+            if bscale != 1:
+                block *= bscale
+            if bzero != 0:
+                block += bzero
+            if bias is not None:
+                np.subtract(block, _rows(bias, start, stop), out=block)
+            np.maximum(block, 0, out=block)
+            if flat is not None:
+                np.true_divide(block, _rows(flat, start, stop), out=block)
+    return out
+
+
+@timed('calibrate')
+def calibrate_frame(frame, bias=None, flat=None, out=None, dtype=np.float32,
+                    rows=64):
+    """
+    Fused calibration of a raw HRS file or MappedFrame (see orient() and
+    calibrate_rows()), read from the memory-mapped file straight into out.
+    """
+    mapped = frame if isinstance(frame, MappedFrame) else MappedFrame(frame)
+    bias = bias.data if isinstance(bias, FITS) else bias
+    flat = flat.data if isinstance(flat, FITS) else flat
+    try:
+        return calibrate_rows(mapped.raw, bias, flat, out=out, dtype=dtype,
+                              rows=rows, bscale=mapped.bscale,
+                              bzero=mapped.bzero)
+    finally:
+        if mapped is not frame:
+            mapped.close()
+
+
+class NormalisedFrame(object):
+    """
+    Bias subtracted and exposure time normalised view of a frame:
+    (frame[start:stop] - bias[start:stop]) / exptime, computed on the fly.
+    """
+    def __init__(self, frame, bias=None, exptime=1.):
+        self.frame = frame
+        self.bias = bias
+        self.exptime = exptime
+        self.shape = frame.shape
+
+    def __getitem__(self, item):
+        block = np.array(self.frame[item], dtype=np.float64)
+        if self.bias is not None:
+            block -= self.bias[item]
+        block /= self.exptime
+        return block
+
+
+def _reduce(stack, method, sigma, iterations):
+    """
+    Combines a stack of blocks along the first axis.
+    """
+    if method == 'average':
+        return stack.mean(axis=0)
+    if method == 'median':
+        return np.median(stack, axis=0)
+    if method == 'sigmaclip':
+        # The rejected pixels are set to NaN, the stack is a scratch buffer.
+        for _ in range(iterations):
+            center = np.nanmedian(stack, axis=0)
+            deviation = np.nanstd(stack, axis=0)
+            rejected = np.abs(stack - center) > sigma * deviation
+            if not rejected.any():
+                break
+            stack[rejected] = np.nan
+        return np.nanmean(stack, axis=0)
+    raise ValueError('Unknown combination method {method}'.format(
+        method=method))
+
+
+def combine(frames, method='average', memory=256 * 1024 ** 2, sigma=3.,
+            iterations=5, dtype=np.float32):
+    """
+    Combines frames of the same shape (MappedFrame, or arrays) block of
+    rows by block of rows, one block of every frame in memory at a time.
+
+    Parameters:
+    -----------
+    frames : list of frames to combine.
+
+    method : 'average', 'median' or 'sigmaclip' (mean of the pixels within
+             sigma standard deviations of the median, iterated).
+
+    memory : approximate memory budget in bytes, of the stack of a block
+             and of the temporaries.
+
+    dtype : type of the combined frame.
+    """
+    nrows, ncols = frames[0].shape
+    rows = int(max(1, min(nrows, memory // (3 * len(frames) * ncols * 8))))
+    combined = np.empty((nrows, ncols), dtype=dtype)
+    stack = np.empty((len(frames), rows, ncols))
+    for start in range(0, nrows, rows):
+        stop = min(start + rows, nrows)
+        block = stack[:, :stop - start]
+        for i, frame in enumerate(frames):
+            block[i] = frame[start:stop]
+        combined[start:stop] = _reduce(block, method, sigma, iterations)
+    return combined
+
+
+def _rows(operand, start, stop):
+    """
+    Rows start:stop of an operand, a frame or something that broadcasts
+    against a block of rows.
+    """
+    if np.ndim(operand) == 2 and np.shape(operand)[0] > 1:
+        return operand[start:stop]
+    return operand
+
+
+def _blockwise(ufunc, data, operand, out, clip, rows=256):
+    """
+    out = ufunc(data, operand), clipped to zero if clip is True, computed
+    in float64 on blocks of rows. out can be data itself.
+    """
+    scratch = np.empty((min(rows, data.shape[0]),) + data.shape[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, data.shape[0], rows):
+            stop = min(start + rows, data.shape[0])
+            block = scratch[:stop - start]
+            ufunc(data[start:stop], _rows(operand, start, stop), out=block)
+            if clip:
+                np.maximum(block, 0, out=block)
+            out[start:stop] = block
+    return out
+
+
 class FITS(object):
+    """
+    Arithmetic on frames, on blocks of rows. The binary operators return a
+    new frame, the augmented assignments work in place, and add(),
+    subtract() and divide() take an output buffer (out=) and type (dtype=).
+    """
+
+    def _operand(self, other):
+        if isinstance(other, FITS):
+            return other.data
+        if isinstance(other, (int, float, np.integer, np.floating,
+                              np.ndarray)):
+            return other
+        return NotImplemented
+
+    def _apply(self, ufunc, other, out, dtype, clip):
+        operand = self._operand(other)
+        if operand is NotImplemented:
+            return NotImplemented
+        if out is None:
+            if dtype is None:
+                dtype = self.data.dtype
+            out = np.empty(self.data.shape, dtype=dtype)
+        if out is self.data:
+            new = self
+        else:
+            new = copy.copy(self)
+        new.data = _blockwise(ufunc, self.data, operand, out, clip)
+        return new
+
+    def _writable(self, dtype=None):
+        """
+        Data that can be modified in place, copied once if they are
+        read-only or of another type.
+        """
+        if dtype is None:
+            dtype = self.data.dtype
+        if not self.data.flags.writeable or self.data.dtype != dtype:
+            self.data = np.array(self.data, dtype=dtype)
+        return self.data
+
+    def add(self, other, out=None, dtype=None, clip=True):
+        """
+        Adds a frame or a number, in out or in a new array of type dtype.
+        Negative values are set to zero if clip is True.
+        """
+        return self._apply(np.add, other, out, dtype, clip)
+
+    def subtract(self, other, out=None, dtype=None, clip=True):
+        """
+        Substracts a frame or a number. See add() for the parameters.
+        """
+        return self._apply(np.subtract, other, out, dtype, clip)
+
+    def divide(self, other, out=None, dtype=None, clip=False):
+        """
+        Divides by a frame or a number. See add() for the parameters. The
+        default type is float32 for integer data, as for /=.
+        """
+        floating = np.issubdtype(self.data.dtype, np.floating)
+        if out is None and dtype is None and not floating:
+            dtype = np.float32
+        return self._apply(np.true_divide, other, out, dtype, clip)
+
+    @timed('calibrate')
+    def calibrate(self, bias=None, flat=None, out=None, dtype=np.float32,
+                  rows=64):
+        """
+        Fused calibration (see calibrate_rows()). Returns a new frame, whose
+        data are out if it is given.
+        """
+        bias = self._operand(bias) if bias is not None else None
+        flat = self._operand(flat) if flat is not None else None
+        out = calibrate_rows(self.data, bias, flat, out=out, dtype=dtype,
+                             rows=rows)
+        new = self if out is self.data else copy.copy(self)
+        new.data = out
+        return new
 
     def __add__(self, other):
         """
         Defining what it is to add two HRS objects
         """
-        new = copy.copy(self)
-        dt = new.data.dtype
-
-        if isinstance(other, HRS):
-            new.data = np.asarray(self.data + other.data, dtype=np.float64)
-        elif isinstance(other, np.int):
-            new.data = np.asarray(self.data + other, dtype=np.float64)
-        elif isinstance(other, np.float):
-            new.data = np.asarray(self.data + other, dtype=np.float64)
-        else:
-            return NotImplemented
-        (newdataminzs, new.datamaxzs) = ZScaleInterval().get_limits(new.data)
-        new.data[new.data <= 0] = 0
-        new.data = np.asarray(new.data, dtype=dt)
-        return new
+        return self.add(other)
 
     def __sub__(self, other):
         """
         Defining what substracting two HRS object is.
 
         """
-        new = copy.copy(self)
-        dt = new.data.dtype
-
-        if not isinstance(other, HRS):
-            if isinstance(other, np.int) or isinstance(other, np.float):
-                new.data = np.asarray(self.data, dtype=np.float64) - other
-                print('pas HRS', new.data.dtype, new.data.min(), new.data.max())
-            else:
-                return NotImplemented
-        else:
-            new.data = np.asarray(self.data, dtype=np.float64) - np.asarray(other.data, dtype=np.float64)
-# updating the datamin and datamax attributes after the substraction.
-        (new.dataminzs, new.datamaxzs) = ZScaleInterval().get_limits(new.data)
-        new.data[new.data <= 0] = 0
-        new.data = np.asarray(new.data, dtype=dt)
-
-        return new
+        return self.subtract(other)
 
     def __truediv__(self, other):
         """
         Define what it is to divide a HRS object
         """
-        new = copy.copy(self)
+        return self.divide(other)
 
-        if not isinstance(other, HRS):
-            if isinstance(other, np.int) or isinstance(other, np.float):
-                new.data = self.data / other
-            else:
-                return NotImplemented
-        else:
-            new.data = self.data / other.data
-# updating the datamin and datamax attributes after the substraction.
-        (new.dataminzs, new.datamaxzs) = ZScaleInterval().get_limits(new.data)
+    def __iadd__(self, other):
+        if self._operand(other) is NotImplemented:
+            return NotImplemented
+        return self.add(other, out=self._writable())
 
-        return new
+    def __isub__(self, other):
+        if self._operand(other) is NotImplemented:
+            return NotImplemented
+        return self.subtract(other, out=self._writable())
+
+    def __itruediv__(self, other):
+        if self._operand(other) is NotImplemented:
+            return NotImplemented
+        dtype = None
+        if not np.issubdtype(self.data.dtype, np.floating):
+            dtype = np.float32
+        return self.divide(other, out=self._writable(dtype))
 
 
 class Order(object):
     """
     Creates an object that defines the position of the orders.
+
+    Parameters:
+    -----------
+    hrs : HRS Flat-Field frame.
+
+    sigma : the limits of the orders are at sigma standard deviations of
+            their gaussian profile.
+
+    fit : 'astropy' (default) fits the orders one by one with astropy,
+          'batched' all at once (see fit_gaussians()), and order_fit holds
+          the parameters of the fits instead of the astropy models.
+
+    detection : 'cwt' (default) detects the orders with find_peaks_cwt(),
+                'fast' with local_maxima().
+
+    processes : number of processes of the 'cwt' detection. None (default)
+                runs it in this process.
+
+    step : the frame is sampled every step columns.
+
+    cache : Cache of the location of the orders, keyed by the flat and the
+            parameters above.
+
+    Output:
+    -------
+
+    .extracted : 3D numpy array with the lower limit, the center and the
+                 upper limit of the orders
+    .trace : TraceModel fitted on .extracted, the limits on any pixel.
     """
     def __init__(self,
                  hrs='',
-                 sigma=5.0):
+                 sigma=5.0,
+                 fit='astropy',
+                 detection='cwt',
+                 processes=None,
+                 step=50,
+                 cache=None):
         self.hrs = hrs
-        self.step = 50
+        self.step = step
         self.sigma = sigma
+        self.fit = fit
+        self.detection = detection
+        self.processes = processes
         self.spversion = sp.__version__
         self.got_flat = self.check_type(self.hrs)
-        self.orderguess = self.find_peaks(self.hrs)
-        self.order = self.identify_orders(self.orderguess)
-        self.extracted, self.order_fit = self.find_orders(self.order)
+        self.cachekey = None
+        product = None
+        name = Path(str(getattr(self.hrs, 'file', 'flat'))).name
+        with instrument.frame(name):
+            if cache is not None:
+                self.cachekey = cache.key(
+                    'order', files=[self.hrs.file], header=self.hrs.header,
+                    keywords=['DATASEC', 'OBSMODE', 'DETNAM'], step=step,
+                    sigma=sigma, fit=fit, detection=detection)
+                product = cache.get(self.cachekey)
+            if product is None:
+                self.orderguess = self.find_peaks(self.hrs)
+                self.order = self.identify_orders(self.orderguess)
+                self.extracted, self.order_fit = self.find_orders(self.order)
+                if cache is not None:
+                    cache.put(self.cachekey, (self.orderguess, self.order,
+                                              self.extracted, self.order_fit))
+            else:
+                (self.orderguess, self.order,
+                 self.extracted, self.order_fit) = product
+            with instrument.stage('trace'):
+                self.trace = TraceModel(self.extracted, self.step)
+        self._operators = {}
+
+    def operator(self, shape, mode='', fractional=True):
+        """
+        Sparse extraction operator of the frames of a shape and mode, built
+        once per flat.
+        """
+        key = (tuple(shape), xshift(mode), fractional)
+        if key not in self._operators:
+            self._operators[key] = ExtractionOperator.from_trace(
+                self.trace, shape, mode=mode, fractional=fractional)
+        return self._operators[key]
 
     def check_type(self, frame):
         if 'Flat field' not in frame.name:
             return False
         return True
 
+    @timed('find_peaks')
     def find_peaks(self, frame):
         """
         Identifies in a Flat-Field frame where the orders are located
         The procedure is as follows:
-        1 -
+        1 - the columns sampled every step pixels are smoothed at once,
+        2 - the faint pixels are masked,
+        3 - the peaks are detected with find_peaks_cwt() or local_maxima().
+        Returns the peaks of the columns (npeaks x ncolumns), padded with
+        zeros.
         """
-        print(self.spversion)
-        splitscipyversion = self.spversion.split('.')
-# To avoid weird detection, we set any value below zero to zero.
-        data = frame.data.copy()
+        log.debug('scipy %s', self.spversion)
         if not self.got_flat:
-            print("Not a flat, can't determine the position of the orders")
+            log.warning("Not a flat, can't determine the position of the "
+                        "orders")
             return None
+        if 'LOW' in frame.mode:
+            window = 31
+            polyorder = 5
+            f = 15
         else:
-            pixelstart = self.step
-            pixelstop = frame.data.shape[1]
-            # step = 20
-            xb = np.arange(pixelstart, pixelstop, self.step)
-            temp = []
-            for pixel in xb:
-                if 'LOW' in frame.mode:
-                    window = 31
-                    polyorder = 5
-                    f = 15
-                else:
-                    window = 37
-                    polyorder = 3
-                    f = 1
-                test = data[:, pixel]
-                b, c = np.histogram(np.abs(test))
-                mask = test < c[1]/f
-                t = ma.array(test, mask=mask)
-                if pixel > frame.xpix:
-                    print(pixel)
-                    break
-                filtereddata = savgol_filter(t, window, polyorder)
-                xp = find_peaks_cwt(filtereddata, widths=np.arange(1, 20))
-# TODO : Older version of scipy output a list and not a numpy array. Test it. Change occurred in version 0.19
-                if splitscipyversion[0] == '0' and np.int(splitscipyversion[1]) < 19:
-                    xp = np.array(xp)
-# We now extract the valid entries from the peaks_cwt()
-                x = xp[~t[xp].mask].copy()
-                # print(pixel, x)
-                temp.append(x)
-            print('-----')
-            # print(temp)0
-            # Storing the location of the peaks in a numpy array
-            size = max([len(i) for i in temp])
-            peaks = np.ones((size, len(temp)), dtype=np.int)
-            for index in range(len(temp)):
-                temp[index].resize(size, refcheck=False)
-                peaks[:, index] = temp[index]
-
-            return peaks
-
+            window = 37
+            polyorder = 3
+            f = 1
+        xb = np.arange(self.step, frame.data.shape[1], self.step)
+        xb = xb[xb <= frame.xpix]
+        columns = np.asarray(frame.data[:, xb], dtype=np.float64)
+        # c[1] of np.histogram(), the upper edge of the first of 10 bins.
+        amplitude = np.abs(columns)
+        low, high = amplitude.min(axis=0), amplitude.max(axis=0)
+        c1 = low + (high - low) / 10
+        mask = columns < c1 / f
+        filtereddata = savgol_filter(columns, window, polyorder, axis=0)
+        if self.detection == 'fast':
+            detected = local_maxima(filtereddata, columns) & ~mask
+        else:
+            detected = np.zeros_like(mask)
+            if self.processes:
+                with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                    chunksize = max(1, len(xb) // self.processes)
+                    xps = list(pool.map(_cwt_peaks, filtereddata.T,
+                                        chunksize=chunksize))
+            else:
+                xps = [_cwt_peaks(column) for column in filtereddata.T]
+            for index, xp in enumerate(xps):
+                # We now extract the valid entries from the peaks_cwt()
+                detected[xp[~mask[xp, index]], index] = True
+        # The location of the peaks, padded with zeros.
+        count = detected.sum(axis=0)
+        peaks = np.zeros((max(count.max(), 1), len(xb)), dtype=int)
+        index, pixel = np.nonzero(detected.T)
+        rank = np.arange(len(pixel)) - np.repeat(np.cumsum(count) - count,
+                                                 count)
+        peaks[rank, index] = pixel
+        return peaks
+
+    @timed('identify_orders')
     def identify_orders(self, pts):
         """
         This function extracts the real location of the orders
@@ -207,25 +699,19 @@ class Order(object):
         o = np.zeros_like(pts)
         # Detection of the first order shifts.
         p = np.where((pts[2, 1:] - pts[2, :-1]) > 10)[0]
-        print('changement à', p, len(p))
+        log.debug('changement à %s %s', p, len(p))
 # The indices will allow us to know when to switch row in order to follow the orders.
 # The first one has to be zero and the last one the size of the orders.
 # This is so that the automatic procedure picks them properly
         indices = [0] + list(p+1) + [pts.shape[1]]
-        print('\nindices : ', indices)
-        for i in range(pts.shape[0]):
-            # The orders come in three section, so we coalesce them
-            print('indice', i)
-            ind = np.arange(i, i - (len(p) + 1), -1) + 1
-            ind[np.where(ind <= 0)] = 0
-            a = ind > 0
-            a = a * 1
-            for j in range(len(a)):
-                # TODO FIXER CETTE PARTIE LA QUI NE MARCHE PAS ET QUI FOUT LE BORDEL
-                # LE COLLAGE DES ORDRES N'EST PAS CORRECT.
-
-                arr1 = pts[i - j, indices[j]:indices[j + 1]] * a[j]
-                o[i, indices[j]:indices[j + 1]] = arr1
+        log.debug('indices : %s', indices)
+        # The orders come in sections: in section j, order i is on row i - j.
+        # TODO FIXER CETTE PARTIE LA QUI NE MARCHE PAS ET QUI FOUT LE BORDEL
+        # LE COLLAGE DES ORDRES N'EST PAS CORRECT.
+        # The TraceModel smooths the wrong joins out, but does not fix them.
+        for j in range(min(len(indices) - 1, pts.shape[0])):
+            section = slice(indices[j], indices[j + 1])
+            o[j:, section] = pts[:pts.shape[0] - j, section]
         return o
 
     def _gaussian_fit(self, a, k):
@@ -253,10 +739,19 @@ class Order(object):
         except AttributeError:
             return(np.nan, np.nan, np.nan)
 
+    @timed('find_orders')
     def find_orders(self, op):
         """ Computes the location of the orders
         Returns a 3D numpy array
         """
+        if self.fit == 'batched':
+            columns = self.step * (np.arange(op.shape[1]) + 1)
+            fit = fit_gaussians(self.hrs.data, op, columns[None, :])
+            positions = np.stack([fit[..., 1] - self.sigma * fit[..., 2],
+                                  fit[..., 1],
+                                  fit[..., 1] + self.sigma * fit[..., 2]],
+                                 axis=-1)
+            return positions, fit
         vgf = np.vectorize(self._gaussian_fit)
         vadd = np.vectorize(self._add_gaussian)
         fit = np.zeros_like(op, dtype=object)
@@ -268,41 +763,161 @@ class Order(object):
         return positions, fit
 
 
+def pyramid(data, size=1024):
+    """
+    Image pyramid of a frame, for display: each level is the mean of the
+    2x2 blocks of the previous one, down to sides of at most size pixels.
+    """
+    levels = [data]
+    while max(levels[-1].shape) > size and min(levels[-1].shape) >= 2:
+        image = levels[-1]
+        rows, columns = image.shape[0] // 2, image.shape[1] // 2
+        blocks = np.asarray(image[:2 * rows, :2 * columns], dtype=np.float32)
+        blocks = blocks.reshape(rows, 2, columns, 2)
+        levels.append(blocks.mean(axis=(1, 3)))
+    return levels
+
+
+def decimate(y, width):
+    """
+    Reduces the line y to the minimum and the maximum of width bins, for a
+    plot width pixels wide. Returns the centres of the bins and the values.
+    """
+    y = np.asarray(y)
+    width = max(int(width), 1)
+    if len(y) <= 2 * width:
+        return np.arange(len(y)), y
+    edges = np.linspace(0, len(y), width + 1).astype(int)
+    values = np.empty(2 * width, dtype=np.result_type(y.dtype, np.float32))
+    values[0::2] = np.fmin.reduceat(y, edges[:-1])
+    values[1::2] = np.fmax.reduceat(y, edges[:-1])
+    return np.repeat((edges[:-1] + edges[1:] - 1) / 2, 2), values
+
+
+# Parameters of the chips, by DETNAM: the first order is OrderShift + 1.
+CHIP_PARAMETERS = {'HBDET': {'OrderShift': 83,
+                             'XPix': 2048,
+                             'BiasLevel': 690},
+                   'HRDET': {'OrderShift': 52,
+                             'XPix': 4096,
+                             'BiasLevel': 920}}
+
+
 class HRS(FITS):
     """
     Class that allows to set the parameters of each files
     the data attribute is such that all frames have the same orientation
+
+    Only the header is read (or given, from the FileIndex) on creation. The
+    data are memory-mapped when first used, and the statistics computed on
+    a subsample. Use it as a context manager, or call close().
     """
+    # Approximate number of pixels used to compute the statistics of the frame.
+    samplesize = 2 ** 18
+
     def __init__(self,
-                 hrsfile=''):
+                 hrsfile='',
+                 header=None):
         self.file = hrsfile
-        self.hdulist = fits.open(self.file)
-        self.header = self.hdulist[0].header
-        self.dataX1 = int(self.header['DATASEC'][1:8].split(':')[0])
-        self.dataX2 = int(self.header['DATASEC'][1:8].split(':')[1])
-        self.dataY1 = int(self.header['DATASEC'][9:15].split(':')[0])
-        self.dataY2 = int(self.header['DATASEC'][9:15].split(':')[1])
+        self.header = header if header is not None else read_header(self.file)
+        self._hdulist = None
+        self._data = None
+        self._mapped = False
+        self._statistics = {}
+        (self.dataX1, self.dataX2,
+         self.dataY1, self.dataY2) = datasec(self.header)
         self.mode = self.header['OBSMODE']
         self.type = self.header['OBSTYPE']
         self.name = self.header['OBJECT']
         self.chip = self.header['DETNAM']
-        self.data = self.prepare_data(self.file)
-        self.shape = self.data.shape
-        (self.dataminzs, self.datamaxzs) = ZScaleInterval().get_limits(self.data)
-        parameters = {'HBDET': {'OrderShift': 83,
-                                'XPix': 2048,
-                                'BiasLevel': 690},
-                      'HRDET': {'OrderShift': 52,
-                                'XPix': 4096,
-                                'BiasLevel': 920}}
-        self.biaslevel = parameters[self.chip]['BiasLevel']
-        self.ordershift = parameters[self.chip]['OrderShift']
-        self.xpix = parameters[self.chip]['XPix']
-        self.mean = self.data.mean()
-        self.std = self.data.std()
-        self.counter = 0
+        self.shape = (self.header['NAXIS2'], self.dataX2 - self.dataX1 + 1)
+        self.biaslevel = CHIP_PARAMETERS[self.chip]['BiasLevel']
+        self.ordershift = CHIP_PARAMETERS[self.chip]['OrderShift']
+        self.xpix = CHIP_PARAMETERS[self.chip]['XPix']
         self._zoom1 = 100
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Closes the file. Unmodified data are mapped again when used.
+        """
+        if self._mapped:
+            self._data = None
+            self._mapped = False
+        if self._hdulist is not None:
+            self._hdulist.close()
+            self._hdulist = None
+
+    def __getstate__(self):
+        # The memory-mapped file is mapped again in the other process.
+        state = self.__dict__.copy()
+        state['_hdulist'] = None
+        if self._mapped:
+            state['_data'] = None
+            state['_mapped'] = False
+        return state
+
+    @property
+    def hdulist(self):
+        if self._hdulist is None:
+            # astropy memory-maps the data, unless they have to be scaled
+            # (BZERO/BSCALE), in which case only the scaled copy is made.
+            self._hdulist = fits.open(str(self.file))
+        return self._hdulist
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.prepare_data(self.file)
+            self._mapped = True
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._mapped = False
+        self._statistics = {}
+
+    def _statistic(self, name):
+        if name not in self._statistics:
+            stride = max(1, int(np.sqrt(self.data.size / self.samplesize)))
+            sample = np.asarray(self.data[::stride, ::stride])
+            limits = ZScaleInterval().get_limits(sample)
+            self._statistics['dataminzs'] = limits[0]
+            self._statistics['datamaxzs'] = limits[1]
+            self._statistics['mean'] = sample.mean()
+            self._statistics['std'] = sample.std()
+        return self._statistics[name]
+
+    @property
+    def dataminzs(self):
+        return self._statistic('dataminzs')
+
+    @dataminzs.setter
+    def dataminzs(self, value):
+        self._statistics['dataminzs'] = value
+
+    @property
+    def datamaxzs(self):
+        return self._statistic('datamaxzs')
+
+    @datamaxzs.setter
+    def datamaxzs(self, value):
+        self._statistics['datamaxzs'] = value
+
+    @property
+    def mean(self):
+        return self._statistic('mean')
+
+    @property
+    def std(self):
+        return self._statistic('std')
+
     def __repr__(self):
         color = 'blue'
         if 'HR' in self.chip:
@@ -315,67 +930,132 @@ class HRS(FITS):
             mode=self.mode)
         return description
 
+    def calibrate(self, bias=None, flat=None, out=None, dtype=np.float32,
+                  rows=64):
+        """
+        Same as FITS.calibrate(), straight from the file if the data have
+        not been read yet (see calibrate_frame()).
+        """
+        if self._data is not None:
+            return FITS.calibrate(self, bias, flat, out=out, dtype=dtype,
+                                  rows=rows)
+        new = copy.copy(self)
+        new._hdulist = None
+        new.data = calibrate_frame(self.file, bias, flat, out=out, dtype=dtype,
+                                   rows=rows)
+        return new
+
+    @timed('read')
     def prepare_data(self, hrsfile):
         """
         This method sets the orientation of both the red and the blue files to be the same, which is red is up and right
+        The result is a view of the memory-mapped data of the file.
         """
-        d = self.hdulist[0].data
-        if self.chip == 'HRDET':
-            d = d[:, self.dataX1-1:self.dataX2]
-        else:
-            d = d[::-1, self.dataX1-1:self.dataX2]
-#
-        return d
+        return orient(self.hdulist[0].data, self.chip, self.dataX1,
+                      self.dataX2)
 
-    def _zoom(self, event):
-        self.counter += 1
-        if self.counter % 4:  # Limiting the frequency of the update to every 4 moves.
+    def _window(self, x, y):
+        """
+        Part of the frame around the pixel (x, y), padded with NaN.
+        """
+        zoom = self._zoom1
+        x, y = int(round(x)), int(round(y))
+        window = np.full((2 * zoom, 2 * zoom), np.nan, dtype=np.float32)
+        rows = slice(max(y - zoom, 0), min(y + zoom, self.data.shape[0]))
+        columns = slice(max(x - zoom, 0), min(x + zoom, self.data.shape[1]))
+        if rows.start < rows.stop and columns.start < columns.stop:
+            inside = (slice(rows.start - y + zoom, rows.stop - y + zoom),
+                      slice(columns.start - x + zoom,
+                            columns.stop - x + zoom))
+            window[inside] = self.data[rows, columns]
+        return window
+
+    def _level(self, ax):
+        """
+        Shows the coarsest level of the pyramid that still has a pixel of
+        the frame per pixel of the screen, within the limits of the panel.
+        """
+        if self._levelling:
             return
-        if event.inaxes is self.ax1:
-                # Mouse is in subplot 1.
-            xinf2 = np.int(event.xdata - self._zoom1)
-            xsup2 = np.int(event.xdata + self._zoom1)
-            yinf2 = np.int(event.ydata - self._zoom1)
-            ysup2 = np.int(event.ydata + self._zoom1)
-            ax2data = self.data[yinf2:ysup2, xinf2:xsup2]
-            self.plot2.set_data(ax2data)
-            self.ax2.figure.canvas.draw()
-            self.fig.canvas.blit(self.ax2.bbox)
-        self.counter = 0
+        (x0, x1), (y0, y1) = sorted(ax.get_xlim()), sorted(ax.get_ylim())
+        factor = max((x1 - x0) / max(ax.bbox.width, 1),
+                     (y1 - y0) / max(ax.bbox.height, 1))
+        level = int(np.clip(np.floor(np.log2(max(factor, 1))), 0,
+                            len(self.levels) - 1))
+        scale = 2 ** level
+        image = self.levels[level]
+        r0 = max(int(np.floor((y0 + 0.5) / scale)), 0)
+        r1 = min(int(np.ceil((y1 + 0.5) / scale)), image.shape[0])
+        c0 = max(int(np.floor((x0 + 0.5) / scale)), 0)
+        c1 = min(int(np.ceil((x1 + 0.5) / scale)), image.shape[1])
+        if r0 >= r1 or c0 >= c1:
+            return
+        self._levelling = True
+        try:
+            self.plot1.set_data(image[r0:r1, c0:c1])
+            self.plot1.set_extent((c0 * scale - 0.5, c1 * scale - 0.5,
+                                   r1 * scale - 0.5, r0 * scale - 0.5))
+        finally:
+            self._levelling = False
+
+    def _background(self, event):
+        # The figure without the animated artists is kept after a redraw.
+        self._saved = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in (self.plot2, self.cut3, self.cut4):
+            artist.axes.draw_artist(artist)
+
+    def _update(self, *axes):
+        """
+        Draws the animated artists again on the saved background, and blits
+        the panels in axes.
+        """
+        canvas = self.fig.canvas
+        if not canvas.supports_blit or self._saved is None:
+            canvas.draw_idle()
+            return
+        canvas.restore_region(self._saved)
+        for artist in (self.plot2, self.cut3, self.cut4):
+            artist.axes.draw_artist(artist)
+        for ax in axes:
+            canvas.blit(ax.bbox)
+
+    def _zoom(self, event):
+        if event.inaxes is self.ax1 and event.xdata is not None:
+            # Mouse is in subplot 1.
+            self.plot2.set_data(self._window(event.xdata, event.ydata))
+            self._update(self.ax2)
+
+    def _cut(self, ax, line, cut):
+        x, y = decimate(cut, ax.bbox.width)
+        line.set_data(x, y)
+        low, high = np.nanmin(y), np.nanmax(y)
+        bottom, top = ax.get_ylim()
+        if low < bottom or high > top or high - low < 0.25 * (top - bottom):
+            # The ticks change, so the whole figure is drawn again.
+            margin = 0.05 * (high - low) or 1
+            ax.set_ylim(low - margin, high + margin)
+            self.fig.canvas.draw_idle()
+        else:
+            self._update(self.ax3, self.ax4)
 
     def _plot(self, event):
-        if event.inaxes is self.ax1:
-            ax3ydata = self.data[:, np.int(event.xdata)]
-            ax3xdata = self.data[np.int(event.ydata), :]
+        if event.inaxes is self.ax1 and event.xdata is not None:
+            column = int(np.clip(round(event.xdata), 0,
+                                 self.data.shape[1] - 1))
+            row = int(np.clip(round(event.ydata), 0, self.data.shape[0] - 1))
             if event.button == 1:  # Left button
-                self.ax3.cla()
-                self.ax3.yaxis.tick_left()
-                self.ax3.set_xlabel('Pixel', color=self.ax3.color)
-                self.ax3.set_ylabel('Intensity', color=self.ax3.color)
-                self.ax3.xaxis.set_label_position('bottom')
-                self.ax3.yaxis.set_label_position('left')
-                self.ax3.tick_params(axis='y', colors=self.ax3.color)
-                self.ax3.plot(ax3ydata, color=self.ax3.color)
-                self.ax3.figure.canvas.draw()
+                self._cut(self.ax3, self.cut3, self.data[:, column])
             elif event.button == 3:  # Right button
-                self.ax4.cla()
-                self.ax4.xaxis.tick_top()
-                self.ax4.yaxis.tick_right()
-                self.ax4.set_xlabel('Pixel', color=self.ax4.color)
-                self.ax4.set_ylabel('Intensity', color=self.ax4.color)
-                self.ax4.xaxis.set_label_position('top')
-                self.ax4.yaxis.set_label_position('right')
-                self.ax4.tick_params(axis='y', colors=self.ax4.color)
-                self.ax4.plot(ax3xdata, color=self.ax4.color)
-                self.ax4.figure.canvas.draw()
-
-    def plot(self, fig=None):
+                self._cut(self.ax4, self.cut4, self.data[row, :])
+
+    def plot(self, fig=None, size=1024):
         """
         Creates a matplotlib window to display the frame
-        Adds a small window which is a zoom on where the cursor is
+        Adds a small window which is a zoom on where the cursor is, and cuts
+        along the column (left click) and the row (right click) of the cursor.
+        The main panel shows a pyramid of the frame (see pyramid()), and the
+        zoom and the cuts are blitted.
         """
-        # Peut-être faire une classe Plot() qui se chargera de tout, et faire que plot() appelle Plot().
-        # https://matplotlib.org/examples/animation/subplots.html
         # Defining the grid on which the plot will be shown
         grid = gridspec.GridSpec(6, 2)
         if fig is None:
@@ -396,18 +1076,24 @@ class HRS(FITS):
         ax3.color = 'xkcd:cerulean'
         ax4 = self.ax4
         ax4.color = 'xkcd:tangerine'
-        data = self.data
-        zoom = self._zoom1
+        rows, columns = self.data.shape
+        self.levels = pyramid(self.data, size=size)
+        self._levelling = False
+        self._saved = None
 
         # Adding the plots
-        self.plot1 = ax1.imshow(data, vmin=self.dataminzs, vmax=self.datamaxzs)
+        coarsest = self.levels[-1]
+        scale = 2 ** (len(self.levels) - 1)
+        extent = (-0.5, coarsest.shape[1] * scale - 0.5,
+                  coarsest.shape[0] * scale - 0.5, -0.5)
+        self.plot1 = ax1.imshow(coarsest, vmin=self.dataminzs,
+                                vmax=self.datamaxzs, extent=extent)
+        ax1.set_autoscale_on(False)
         ax1.title.set_text('CCD')
         cb.Colorbar(ax=cbax1, mappable=self.plot1, orientation='horizontal', ticklocation='bottom')
-        zoomeddata = self.data[
-            np.int(self.data.shape[0]//2)-zoom:np.int(self.data.shape[0]//2)+zoom,
-            np.int(self.data.shape[1]//2)-zoom:np.int(self.data.shape[1]//2)+zoom
-            ]
-        self.plot2 = ax2.imshow(zoomeddata, vmin=self.dataminzs, vmax=self.datamaxzs)
+        self.plot2 = ax2.imshow(self._window(columns // 2, rows // 2),
+                                vmin=self.dataminzs, vmax=self.datamaxzs,
+                                animated=True)
         # We need to tidy the bottom right plot a little bit first
         # Ax3 first
         self.ax3.tick_params(axis='x', colors=ax3.color)
@@ -428,13 +1114,68 @@ class HRS(FITS):
         self.ax4.xaxis.set_label_position('top')
         self.ax4.yaxis.set_label_position('right')
 
-        self.ax3.plot(self.data[:, np.int(self.data.shape[1]/2)], color=ax3.color)
-        self.ax4.plot(self.data[np.int(self.data.shape[0]/2), :], color=ax4.color)
-        ax1.figure.canvas.mpl_connect('motion_notify_event', self._zoom)
-        ax1.figure.canvas.mpl_connect('button_press_event', self._plot)
+        self.cut3, = self.ax3.plot([], [], color=ax3.color, animated=True)
+        self.cut4, = self.ax4.plot([], [], color=ax4.color, animated=True)
+        self.ax3.set_xlim(0, rows - 1)
+        self.ax4.set_xlim(0, columns - 1)
+        self.ax3.set_ylim(self.dataminzs, self.datamaxzs)
+        self.ax4.set_ylim(self.dataminzs, self.datamaxzs)
+        self._cut(self.ax3, self.cut3, self.data[:, columns // 2])
+        self._cut(self.ax4, self.cut4, self.data[rows // 2, :])
+        ax1.callbacks.connect('xlim_changed', self._level)
+        ax1.callbacks.connect('ylim_changed', self._level)
+        fig.canvas.mpl_connect('draw_event', self._background)
+        fig.canvas.mpl_connect('motion_notify_event', self._zoom)
+        fig.canvas.mpl_connect('button_press_event', self._plot)
         plt.show()
 
 
+def raw_layout(data, frame):
+    """
+    data, oriented like HRS.data, in the layout of the raw MappedFrame
+    frame (the inverse of orient()).
+    """
+    raw = np.zeros(frame.hdulist[0].data.shape, dtype=np.float32)
+    x1, x2, y1, y2 = datasec(frame.header)
+    orient(raw, frame.chip, x1, x2)[:] = data
+    return raw
+
+
+def master_bias(files, method='average', memory=256 * 1024 ** 2):
+    """
+    Combines the biases of a chip (see combine()). Returns the master bias,
+    in the layout of the raw frames, and the header of the last bias.
+    """
+    frames = [MappedFrame(b) for b in files]
+    header = frames[-1].header.copy()
+    for keyword in ('BZERO', 'BSCALE'):
+        header.remove(keyword, ignore_missing=True)
+    raw = raw_layout(combine(frames, method=method, memory=memory), frames[-1])
+    for frame in frames:
+        frame.close()
+    return raw, header
+
+
+def master_flat(files, masterbias=None, method='median',
+                memory=256 * 1024 ** 2):
+    """
+    Combines the flats of a chip and mode, bias subtracted and normalised
+    by their exposure time. Returns the master flat, in the layout of the
+    raw frames, and the header of the last flat.
+    """
+    frames = [MappedFrame(f) for f in files]
+    flats = [NormalisedFrame(frame, masterbias,
+                             frame.header.get('EXPTIME', 1.))
+             for frame in frames]
+    header = frames[-1].header.copy()
+    for keyword in ('BZERO', 'BSCALE'):
+        header.remove(keyword, ignore_missing=True)
+    raw = raw_layout(combine(flats, method=method, memory=memory), frames[-1])
+    for frame in frames:
+        frame.close()
+    return raw, header
+
+
 class Master(object):
     """
 
@@ -447,126 +1188,545 @@ class Master(object):
     flat : orders
     """
 
-    def makemasterbias(lof):
-        blue = []
-        red = []
+    @timed('masterbias')
+    def makemasterbias(lof, cache=None, method='average',
+                       memory=256 * 1024 ** 2):
+        """
+        Combines the biases of each chip block by block (see combine()), and
+        writes the master biases in lof.path, in the layout of the raw
+        frames. A chip without biases has no master bias.
+        method is 'average' (default), 'median' or 'sigmaclip'.
+        With a Cache, the master biases are kept in it.
+        """
+        files = {'HBDET': [], 'HRDET': []}
         for b in lof.bias:
             if b.name.startswith('H'):
-                blue.append(HRS(b).data)
-                blueheader = HRS(b).header
+                files['HBDET'].append(b)
             elif b.name.startswith('R'):
-                red.append(HRS(b).data)
-                redheader = HRS(b).header
-            else:
+                files['HRDET'].append(b)
+        masters = {}
+        for chip in files:
+            if not files[chip]:
+                log.warning('No bias for %s, its master bias is not made',
+                            chip)
                 continue
-        bshape = list(blue[0].shape)
-        bshape[:0] = [len(blue)]
-        ba = np.concatenate(blue).reshape(bshape)
-        mbdata = np.int16(np.average(ba, axis=0))
-        mbfile = b.parent/'bluemasterbias.fits'
-        rshape = list(red[0].shape)
-        rshape[:0] = [len(red)]
-        ra = np.concatenate(red).reshape(rshape)
-        mrdata = np.int16(np.average(ra, axis=0))
-        mrfile = b.parent/'redmasterbias.fits'
-
-        try:
-            fits.writeto(mbfile, mbdata, blueheader, overwrite=True)
-            fits.writeto(mrfile, mrdata, redheader, overwrite=True)
-        except FileNotFoundError:
-            fits.writeto(mrfile, mrdata, redheader, overwrite=False)
-            fits.writeto(mbfile, mbdata, blueheader, overwrite=False)
-        ListOfFiles.update(lof, mbfile)
-        ListOfFiles.update(lof, mrfile)
-
-    def makemasterflat(lof):
-        blue = []
-        red = []
+            key = None
+            if cache is not None:
+                key = cache.key('masterbias', files=files[chip], chip=chip,
+                                method=method, layout='raw')
+            product = cache.get(key) if cache is not None else None
+            if product is None:
+                product = master_bias(files[chip], method=method,
+                                      memory=memory)
+                if cache is not None:
+                    cache.put(key, product)
+            masters[chip] = product
+        for chip, (data, header) in masters.items():
+            color = 'blue' if chip == 'HBDET' else 'red'
+            mfile = lof.path/'{color}masterbias.fits'.format(color=color)
+            fits.writeto(mfile, data, header, overwrite=True)
+            ListOfFiles.update(lof, mfile)
+
+    @timed('masterflat')
+    def makemasterflat(lof, cache=None, method='median',
+                       memory=256 * 1024 ** 2):
+        """
+        Combines the flats of each chip and mode block by block:
+            masterflat = median( (flat_i - masterbias)/exptime_i )
+        and writes them in the layout of the raw frames, as
+        bluemasterflat_MODE.fits and redmasterflat_MODE.fits.
+        """
+        groups = {}
         for b in lof.flat:
-            if b.name.startswith('H'):
-                blue.append(b.parent/b.name)
-            if b.name.startswith('R'):
-                red.append(b.parent/b.name)
-            else:
+            if not (b.name.startswith('H') or b.name.startswith('R')):
                 continue
-        t = []
+            record = lof.index.record(b)
+            chip = 'HBDET' if b.name.startswith('H') else 'HRDET'
+            mode = 'UNKNOWN'
+            if record is not None and record['OBSMODE']:
+                mode = record['OBSMODE']
+            mode = mode.split()[0]
+            groups.setdefault((chip, mode), []).append(b)
+        for (chip, mode), files in sorted(groups.items()):
+            color = 'blue' if chip == 'HBDET' else 'red'
+            mbfile = lof.path/'{color}masterbias.fits'.format(color=color)
+            if not mbfile.exists():
+                log.warning('No master bias %s, the %s flats are not bias '
+                            'subtracted', mbfile, color)
+                mbfile = None
+            key = None
+            product = None
+            if cache is not None:
+                inputs = files + ([mbfile] if mbfile is not None else [])
+                key = cache.key('masterflat', files=inputs, chip=chip,
+                                mode=mode, method=method)
+                product = cache.get(key)
+            if product is None:
+                masterbias = None
+                if mbfile is not None:
+                    masterbias = MappedFrame(mbfile)
+                product = master_flat(files, masterbias, method=method,
+                                      memory=memory)
+                if masterbias is not None:
+                    masterbias.close()
+                if cache is not None:
+                    cache.put(key, product)
+            mffile = lof.path/'{color}masterflat_{mode}.fits'.format(
+                color=color, mode=mode)
+            fits.writeto(str(mffile), product[0], product[1], overwrite=True)
+            ListOfFiles.update(lof, mffile)
+
+
+def binned_continuum(x, y, frac=0.05):
+    """
+    Fast continuum: the medians of bins of frac times the number of points,
+    interpolated with a cubic spline, aligned with the input points.
+    """
+    n = len(y)
+    size = max(3, int(round(frac * n)))
+    nbins = int(np.ceil(n / size))
+    order = np.argsort(x, kind='stable')
+    pad = np.full(nbins * size - n, np.nan)
+    xs = np.concatenate([x[order], pad]).reshape(nbins, size)
+    ys = np.concatenate([y[order], pad]).reshape(nbins, size)
+    with warnings.catch_warnings():
+        # The last bin can be only partially filled, and a bin can be empty.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        xc = np.nanmedian(xs, axis=1)
+        yc = np.nanmedian(ys, axis=1)
+    good = np.isfinite(xc) & np.isfinite(yc)
+    fitted = np.empty(n)
+    if good.sum() < 2:
+        fitted[:] = np.nanmedian(y)
+        return fitted
+    spline = make_interp_spline(xc[good], yc[good], k=min(3, good.sum() - 1))
+    fitted[order] = spline(x[order])
+    return fitted
+
+
+def _continuum(args):
+    """
+    Continuum of an order, fitted in two parts that break at pixel split.
+    """
+    x, y, frac, smoother, split = args
+    fitted = np.empty(len(y))
+    for part in (slice(None, split), slice(split, None)):
+        if not len(y[part]):
+            continue
+        if smoother == 'lowess':
+            fitted[part] = nonparametric.lowess(y[part], x[part], frac=frac,
+                                                return_sorted=False)
+        else:
+            fitted[part] = binned_continuum(x[part], y[part], frac=frac)
+    return fitted
 
 
 class Normalise(object):
     """
     Normalise each order
+
+    Parameters:
+    -----------
+    science : Extract object of the science frame.
+
+    specphot : Extract object of the spectrophotometric standard, used as
+               the flat field.
+
+    smoother : 'lowess' (default), or 'binned' (see binned_continuum()),
+               which is much faster.
+
+    processes : number of processes that fit the orders. None fits them in
+                this process.
+
+    Output:
+    -------
+
+    .flatfielded, .normalised : the science object, whose wlcrorders gained
+                                the FlatField, oshape and Normalised
+                                columns.
     """
     def __init__(self,
                  science,
-                 specphot):
+                 specphot,
+                 smoother='lowess',
+                 processes=None,
+                 frac=0.05):
         self.science = science
         self.specphot = specphot
+        self.smoother = smoother
+        self.processes = processes
+        self.frac = frac
         self.flatfielded = self.normalise(self.science)
         self.normalised = self.deblaze(self.science)
 
-    def _shape(self, source, field, o, frac=0.05):
+    def _partition(self, table):
+        """
+        Positions of the rows of each order, in a single pass.
         """
-        Determine the shape of an order, by using a Locally Weighted Scatterplot Smoothing method
-        One could use a polynomial fitting too
+        return table.groupby('Order', sort=False).indices
+
+    def _shapes(self, source, field, orders):
+        """
+        Determine the shape of the orders of source.wlcrorders[field].
+        Returns the shape of each order, aligned with its rows.
         """
-        lowess = nonparametric.lowess
-        order = source.wlcrorders.Order == o
         # Because of the weird shape of the orders, we need to split the fit into two separate fits
         # The break is at pixel 1650
         bk = 1650
-        ya = source.wlcrorders.loc[order, [field]].values.flatten()[:bk]
-        xa = source.wlcrorders.loc[order, ['Wavelength']].values.flatten()[:bk]
-        yb = source.wlcrorders.loc[order, [field]].values.flatten()[bk:]
-        xb = source.wlcrorders.loc[order, ['Wavelength']].values.flatten()[bk:]
-        # print(x)
-        # print(y)
-        lowessfita = lowess(ya, xa, frac=frac)
-        lowessfitb = lowess(yb, xb, frac=frac)
-        # lowessfit = lowess(source.wlcrorders.Object[order], source.wlcrorders.Wavelength[order], frac=frac)
-        return np.concatenate((lowessfita, lowessfitb))
+        rows = self._partition(source.wlcrorders)
+        x = source.wlcrorders.Wavelength.values
+        y = source.wlcrorders[field].values
+        orders = [o for o in orders if o in rows]
+        tasks = [(x[rows[o]], y[rows[o]], self.frac, self.smoother, bk)
+                 for o in orders]
+        if self.processes:
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                shapes = list(pool.map(_continuum, tasks))
+        else:
+            shapes = [_continuum(task) for task in tasks]
+        return dict(zip(orders, shapes))
 
+    def _shape(self, source, field, o, frac=0.05):
+        """
+        Determine the shape of an order
+        Returns an array with the wavelength and the shape of the order.
+        """
+        rows = self._partition(source.wlcrorders)[o]
+        x = source.wlcrorders.Wavelength.values[rows]
+        y = source.wlcrorders[field].values[rows]
+        return np.column_stack(
+            (x, _continuum((x, y, frac, self.smoother, 1650))))
+
+    @timed('normalise')
     def normalise(self, science):
         """
         First step, correction of the pixel-pixel variations
         """
-        # fshape = self._shape(self.specphot, 'Object')
         # We add one column that will hold the normalisez flux
-        science.wlcrorders = science.wlcrorders.assign(FlatField=science.wlcrorders.CosmicRaysObject)
-        for order in science.wlcrorders.Order.unique():
-            o = science.wlcrorders.Order == order
-            fshape = self._shape(self.specphot, 'Object', order)
-            science.wlcrorders.loc[science.wlcrorders.Order == order,
-                                   ['FlatField']] = science.wlcrorders.CosmicRaysObject[o]/fshape[:, 1]
+        table = science.wlcrorders
+        orders = table.Order.unique()
+        rows = self._partition(table)
+        fshapes = self._shapes(self.specphot, 'Object', orders)
+        crobject = table.CosmicRaysObject.values
+        # The orders the standard can not flat field are left out (NaN).
+        flatfield = np.full(len(table), np.nan)
+        missing = []
+        for order in orders:
+            fshape = fshapes.get(order)
+            if fshape is None or len(fshape) != len(rows[order]):
+                missing.append(order)
+                continue
+            flatfield[rows[order]] = crobject[rows[order]] / fshape
+        if missing:
+            log.warning('Orders %s of the science frame do not match the '
+                        'spectrophotometric standard, they are not flat '
+                        'fielded', ', '.join(str(o) for o in missing))
+        science.wlcrorders = table.assign(FlatField=flatfield)
         return science
 
+    @timed('deblaze')
     def deblaze(self, science):
         """
         We now deblaze the orders to have their flux set to unity
         """
-        # oshape = self._shape(self.science, 'FlatField')
-        science.wlcrorders = science.wlcrorders.assign(Normalised=science.wlcrorders.CosmicRaysObject)
-        science.wlcrorders = science.wlcrorders.assign(oshape=science.wlcrorders.CosmicRaysObject)
-        for order in science.wlcrorders.Order.unique()[2:-1]:
-            o = science.wlcrorders.Order == order
-            # print(order)
-            oshape = self._shape(self.science, 'FlatField', order)
-            print(oshape.shape)
-            orderlength = science.hrsfile.data.shape[1]
-            if orderlength > 4000:
-                orderlength = 4040
-            if len(oshape) != orderlength:
-                os = np.pad(oshape[:, 1], (0, orderlength - len(oshape[:, 1]) % orderlength), 'edge')
-            else:
-                os = oshape[:, 1]
-            print(os.shape)
-            science.wlcrorders.loc[science.wlcrorders.Order == order,
-                                   ['oshape']] = os
-            print('apres', order, os.shape)
-            science.wlcrorders.loc[science.wlcrorders.Order == order,
-                                   ['Normalised']] = science.wlcrorders.FlatField[o]/os
+        table = science.wlcrorders
+        rows = self._partition(table)
+        orders = table.Order.unique()[2:-1]
+        oshapes = self._shapes(science, 'FlatField', orders)
+        normalised = np.array(table.CosmicRaysObject.values, dtype=np.float64)
+        oshape = normalised.copy()
+        flatfield = table.FlatField.values
+        for order, os in oshapes.items():
+            oshape[rows[order]] = os
+            normalised[rows[order]] = flatfield[rows[order]] / os
+        science.wlcrorders = table.assign(Normalised=normalised, oshape=oshape)
         return science
 
 
+def clip_cosmics(cube, sigma=3., maxiters=5, std='mad'):
+    """
+    Iterative sigma clipping of all the orders at once, along the pixels,
+    around the median, with the median absolute deviation (std='mad') or
+    the standard deviation (std='std'). Returns the mask of the clipped
+    pixels.
+    """
+    values = np.array(cube, dtype=np.float64)
+    mask = np.zeros(values.shape, dtype=bool)
+    with warnings.catch_warnings():
+        # The padding of the shorter orders is NaN.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for _ in range(maxiters):
+            center = np.nanmedian(values, axis=-1, keepdims=True)
+            if std == 'mad':
+                deviation = 1.4826 * np.nanmedian(np.abs(values - center),
+                                                  axis=-1, keepdims=True)
+            else:
+                deviation = np.nanstd(values, axis=-1, keepdims=True)
+            with np.errstate(invalid='ignore'):
+                rejected = np.abs(values - center) > sigma * deviation
+            if not rejected.any():
+                break
+            values[rejected] = np.nan
+            mask |= rejected
+    return mask
+
+
+def xshift(mode):
+    """
+    Sliced orders are not located at the same place as non sliced orders.
+    This is a crude way of correcting that effect.
+    It works, so let's do it that way for now.
+    """
+    if 'MEDIUM' in mode:
+        return 6
+    return 0
+
+
+class TraceModel(object):
+    """
+    Global model of the location of the orders on the frame: the limits of
+    all the orders are fitted at once with a 2D Legendre polynomial of the
+    column and of the order number, one per fibre.
+
+    Parameters:
+    -----------
+    positions : limits of the orders (norders x ncolumns x 3), as found by
+                Order.find_orders()
+
+    step : the columns of positions are located every step pixels.
+
+    xdeg : degree of the polynomial along the orders.
+
+    odeg : degree of the polynomial across the orders.
+
+    fibres : number of fibres, i.e. of interleaved sets of orders.
+
+    niter, clip : iterations and threshold of the sigma clipping.
+
+    Output:
+    -------
+
+    Called with columns, returns the limits (norders x ncolumns x 3), NaN
+    for the orders outside of the positions.
+    """
+    def __init__(self,
+                 positions,
+                 step,
+                 xdeg=7,
+                 odeg=5,
+                 fibres=2,
+                 niter=3,
+                 clip=4.):
+        self.norders = positions.shape[0]
+        self.step = step
+        self.xdeg = xdeg
+        self.fibres = fibres
+        self.xspan = step * (positions.shape[1] + 1)
+        self.mspan = max(1, (self.norders - 1) // fibres)
+        self.coefficients = []
+        self.rows = []
+        for fibre in range(fibres):
+            rows = np.arange(fibre, self.norders, fibres)
+            coefficients, fitted = self._fit(positions[rows], rows // fibres,
+                                             odeg, niter, clip)
+            self.coefficients.append(coefficients)
+            self.rows.append(rows[fitted])
+        self._grids = {}
+
+    def _scale(self, x, m):
+        return (2. * np.asarray(x) / self.xspan - 1,
+                2. * np.asarray(m) / self.mspan - 1)
+
+    def _fit(self, positions, m, odeg, niter, clip):
+        """
+        Least square fit of the three limits, rejecting the outliers of the
+        center. Returns the coefficients, and the orders within the fit.
+        """
+        x = self.step * (np.arange(positions.shape[1]) + 1)
+        xx, mm = np.meshgrid(x, m)
+        points = positions.reshape(-1, 3)
+        valid = np.isfinite(points).all(axis=1) & (points[:, 1] > 0)
+        # The degree can not be higher than the number of orders found.
+        odeg = min(odeg, len(np.unique(mm.ravel()[valid])) - 1)
+        if odeg < 0 or valid.sum() <= (self.xdeg + 1) * (odeg + 1):
+            return (np.full((self.xdeg + 1, max(odeg, 0) + 1, 3), np.nan),
+                    np.zeros(len(m), dtype=bool))
+        vander = np.polynomial.legendre.legvander2d(
+            *self._scale(xx.ravel(), mm.ravel()), [self.xdeg, odeg])
+        keep = valid.copy()
+        for iteration in range(niter + 1):
+            coefficients = np.linalg.lstsq(vander[keep], points[keep],
+                                           rcond=None)[0]
+            residuals = points[:, 1] - vander @ coefficients[:, 1]
+            sigma = 1.4826 * np.median(np.abs(residuals[keep]))
+            if iteration == niter or sigma == 0:
+                break
+            keep = valid & (np.abs(residuals) < clip * sigma)
+        mvalid = mm.ravel()[valid]
+        fitted = (m >= mvalid.min()) & (m <= mvalid.max())
+        return coefficients.reshape(self.xdeg + 1, odeg + 1, 3), fitted
+
+    def __call__(self, x):
+        """
+        Evaluates the limits of all the orders on the columns x.
+        """
+        x = np.asarray(x, dtype=float)
+        limits = np.full((self.norders, x.size, 3), np.nan)
+        vx = np.polynomial.legendre.legvander(self._scale(x, 0)[0], self.xdeg)
+        for coefficients, rows in zip(self.coefficients, self.rows):
+            vm = np.polynomial.legendre.legvander(
+                self._scale(0, rows // self.fibres)[1],
+                coefficients.shape[1] - 1)
+            limits[rows] = np.einsum('xi,ijk,mj->mxk', vx, coefficients, vm)
+        return limits
+
+    def grid(self, npixels):
+        """
+        Limits of the orders on every pixel of a frame npixels wide, cached.
+        """
+        if npixels not in self._grids:
+            self._grids[npixels] = self(np.arange(npixels))
+        return self._grids[npixels]
+
+    def limits(self, npixels, first=2):
+        """
+        Lower limit of the orders (norders x npixels) and their mean width.
+        The first `first` orders are NaN, they are not extracted.
+        """
+        grid = self.grid(npixels)
+        lower = grid[:, :, 0].copy()
+        with np.errstate(all='ignore'):
+            width = np.mean(grid[:, :, 2] - grid[:, :, 0], axis=1)
+        lower[:first] = np.nan
+        width[:first] = np.nan
+        return lower, width
+
+
+class ExtractionOperator(object):
+    """
+    Sparse operator that sums the pixels of the orders, column by column.
+
+    Parameters:
+    -----------
+    lower : lower limit of the orders, for every pixel (norders x npixels)
+
+    width : width of each order, in pixels.
+
+    shape : shape of the frames that will be extracted.
+
+    shift : shift applied to the limits of the orders (see xshift()).
+
+    fractional : if True (default), the pixels at the edges are weighted
+                 by the fraction inside the order. If False, the limits
+                 are truncated like the column by column extraction.
+
+    Output:
+    -------
+
+    Calling the operator on a frame returns a (norders x npixels) array,
+    on a stack of N frames a (N x norders x npixels) array.
+    """
+    def __init__(self,
+                 lower,
+                 width,
+                 shape,
+                 shift=0,
+                 fractional=True):
+        self.shape = tuple(shape)
+        self.norders, self.npixels = lower.shape
+        self.fractional = fractional
+        self.matrix = self._build(lower, width, shift)
+
+    @classmethod
+    @timed('operator')
+    def from_trace(cls, trace, shape, mode='', fractional=True):
+        """
+        Builds the operator from the TraceModel of the orders.
+        """
+        lower, width = trace.limits(shape[1])
+        return cls(lower, width, shape, shift=xshift(mode),
+                   fractional=fractional)
+
+    def _build(self, lower, width, shift):
+        nrows, ncols = self.shape
+        x = np.arange(self.npixels)
+        rows, cols, weights = [], [], []
+        for o in range(self.norders):
+            good = np.isfinite(lower[o]) & (x < ncols)
+            if not np.isfinite(width[o]) or not good.any():
+                continue
+            if self.fractional:
+                lo = lower[o, good] + shift
+                hi = lo + width[o]
+            else:
+                lo = np.trunc(lower[o, good]) + shift
+                hi = lo + np.floor(width[o])
+            # Every pixel even partially covered gets a weight.
+            npix = int(np.ceil(width[o])) + 1
+            j = np.floor(lo)[:, None] + np.arange(npix)[None, :]
+            w = np.clip(np.minimum(j + 1, hi[:, None])
+                        - np.maximum(j, lo[:, None]), 0, 1)
+            keep = (w > 0) & (j >= 0) & (j < nrows)
+            column = np.broadcast_to(x[good][:, None], j.shape)
+            rows.append((o * self.npixels + column)[keep])
+            cols.append((j.astype(np.int64) * ncols + column)[keep])
+            weights.append(w[keep])
+        if rows:
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+            weights = np.concatenate(weights)
+        return sparse.csr_matrix(
+            (weights, (rows, cols)),
+            shape=(self.norders * self.npixels, nrows * ncols))
+
+    def __call__(self, data):
+        """
+        Extracts the orders of a frame, or of a stack of frames.
+        """
+        data = np.asarray(data)
+        if data.shape[-2:] != self.shape:
+            raise ValueError('Frame shape {shape} does not match the operator '
+                             'shape {op}'.format(shape=data.shape[-2:],
+                                                 op=self.shape))
+        if data.ndim == 2:
+            return (self.matrix @ data.ravel()).reshape(self.norders,
+                                                        self.npixels)
+        stack = data.reshape(data.shape[0], -1)
+        return (self.matrix @ stack.T).T.reshape(data.shape[0], self.norders,
+                                                 self.npixels)
+
+
+@functools.lru_cache(maxsize=128)
+def _pyhrs_table(path, size, mtime):
+    with fits.open(path) as hdulist:
+        orders = np.array(hdulist[1].data['Order'], dtype=np.int64)
+        wavelength = np.array(hdulist[1].data['Wavelength'], dtype=np.float64)
+    # One stable sort, then the table is cut where the order changes.
+    index = np.argsort(orders, kind='stable')
+    orders, wavelength = orders[index], wavelength[index]
+    unique, starts = np.unique(orders, return_index=True)
+    return dict(zip(unique.tolist(), np.split(wavelength, starts[1:])))
+
+
+def order_length(chip, order):
+    """
+    Number of pixels of an order in the pyhrs reduced files, and in the
+    extracted tables.
+    """
+    if 'HR' in chip:
+        return 3269 if order == 53 else 4040
+    return 2048
+
+
+def pyhrs_wavelengths(pyhrsfile):
+    """
+    Returns a dictionary {order: wavelengths} read from a pyhrs reduced file.
+    The tables are kept in memory while the file does not change.
+    """
+    stat = Path(pyhrsfile).stat()
+    return _pyhrs_table(str(pyhrsfile), stat.st_size, stat.st_mtime_ns)
+
+
 class Extract(object):
     """
     With the location of the orders defined, we can now extract the orders from the science frame
@@ -581,6 +1741,23 @@ class Extract(object):
     save:   if set to True, a file with the extracted content will be created. False (default) prevents saving.
             Anything else is considered False.
 
+    sparse: if set to True, the orders are extracted with the sparse
+            operator of the orderposition, shared by all the frames.
+
+    cache:  Cache of the extracted orders, keyed by the science frame and
+            the Order, which must have been built with a cache too.
+
+    clipping: 'astropy' (default) clips the cosmic rays order by order,
+              'vectorized' all the orders at once (see clip_cosmics()).
+
+    output: 'csv' (default) saves the orders in a gzip compressed CSV file.
+            'fits' appends them as a binary table to a file of the night
+            (see append_extraction() and read_extraction()).
+
+    wavelength: WavelengthSolution of the night (see
+                pipeline.stability.thar). None (default) reads the
+                wavelengths of the pyhrs reduced file of the frame.
+
     Output:
     -------
 
@@ -588,23 +1765,67 @@ class Extract(object):
     .worders : Numpy array containing the wavelength calibrated extracted orders
     .wlcrorders : Numpy array containing the wavelength calibrated, cosmic rays corrected orders.
     """
+    # Without a WavelengthSolution, the wavelengths come from the pyhrs files.
+    wavelength = None
+    # Without extraction() (extract=False), there are no calibrated orders.
+    worders = None
+    wlcrorders = None
+
     def __init__(self,
                  orderposition='',
                  hrsscience='',
                  extract=False,
-                 save=False):
+                 save=False,
+                 sparse=False,
+                 cache=None,
+                 clipping='astropy',
+                 output='csv',
+                 wavelength=None):
         # self.orderposition = orderposition
         self.hrsfile = hrsscience
         self.step = orderposition.step
         self.extract = extract
-
-        self.orders = self._extract_orders(
-            orderposition.extracted,
-            self.hrsfile.data)
-        if self.extract:
-            self.extraction()
-        if self.checksave(save):
-            self.save()
+        self.clipping = clipping
+        self.output = output
+        self.wavelength = wavelength
+
+        name = Path(str(getattr(self.hrsfile, 'file', 'science'))).name
+        with instrument.frame(name):
+            key = None
+            product = None
+            if (cache is not None
+                    and getattr(orderposition, 'cachekey', None) is not None):
+                files = [self.hrsfile.file]
+                parents = [orderposition.cachekey]
+                if self.extract and wavelength is not None:
+                    parents.append(wavelength.key)
+                elif self.extract and self._pyhrsfile().exists():
+                    files.append(self._pyhrsfile())
+                key = cache.key('extract', files=files,
+                                header=self.hrsfile.header,
+                                keywords=['DATASEC', 'OBSMODE', 'DETNAM'],
+                                parents=parents, sparse=sparse,
+                                extract=extract, clipping=clipping)
+                product = cache.get(key)
+            if product is not None:
+                self.orders, self.worders, self.wlcrorders = product
+            else:
+                if sparse:
+                    self.operator = orderposition.operator(
+                        self.hrsfile.data.shape, self.hrsfile.mode)
+                    with instrument.stage('extract_orders'):
+                        self.orders = self.operator(self.hrsfile.data)
+                else:
+                    self.orders = self._extract_orders(
+                        orderposition.trace,
+                        self.hrsfile.data)
+                if self.extract:
+                    self.extraction()
+                if key is not None:
+                    cache.put(key, (self.orders, self.worders,
+                                    self.wlcrorders))
+            if self.checksave(save):
+                self.save()
 
     def extraction(self):
         self.worders = self._wavelength(
@@ -614,11 +1835,19 @@ class Extract(object):
 
     def checksave(self, save):
         if not isinstance(save, bool):
-            print('Save option must be True or False not {save}\nSaving disabled'.format(save=type(save)))
+            log.warning('Save option must be True or False not %s\n'
+                        'Saving disabled', type(save))
             return False
         return save
 
+    @timed('cosmicrays')
     def _cosmicrays(self, orders):
+        """
+        Sigma clips the Sky and the Object of each order, into the
+        CosmicRaysSky and CosmicRaysObject columns.
+        """
+        if self.clipping == 'vectorized':
+            return self._cosmicrays_vectorized(orders)
         orders = orders.assign(
             CosmicRaysSky=orders['Sky'])
         orders = orders.assign(
@@ -631,42 +1860,51 @@ class Extract(object):
             orders.loc[orders.Order == o, ['CosmicRaysObject']] = orders.Object[filt][~cro.mask]
         return orders
 
-    def _extract_orders(self, positions, data):
-        """ positions est un array à 3 dimensions représentant pour chaque point des ordres detectes :
+    def _cosmicrays_vectorized(self, orders):
+        """
+        Same as _cosmicrays(), on a (2 x norders x npixels) array of both
+        fibres, clipped in one call (see clip_cosmics()).
+        """
+        rows, index, valid = order_index(orders)
+        cube = np.full((2,) + index.shape, np.nan)
+        sky = np.array(orders.Sky.values, dtype=np.float64)
+        obj = np.array(orders.Object.values, dtype=np.float64)
+        cube[0][valid] = sky[index[valid]]
+        cube[1][valid] = obj[index[valid]]
+        mask = clip_cosmics(cube)
+        sky[index[valid & mask[0]]] = np.nan
+        obj[index[valid & mask[1]]] = np.nan
+        return orders.assign(CosmicRaysSky=sky, CosmicRaysObject=obj)
+
+    @timed('extract_orders')
+    def _extract_orders(self, trace, data):
+        """ trace est le TraceModel des ordres détectés, qui donne pour
+        chaque pixel :
         la limite inférieure,
         le centre,
         la limite supérieure des ordres.
-        [:,:,0] est la limite inférieure
-        [:,:,1] le centre,
-        [:,:,2] la limite supérieure
+        Il est évalué une seule fois sur tous les pixels.
         """
 # TODO penser à mettre l'array en fortran, vu qu'on travaille par colonnes, ça ira plus vite.
 
         # data = parameters['data']
-        orders = np.zeros((positions.shape[0], data.shape[1]))
+        orders = np.zeros((trace.norders, data.shape[1]))
         npixels = orders.shape[1]
-        print(orders.shape)
+        log.debug('%s', orders.shape)
         x = [i for i in range(npixels)]
-        # Sliced orders are not located at the same place as non sliced orders.
-        # This is a crude way of correcting that effect.
-        # It works, so let's do it that way for now.
-        if 'MEDIUM' in self.hrsfile.mode:
-            xshift = 6
-        elif 'LOW' in self.hrsfile.mode:
-            xshift = 0
+        shift = xshift(self.hrsfile.mode)
+        lower, width = trace.limits(npixels)
         for o in range(2, orders.shape[0]):
-            print('Extracting order : ', o)
-            X = [self.step * (i + 1) for i in range(positions[o, :, 0].shape[0])]
-            try:
-                foinf = np.poly1d(np.polyfit(X, positions[o, :, 0], 7))
-                fosup = np.poly1d(np.polyfit(X, positions[o, :, 2], 7))
-                orderwidth = np.floor(np.mean(fosup(x) - foinf(x))).astype(int)
-                print("↳ Largeur de l'ordre : {orderwidth}".format(orderwidth=orderwidth))
-            except ValueError:
+            log.debug('Extracting order : %s', o)
+            if not np.isfinite(width[o]):
                 continue
+            foinf = lower[o]
+            orderwidth = np.floor(width[o]).astype(int)
+            log.debug("↳ Largeur de l'ordre : %s", orderwidth)
             for i in x:
                 try:
-                    orders[o, i] = data[np.int(foinf(i))+xshift: np.int(foinf(i)) + orderwidth + xshift, i].sum()
+                    start = int(foinf[i]) + shift
+                    orders[o, i] = data[start:start + orderwidth, i].sum()
                 except ValueError:
                     continue
 # TODO:
@@ -680,68 +1918,263 @@ class Extract(object):
         """
         pass
 
+    def _pyhrsfile(self):
+        """
+        Name of the pyhrs reduced file of the science frame
+        """
+        file = self.hrsfile.file
+        return file.parent / ('p' + file.stem + '_obj' + file.suffix)
+
+    @timed('wavelength')
     def _wavelength(self, extracted_data):
         '''
         In order to get the wavelength solution, we will merge the wavelength solution
         obtained from the pyhrs reduced spectra, with our extracted data
-        This is a temporary solution until we have a working wavelength solution.
+        When a WavelengthSolution of the night is given, its wavelength grid
+        is used instead.
         '''
-        print(self.hrsfile.file.name)
-        pyhrsfile = 'p' + self.hrsfile.file.stem + '_obj' + self.hrsfile.file.suffix
-        try:
-            pyhrs_data = fits.open(self.hrsfile.file.parent/pyhrsfile)
-        except FileNotFoundError:
-            print("File {hrsfile} not found, can't do a wavelength calibration.".format(
-                hrsfile=self.hrsfile.file.parent/pyhrsfile))
-            return None
-        list_orders = np.unique(pyhrs_data[1].data['Order'])
-        dex = pd.DataFrame()
-
-        for o in list_orders[::-1]:
-            print('Ordre :', o)
-            a = pyhrs_data[1].data[np.where(pyhrs_data[1].data['Order'] == o)[0]]
-            line = 2*(int(o) - self.hrsfile.ordershift)
-            orderlength = 2048
-            if 'HR' in self.hrsfile.chip:
-                if o == 53:
-                    orderlength = 3269
-                else:
-                    orderlength = 4040
+        log.debug('%s', self.hrsfile.file.name)
+        if self.wavelength is not None:
+            wavelengths = self.wavelength.grid()
+        else:
+            pyhrsfile = self._pyhrsfile()
             try:
-                dex = dex.append(pd.DataFrame(
-                    {
-                        'Wavelength': a['Wavelength'],
-                        'Sky': extracted_data[line, :orderlength],
-                        'Object': extracted_data[line-1, :orderlength],
-                        'Order': [o for i in range(orderlength)]}
-                    ))
-            except (IndexError, ValueError):
+                wavelengths = pyhrs_wavelengths(pyhrsfile)
+            except FileNotFoundError:
+                log.warning("File %s not found, can't do a wavelength "
+                            "calibration.", pyhrsfile)
+                return None
+        nlines, ncolumns = extracted_data.shape
+        selected = []
+        for o in sorted(wavelengths, reverse=True):
+            line = 2*(int(o) - self.hrsfile.ordershift)
+            orderlength = order_length(self.hrsfile.chip, o)
+            # Orders that do not match the extraction are skipped.
+            if (not 1 <= line < nlines or orderlength > ncolumns
+                    or len(wavelengths[o]) != orderlength):
                 continue
-        dex = dex.reset_index()
-        # Reordering the columns
-        dex = dex[['Wavelength', 'Object', 'Sky', 'Order']]
-        return dex
-
-    def save(self):
+            selected.append((o, line, orderlength))
+        size = sum(orderlength for o, line, orderlength in selected)
+        columns = {
+            'Wavelength': np.empty(size),
+            'Object': np.empty(size, dtype=extracted_data.dtype),
+            'Sky': np.empty(size, dtype=extracted_data.dtype),
+            'Order': np.empty(size, dtype=np.int64)}
+        start = 0
+        for o, line, orderlength in selected:
+            stop = start + orderlength
+            columns['Wavelength'][start:stop] = wavelengths[o]
+            rows = extracted_data[line-1:line+1, :orderlength]
+            columns['Object'][start:stop] = rows[0]
+            columns['Sky'][start:stop] = rows[1]
+            columns['Order'][start:stop] = o
+            start = stop
+        return pd.DataFrame(columns,
+                            columns=['Wavelength', 'Object', 'Sky', 'Order'])
+
+    @timed('save')
+    def save(self, output=None, file=None):
         """
         Saving the DataFrame to disk.
+        output : 'csv' writes a gzip compressed CSV file named after the
+                 object, 'fits' appends a binary table to the file of the
+                 night (see append_extraction()).
+        file : file of the night, for the 'fits' output. Defaults to
+               {chip letter}{date}_extracted.fits
         """
+        output = self.output if output is None else output
+        if output == 'fits':
+            if file is None:
+                # The chip letter and the night, as in R201701010012.fits.
+                file = self.hrsfile.file.stem[:9] + '_extracted.fits'
+            log.info('Saving extracted data in %s', file)
+            append_extraction(file, self.wlcrorders, self.hrsfile.file.stem,
+                              header=self.hrsfile.header)
+            return
         if 'HBDET' in self.hrsfile.chip:
             ext = 'B'
         else:
             ext = 'R'
         name = self.hrsfile.name + '_' + ext + '.csv.gz'
-        print('Saving extracted data as {name}'.format(name=name))
+        log.info('Saving extracted data as %s', name)
         self.wlcrorders.to_csv(name, compression='gzip', index=False)
 
 
+# Keywords of the science frame that are copied in the header of its table.
+EXTRACTION_KEYWORDS = ['OBJECT', 'DATE-OBS', 'TIME-OBS', 'OBSMODE', 'DETNAM',
+                       'EXPTIME', 'PROPID']
+
+
+def order_index(orders):
+    """
+    Lays out the rows of a table of orders in a (norders x npixels) array.
+    Returns the {order: rows} dictionary, the array (-1 past the end of the
+    shorter orders) and its valid mask.
+    A table without an Order column, like a merged spectrum, is a single row.
+    """
+    if 'Order' in orders:
+        rows = orders.groupby('Order', sort=False).indices
+    else:
+        rows = {0: np.arange(len(orders))}
+    length = max(len(r) for r in rows.values())
+    index = np.full((len(rows), length), -1)
+    for i, r in enumerate(rows.values()):
+        index[i, :len(r)] = r
+    return rows, index, index >= 0
+
+
+def extraction_table(orders, header=None):
+    """
+    Converts a DataFrame of extracted orders to a FITS binary table with one
+    row per order, padded with NaN, the Length column gives the pixels.
+    The columns are kept in the order of the DataFrame.
+    """
+    rows, index, valid = order_index(orders)
+    lengths = valid.sum(axis=1).astype(np.int32)
+    columns = [fits.Column(name='Length', format='J', array=lengths)]
+    for name in orders.columns:
+        if name == 'Order':
+            numbers = np.array(list(rows), dtype=np.int32)
+            columns.append(fits.Column(name='Order', format='J',
+                                       array=numbers))
+            continue
+        values = orders[name].values
+        dtype = np.float32 if values.dtype == np.float32 else np.float64
+        array = np.full(index.shape, np.nan, dtype=dtype)
+        array[valid] = values[index[valid]]
+        columns.append(fits.Column(
+            name=name,
+            format='{n}{code}'.format(
+                n=index.shape[1], code='E' if dtype == np.float32 else 'D'),
+            array=array))
+    table = fits.BinTableHDU.from_columns(columns)
+    if header is not None:
+        for k in EXTRACTION_KEYWORDS:
+            if k in header:
+                table.header[k] = header[k]
+    return table
+
+
+def append_extraction(file, orders, frame, header=None):
+    """
+    Appends the extracted orders of a frame to the file of a night, as a
+    binary table named after the frame, or replaces its table.
+    """
+    table = extraction_table(orders, header=header)
+    table.name = frame
+    if not Path(file).exists():
+        fits.HDUList([fits.PrimaryHDU(), table]).writeto(str(file))
+    elif frame in extraction_frames(file):
+        with fits.open(str(file), mode='update') as hdulist:
+            hdulist[frame] = table
+    else:
+        fits.append(str(file), table.data, table.header)
+
+
+def extraction_frames(file):
+    """
+    Names of the frames stored in a file of extracted orders.
+    """
+    with fits.open(str(file), memmap=True) as hdulist:
+        return [hdu.name for hdu in hdulist[1:]]
+
+
+def _extraction_table(data):
+    """
+    DataFrame of the orders of a binary table written by extraction_table().
+    """
+    lengths = np.array(data['Length'])
+    valid = np.arange(data['Wavelength'].shape[1]) < lengths[:, None]
+    columns = {}
+    for name in data.columns.names:
+        if name == 'Length':
+            continue
+        if name == 'Order':
+            orders = np.array(data['Order'], dtype=np.int64)
+            columns[name] = np.repeat(orders, lengths)
+        else:
+            # Boolean indexing copies the pixels out of the memory map.
+            values = data[name][valid]
+            columns[name] = values.astype(values.dtype.type)
+    return pd.DataFrame(columns, columns=list(columns))
+
+
+def read_extraction(file, frame, header=False):
+    """
+    Reads the extracted orders of a frame back as a DataFrame.
+    The file is memory mapped, only the table of the frame is read. If
+    header is True, the header of the table is returned as well.
+    """
+    with fits.open(str(file), memmap=True) as hdulist:
+        orders = _extraction_table(hdulist[frame].data)
+        theader = hdulist[frame].header.copy() if header else None
+    return (orders, theader) if header else orders
+
+
+def read_extractions(file, frames=None, header=False):
+    """
+    Reads the extracted orders of frames of a file (all by default), opening
+    it once: yields (frame, orders), and the header if header is True.
+    """
+    with fits.open(str(file), memmap=True) as hdulist:
+        wanted = set(frames) if frames is not None else None
+        for hdu in hdulist[1:]:
+            if wanted is not None and hdu.name not in wanted:
+                continue
+            orders = _extraction_table(hdu.data)
+            if header:
+                yield hdu.name, orders, hdu.header.copy()
+            else:
+                yield hdu.name, orders
+
+
+def classify(record):
+    """
+    Kinds of a frame ('thar', 'flat', 'bias', 'science', 'specphot') from
+    a record of the FileIndex, or a header. A frame without PROPID, TIME-OBS
+    or DATE-OBS has no kind.
+    """
+    propid = record.get('PROPID')
+    if (propid is None or record.get('TIME-OBS') is None
+            or record.get('DATE-OBS') is None):
+        return []
+    kinds = []
+    if 'STABLE' in propid:
+        kinds.append('thar')
+    if 'CAL_FLAT' in propid:
+        kinds.append('flat')
+    if 'BIAS' in propid:
+        kinds.append('bias')
+    if 'SCI' in propid or 'MLT' in propid or 'LSP' in propid:
+        kinds.append('science')
+    if 'SPST' in propid:
+        kinds.append('specphot')
+    return kinds
+
+
 class ListOfFiles(object):
     """
     List all the  HRS raw files in the directory
     Returns the description of the files
+
+    The headers are kept in a FileIndex, by default .hrsindex.sqlite in
+    datadir, so only the new or modified files are read again.
+
+    Parameters:
+    -----------
+    datadir : directory where the data are.
+
+    index : sqlite file of the index, or a FileIndex.
+
+    workers : number of threads that read the headers.
     """
-    def __init__(self, datadir):
-        self.path = datadir
+    def __init__(self, datadir, index=None, workers=8):
+        self.path = Path(datadir)
+        if not isinstance(index, FileIndex):
+            if index is None:
+                index = default_database(self.path)
+            index = FileIndex(index, workers=workers)
+        self.index = index
         self.thar = []
         self.bias = []
         self.flat = []
@@ -758,19 +2191,20 @@ class ListOfFiles(object):
         in order to take into account the master bias/flats that have been created after
         the datadir has been parsed
         """
-        print('updating')
-        with fits.open(datadir/file) as fh:
-            propid = fh[0].header['propid']
-            print(propid)
-            print(datadir/file)
-            if 'BIAS' in propid and datadir/file not in self.bias:
-                self.bias.append(datadir/file)
-            else:
-                print('File already included')
+        file = self.path/Path(file).name
+        record = self.index.update(file)
+        propid = record['PROPID'] or ''
+        log.debug('updating %s (%s)', file, propid)
+        if 'BIAS' in propid and file not in self.bias:
+            self.bias.append(file)
+        elif 'CAL_FLAT' in propid and file not in self.flat:
+            self.flat.append(file)
+        else:
+            log.debug('%s already included', file)
 
     def calibrations_check(self):
         if not self.flat and not self.bias:
-            print('No Flats and no biases found in {datadir}\nGo to https://hrscal.salt.ac.za/ to download the biases and flats that are needed to reduce your science data.'.format(datadir=self.path))  # noqa
+            log.warning('No Flats and no biases found in %s\nGo to https://hrscal.salt.ac.za/ to download the biases and flats that are needed to reduce your science data.', self.path)  # noqa
 
     def crawl(self, path=None):
         """
@@ -785,28 +2219,15 @@ class ListOfFiles(object):
         objet = []
         sky = []
         specphot = []
-        path = path if path is not None else self.path
-        for item in path.glob('*.fits'):
-            if item.name.startswith('H') or item.name.startswith('R'):
-                # print('File : {file}'.format(file=path / item.name))
-                with fits.open(path / item.name) as fh:
-                    try:
-                        h = fh[0].header['PROPID']
-                        t = fh[0].header['TIME-OBS']
-                        d = fh[0].header['DATE-OBS']
-                    except KeyError:
-                        # no propid, probably not a SALT FITS file.
-                        continue
-                    if 'STABLE' in h:
-                        thar.append(self.path / item.name)
-                    if 'CAL_FLAT' in h:
-                        flat.append(self.path / item.name)
-                    if 'BIAS' in h:
-                        bias.append(self.path / item.name)
-                    if 'SCI' in h or 'MLT' in h or 'LSP' in h:
-                        science.append(self.path / item.name)
-                    if 'SPST' in h:
-                        specphot.append(self.path / item.name)
+        path = Path(path) if path is not None else self.path
+        self.index.scan(path)
+        lists = {'thar': thar, 'flat': flat, 'bias': bias,
+                 'science': science, 'specphot': specphot}
+        for record in self.index.records(path):
+            item = Path(record['path'])
+            for kind in classify(record):
+                lists[kind].append(self.path / item.name)
+        for item in path.glob('p*.fits'):
             if item.name.startswith('pH') or item.name.startswith('pR'):
                 if 'obj' in item.name:
                     objet.append(self.path / item.name)
@@ -839,10 +2260,5 @@ if __name__ == "__main__":
         from sys import exit
         print('You need to upgrade to a version of Astropy greater than 1.3.1')
         exit()
-    parser = argparse.ArgumentParser(description='HRS Data Reduction pipeline')
-    parser.add_argument('-d',
-                        '--datadir',
-                        help='Directory where the data to be reduced are',
-                        default='.')
-    args = parser.parse_args()
-    datadir = Path(args.datadir)
+    from pipeline.stability.night import main
+    main()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# python imports
+from pathlib import Path
+import datetime
+
+# numpy imports
+import numpy as np
+
+# astropy imports
+from astropy.io import fits
+
+# pandas imports
+import pandas as pd
+
+# pipeline imports
+from pipeline.stability.stability import order_length, orient
+
+# Layout of the chips. The orders go along the columns of HRS.data, the
+# prescan and overscan columns are outside of DATASEC.
+CHIPS = {'HBDET': {'letter': 'H',
+                   'xpix': 2048,
+                   'nrows': 4096,
+                   'prescan': 26,
+                   'overscan': 26,
+                   'ordershift': 83,
+                   'norders': 40,
+                   'bias': 690,
+                   'gain': 1.},
+         'HRDET': {'letter': 'R',
+                   'xpix': 4096,
+                   'nrows': 4096,
+                   'prescan': 28,
+                   'overscan': 28,
+                   'ordershift': 52,
+                   'norders': 32,
+                   'bias': 920,
+                   'gain': 1.}}
+
+# The wavelength of the centre of order m is about BLAZE / m Angstroms.
+BLAZE = 4.7e5
+
+KINDS = {'bias': {'PROPID': 'CAL_BIAS',
+                  'OBSTYPE': 'Bias',
+                  'OBJECT': 'Bias',
+                  'EXPTIME': 0.},
+         'flat': {'PROPID': 'CAL_FLAT',
+                  'OBSTYPE': 'Flat field',
+                  'OBJECT': 'Flat field',
+                  'EXPTIME': 10.},
+         'thar': {'PROPID': 'CAL_STABLE',
+                  'OBSTYPE': 'Arc',
+                  'OBJECT': 'ThAr',
+                  'EXPTIME': 30.},
+         'science': {'PROPID': '2017-1-SCI-001',
+                     'OBSTYPE': 'Science',
+                     'OBJECT': 'HD 000001',
+                     'EXPTIME': 600.},
+         'specphot': {'PROPID': 'CAL_SPST',
+                      'OBSTYPE': 'Science',
+                      'OBJECT': 'LTT 0001',
+                      'EXPTIME': 300.}}
+
+
+def order_centers(chip='HRDET', fibre=22, nrows=None, norders=None):
+    """
+    Rows of the sky and object fibres of the orders on every column of
+    HRS.data (norders x 2 x xpix), curved and tilted like on an echelle.
+    """
+    layout = CHIPS[chip]
+    nrows = layout['nrows'] if nrows is None else nrows
+    norders = layout['norders'] if norders is None else norders
+    x = np.arange(layout['xpix'])
+    u = (x - layout['xpix'] / 2) / layout['xpix']
+    # The spacing goes from 1.25 to 0.75 times the mean spacing.
+    spacing = np.linspace(1.25, 0.75, norders)
+    spacing *= (nrows - 160) / spacing.sum()
+    base = 80 + np.concatenate([[0], np.cumsum(spacing[:-1])])
+    curve = base[:, None] - 0.02 * base[:, None] * 4 * u ** 2 + 10 * u
+    return np.stack([curve, curve + fibre], axis=1)
+
+
+def wavelengths(chip, order, length=None):
+    """
+    Wavelength of the pixels of an order, in Angstroms.
+    """
+    length = order_length(chip, order) if length is None else length
+    centre = BLAZE / order
+    return centre * (1 + (np.arange(length) - length / 2) / (40 * length))
+
+
+def _profile(shape, centers, amplitude, sigma, rows=30):
+    """
+    Frame of gaussian profiles of width sigma along the centers
+    (norders x 2 x ncols), computed on the rows around them only.
+    """
+    frame = np.zeros(shape)
+    amplitude = np.broadcast_to(amplitude, centers.shape)
+    columns = np.arange(shape[1])
+    offsets = np.arange(-rows, rows + 1)[:, None]
+    for center, a in zip(centers.reshape(-1, shape[1]),
+                         amplitude.reshape(-1, shape[1])):
+        y = np.rint(center).astype(int) + offsets
+        valid = (y >= 0) & (y < shape[0])
+        profile = a * np.exp(-0.5 * ((y - center) / sigma) ** 2)
+        # The pixels of a profile are all different.
+        x = np.broadcast_to(columns, y.shape)
+        frame[y[valid], x[valid]] += profile[valid]
+    return frame
+
+
+def _blaze(ncols):
+    u = (np.arange(ncols) - ncols / 2) / ncols
+    return np.sinc(1.2 * u) ** 2
+
+
+def _lines(rng, nlines, ncols, width, strength):
+    """
+    Spectrum of nlines gaussian lines at random positions.
+    """
+    return _spectrum(rng.uniform(0, ncols, nlines),
+                     strength * rng.uniform(0.1, 1., nlines), ncols, width)
+
+
+def thar_lines(chip, order, nlines=60, strength=30000):
+    """
+    Positions (pixels) and amplitudes of the ThAr lines of an order, the
+    same on every frame of the chip.
+    """
+    rng = np.random.default_rng([sorted(CHIPS).index(chip), order])
+    centres = np.sort(rng.uniform(0, CHIPS[chip]['xpix'], nlines))
+    return centres, strength * rng.uniform(0.1, 1., nlines)
+
+
+def thar_linelist(chip, orders=None):
+    """
+    Sorted wavelengths and amplitudes of the ThAr lines of a chip, the
+    line list of the wavelength calibration.
+    """
+    layout = CHIPS[chip]
+    if orders is None:
+        orders = layout['ordershift'] + 1 + np.arange(layout['norders'])
+    lines = [(o,) + thar_lines(chip, o) for o in orders]
+    wavelength = np.concatenate([
+        BLAZE / o * (1 + (c - order_length(chip, o) / 2)
+                     / (40 * order_length(chip, o))) for o, c, a in lines])
+    amplitude = np.concatenate([a for o, c, a in lines])
+    index = np.argsort(wavelength)
+    return wavelength[index], amplitude[index]
+
+
+def stellar_lines(chip, nlines=4000):
+    """
+    Wavelengths and depths of the lines of the synthetic star, the line
+    mask of the radial velocities.
+    """
+    layout = CHIPS[chip]
+    first = layout['ordershift'] + 1
+    last = layout['ordershift'] + layout['norders']
+    rng = np.random.default_rng([sorted(CHIPS).index(chip), 1])
+    wavelength = np.sort(rng.uniform(wavelengths(chip, last)[0],
+                                     wavelengths(chip, first)[-1], nlines))
+    return wavelength, rng.uniform(0.1, 0.6, nlines)
+
+
+def normalised_orders(chip, velocity=0., snr=None, seed=0, width=3.,
+                      orders=None):
+    """
+    Table of normalised orders, like those of Normalise, of the synthetic
+    star at velocity km/s, with photon noise if snr is given.
+    """
+    layout = CHIPS[chip]
+    if orders is None:
+        orders = layout['ordershift'] + 1 + np.arange(layout['norders'])
+    rng = np.random.default_rng(seed)
+    centres, depths = stellar_lines(chip)
+    centres = centres * (1 + velocity / 299792.458)
+    tables = []
+    for o in sorted(orders, reverse=True):
+        wavelength = wavelengths(chip, o)
+        lines = ((centres > wavelength[0] * 0.999)
+                 & (centres < wavelength[-1] * 1.001))
+        # The orders are evenly spaced in wavelength.
+        step = wavelength[1] - wavelength[0]
+        pixels = (centres[lines] - wavelength[0]) / step
+        sigma = width / 299792.458 * wavelength.mean() / step
+        flux = 1 - _spectrum(pixels, depths[lines], len(wavelength), sigma)
+        blaze = _blaze(len(wavelength))
+        counts = (snr if snr is not None else 100.) ** 2 * blaze
+        if snr is not None:
+            noise = rng.normal(0, 1, len(flux)) / np.sqrt(counts)
+            flux = flux * (1 + noise)
+        tables.append(pd.DataFrame({'Wavelength': wavelength,
+                                    'Object': counts * flux,
+                                    'Order': np.full(len(wavelength), o),
+                                    'Normalised': flux}))
+    return pd.concat(tables, ignore_index=True)
+
+
+def _spectrum(centres, amplitudes, ncols, width):
+    """
+    Spectrum of gaussian lines of the given width, at the given positions.
+    """
+    x = np.arange(ncols)
+    spectrum = np.zeros(ncols)
+    for c, a in zip(centres, amplitudes):
+        lo = max(int(c - 5 * width), 0)
+        hi = min(int(c + 5 * width) + 1, ncols)
+        spectrum[lo:hi] += a * np.exp(-0.5 * ((x[lo:hi] - c) / width) ** 2)
+    return spectrum
+
+
+def cosmic_rays(shape, count, rng, level=20000.):
+    """
+    Returns a frame with count cosmic rays, short tracks of a few pixels.
+    """
+    frame = np.zeros(shape)
+    for _ in range(count):
+        y, x = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        length = rng.integers(1, 6)
+        dy, dx = rng.choice([-1, 0, 1], 2)
+        ys = np.clip(y + dy * np.arange(length), 0, shape[0] - 1)
+        xs = np.clip(x + dx * np.arange(length), 0, shape[1] - 1)
+        frame[ys, xs] += level * rng.uniform(0.2, 1., length)
+    return frame
+
+
+def frame(kind='flat', chip='HRDET', mode='HIGH RESOLUTION', seed=0,
+          nrows=None, cosmics=None, exptime=None, readnoise=5.,
+          date='2017-04-12', time='20:00:00', drift=0.):
+    """
+    Creates a synthetic HRS raw frame.
+
+    Parameters:
+    -----------
+    kind : 'bias', 'flat', 'thar', 'science' or 'specphot'.
+
+    chip : 'HBDET' (2048 pixels along the orders) or 'HRDET' (4096 pixels).
+
+    mode : OBSMODE. The LOW RESOLUTION mode only has the object fibre.
+
+    seed : seed of the random generator.
+
+    nrows : number of rows of the frame. Defaults to the size of the chip.
+
+    cosmics : number of cosmic rays. Defaults to one every 10000 pixels,
+              none on the biases and flats.
+
+    drift : shift of the ThAr lines along the orders, in pixels.
+
+    Output:
+    -------
+
+    data, header : the raw frame (uint16, with prescan and overscan) and
+                   its header.
+    """
+    layout = CHIPS[chip]
+    rng = np.random.default_rng(seed)
+    nrows = layout['nrows'] if nrows is None else nrows
+    keywords = dict(KINDS[kind])
+    if exptime is not None:
+        keywords['EXPTIME'] = exptime
+    shape = (nrows, layout['xpix'])
+    norders = max(2, layout['norders'] * nrows // layout['nrows'])
+    centers = order_centers(chip, nrows=nrows, norders=norders)
+    if 'LOW' in mode:
+        centers = centers[:, 1:]
+    blaze = _blaze(layout['xpix'])
+    norders = centers.shape[0]
+    if kind == 'bias':
+        signal = np.zeros(shape)
+    elif kind == 'flat':
+        amplitude = (20000 * blaze
+                     * np.linspace(0.6, 1., norders)[:, None, None])
+        signal = _profile(shape, centers, amplitude, 3.)
+    elif kind == 'thar':
+        lines = [thar_lines(chip, layout['ordershift'] + 1 + o)
+                 for o in range(norders)]
+        spectra = np.stack([_spectrum(c + drift, a, layout['xpix'], 1.5)
+                            for c, a in lines])
+        signal = _profile(shape, centers, 50 + spectra[:, None, :], 3.)
+    else:
+        scale = 3000 if kind == 'science' else 8000
+        continuum = scale * blaze * np.linspace(0.5, 1., norders)[:, None]
+        absorption = np.stack([_lines(rng, 30, layout['xpix'], 3., 0.6)
+                               for _ in range(norders)])
+        obj = continuum * np.clip(1 - absorption, 0.05, None)
+        sky = 0.05 * continuum + np.stack(
+            [_lines(rng, 5, layout['xpix'], 1.5, 500)
+             for _ in range(norders)])
+        amplitude = np.stack([sky, obj], axis=1)[:, -centers.shape[1]:]
+        signal = _profile(shape, centers, amplitude, 3.)
+    if kind != 'bias':
+        signal = rng.poisson(np.clip(signal, 0, None)).astype(np.float64)
+    if cosmics is None:
+        cosmics = 0 if kind in ('bias', 'flat') else signal.size // 10000
+    signal += cosmic_rays(shape, cosmics, rng)
+    signal += layout['bias'] + rng.normal(0, readnoise, shape)
+
+    ncols = layout['prescan'] + layout['xpix'] + layout['overscan']
+    raw = np.full((nrows, ncols), float(layout['bias']))
+    raw += rng.normal(0, readnoise, raw.shape)
+    x1, x2 = layout['prescan'] + 1, layout['prescan'] + layout['xpix']
+    orient(raw, chip, x1, x2)[:] = signal
+    data = np.clip(np.rint(raw), 0, 65535).astype(np.uint16)
+
+    header = fits.Header()
+    header['PROPID'] = keywords['PROPID']
+    header['OBSTYPE'] = keywords['OBSTYPE']
+    header['OBJECT'] = keywords['OBJECT']
+    header['EXPTIME'] = keywords['EXPTIME']
+    header['OBSMODE'] = mode
+    header['DETNAM'] = chip
+    header['DATASEC'] = '[{x1}:{x2},1:{nrows}]'.format(x1=x1, x2=x2,
+                                                       nrows=nrows)
+    header['DATE-OBS'] = date
+    header['TIME-OBS'] = time
+    return data, header
+
+
+def pyhrs_table(chip='HRDET', orders=None):
+    """
+    Table of a pyhrs reduced file, the Order and Wavelength of the pixels.
+    """
+    layout = CHIPS[chip]
+    if orders is None:
+        orders = layout['ordershift'] + 1 + np.arange(layout['norders'])
+    wavelength = np.concatenate([wavelengths(chip, o) for o in orders])
+    order = np.concatenate([np.full(order_length(chip, o), o) for o in orders])
+    return fits.BinTableHDU.from_columns([
+        fits.Column(name='Wavelength', format='D', array=wavelength),
+        fits.Column(name='Flux', format='D', array=np.zeros(len(order))),
+        fits.Column(name='Order', format='I', array=order)])
+
+
+def write_frame(path, kind='flat', **parameters):
+    """
+    Writes a synthetic frame (see frame()) in path. Returns the path.
+    """
+    data, header = frame(kind, **parameters)
+    fits.writeto(str(path), data, header, overwrite=True)
+    return Path(path)
+
+
+def write_night(directory, chips=('HBDET', 'HRDET'), mode='HIGH RESOLUTION',
+                nbias=5, nflat=3, nthar=1, nscience=2, nspecphot=1,
+                nrows=None, date='2017-04-12', pyhrs=True):
+    """
+    Writes the frames of a synthetic night, named like the HRS frames, and
+    their pyhrs files if pyhrs is True. Returns {kind: [files]}.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    night = date.replace('-', '')
+    start = datetime.datetime.strptime(date + ' 18:00:00',
+                                       '%Y-%m-%d %H:%M:%S')
+    files = {kind: [] for kind in KINDS}
+    for c, chip in enumerate(chips):
+        number = 0
+        for kind, count in (('bias', nbias), ('flat', nflat), ('thar', nthar),
+                            ('specphot', nspecphot), ('science', nscience)):
+            for i in range(count):
+                number += 1
+                path = directory / '{letter}{night}{number:04d}.fits'.format(
+                    letter=CHIPS[chip]['letter'], night=night, number=number)
+                moment = start + datetime.timedelta(minutes=10 * number)
+                write_frame(path, kind, chip=chip, mode=mode,
+                            seed=1000 * c + number, nrows=nrows,
+                            date=moment.strftime('%Y-%m-%d'),
+                            time=moment.strftime('%H:%M:%S'))
+                files[kind].append(path)
+                if pyhrs and kind in ('science', 'specphot'):
+                    pyhrsfile = directory / ('p' + path.stem + '_obj.fits')
+                    table = pyhrs_table(chip)
+                    fits.HDUList([fits.PrimaryHDU(), table]).writeto(
+                        str(pyhrsfile), overwrite=True)
+    return files
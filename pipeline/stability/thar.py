@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Wavelength calibration with the ThAr frames.
+
+The lines of the extracted orders (see find_lines()) are matched with a
+line list (see LineList), and one dispersion solution is fitted on all the
+orders of a chip and mode (see WavelengthSolution), once per night.
+"""
+
+# python imports
+from pathlib import Path
+import hashlib
+import logging
+import pickle
+
+# numpy imports
+import numpy as np
+from numpy.polynomial import legendre
+
+# pipeline imports
+from pipeline.stability.instrument import timed
+from pipeline.stability.series import interpolate_peak
+from pipeline.stability.stability import (
+    CHIP_PARAMETERS, getshapes, order_length, pyhrs_wavelengths)
+
+log = logging.getLogger(__name__)
+
+
+def continuum(orders):
+    """
+    Continuum of the extracted lines (nlines x npixels), from the lines of
+    the same fibre in the orders around them (see getshapes()).
+    """
+    orders = np.nan_to_num(np.asarray(orders, dtype=np.float64))
+    n = len(orders)
+    k = np.arange(n)
+    below = np.where(k >= 2, k - 2, np.minimum(k + 4, n - 1))
+    above = np.where(k + 2 < n, k + 2, np.maximum(k - 4, 0))
+    return getshapes(orders[below], orders[above])
+
+
+@timed('find_lines')
+def find_lines(orders, background=None, snr=10., edge=5):
+    """
+    Local maxima of the orders (nlines x npixels) snr times above the noise,
+    once the background is removed. Returns their lines, positions and
+    heights.
+    """
+    orders = np.nan_to_num(np.asarray(orders, dtype=np.float64))
+    if background is None:
+        background = continuum(orders)
+    residual = orders - background
+    differences = np.diff(residual, axis=1)
+    deviations = differences - np.median(differences, axis=1, keepdims=True)
+    noise = 1.4826 * np.median(np.abs(deviations), axis=1)
+    noise /= np.sqrt(2)
+    centre = residual[:, 1:-1]
+    peaks = ((centre > residual[:, :-2]) & (centre >= residual[:, 2:])
+             & (centre > snr * noise[:, None]))
+    peaks[:, :max(edge - 1, 0)] = False
+    if edge > 1:
+        peaks[:, -(edge - 1):] = False
+    lines, columns = np.nonzero(peaks)
+    columns = columns + 1
+    offset = interpolate_peak(residual[lines, columns - 1],
+                              residual[lines, columns],
+                              residual[lines, columns + 1])
+    return lines, columns + offset, residual[lines, columns]
+
+
+class LineList(object):
+    """
+    Reference wavelengths of the ThAr lines, in Angstroms, kept sorted.
+
+    Parameters:
+    -----------
+    wavelengths : wavelengths of the lines.
+
+    intensities : relative intensities of the lines, or None.
+    """
+    def __init__(self,
+                 wavelengths,
+                 intensities=None):
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        order = np.argsort(wavelengths, kind='stable')
+        self.wavelengths = wavelengths[order]
+        self.intensities = None
+        if intensities is not None:
+            intensities = np.asarray(intensities, dtype=np.float64)
+            self.intensities = intensities[order]
+
+    def __len__(self):
+        return len(self.wavelengths)
+
+    @classmethod
+    def read(cls, file):
+        """
+        Reads a text file of wavelengths, and optionally intensities.
+        """
+        table = np.atleast_2d(np.loadtxt(str(file), comments='#', ndmin=2))
+        return cls(table[:, 0], table[:, 1] if table.shape[1] > 1 else None)
+
+    def nearest(self, wavelengths):
+        """
+        Index of the closest line of each wavelength, and the distance to it.
+        """
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        right = np.clip(np.searchsorted(self.wavelengths, wavelengths),
+                        1, len(self.wavelengths) - 1)
+        left = right - 1
+        closer = (np.abs(wavelengths - self.wavelengths[left])
+                  <= np.abs(self.wavelengths[right] - wavelengths))
+        index = np.where(closer, left, right)
+        return index, np.abs(wavelengths - self.wavelengths[index])
+
+
+class WavelengthSolution(object):
+    """
+    Dispersion solution of all the orders of a chip and mode,
+    m * wavelength = sum c_ij P_i(x) P_j(m) with Legendre polynomials.
+
+    Parameters:
+    -----------
+    coefficients : c_ij (degree in x + 1, degree in m + 1).
+
+    xdomain, mdomain : ranges of the pixels and of the orders.
+
+    chip, mode : DETNAM and OBSMODE of the frames.
+
+    rms : standard deviation of the residuals, in Angstroms.
+
+    nlines : number of lines used.
+    """
+    def __init__(self,
+                 coefficients,
+                 xdomain,
+                 mdomain,
+                 chip='',
+                 mode='',
+                 rms=np.nan,
+                 nlines=0):
+        self.coefficients = np.asarray(coefficients, dtype=np.float64)
+        self.xdomain = tuple(float(d) for d in xdomain)
+        self.mdomain = tuple(float(d) for d in mdomain)
+        self.chip = chip
+        self.mode = mode
+        self.rms = rms
+        self.nlines = nlines
+        self._grid = None
+
+    def __repr__(self):
+        return ('Wavelength solution {chip} {mode}: orders {m0:.0f}-{m1:.0f}, '
+                '{n} lines, rms {rms:.4f} A'.format(
+                    chip=self.chip, mode=self.mode, m0=self.mdomain[0],
+                    m1=self.mdomain[1], n=self.nlines, rms=self.rms))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_grid'] = None
+        return state
+
+    @property
+    def key(self):
+        """
+        Checksum of the solution, for the keys of the Cache.
+        """
+        digest = hashlib.sha1(self.coefficients.tobytes())
+        digest.update(repr((self.xdomain, self.mdomain, self.chip,
+                            self.mode)).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _scale(values, domain):
+        values = np.asarray(values, dtype=np.float64)
+        return ((2 * values - (domain[0] + domain[1]))
+                / max(domain[1] - domain[0], 1))
+
+    @classmethod
+    def _design(cls, orders, pixels, degree, xdomain, mdomain):
+        return legendre.legvander2d(cls._scale(pixels, xdomain),
+                                    cls._scale(orders, mdomain), degree)
+
+    def __call__(self, order, pixels):
+        """
+        Wavelengths of the pixels of an order, or of an array of orders.
+        """
+        order = np.asarray(order, dtype=np.float64)
+        pixels = np.asarray(pixels, dtype=np.float64)
+        order, pixels = np.broadcast_arrays(order, pixels)
+        mlambda = legendre.legval2d(self._scale(pixels, self.xdomain),
+                                    self._scale(order, self.mdomain),
+                                    self.coefficients)
+        return mlambda / order
+
+    def grid(self):
+        """
+        Wavelengths of the pixels of every order, {order: wavelengths}.
+        """
+        if self._grid is None:
+            orders = range(int(round(self.mdomain[0])),
+                           int(round(self.mdomain[1])) + 1)
+            self._grid = {o: self(o, np.arange(order_length(self.chip, o)))
+                          for o in orders}
+        return self._grid
+
+    @classmethod
+    def fit(cls, orders, pixels, wavelengths, degree=(4, 4), xdomain=None,
+            mdomain=None, sigma=3., iterations=5, chip='', mode=''):
+        """
+        Fits the solution to lines of known wavelengths, rejecting those
+        beyond sigma. Returns the solution and the mask of the lines used.
+        """
+        orders = np.asarray(orders, dtype=np.float64)
+        pixels = np.asarray(pixels, dtype=np.float64)
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        # The degree in m is lowered when there are not enough orders.
+        mdegree = min(degree[1], max(len(np.unique(orders)) - 1, 0))
+        degree = (int(degree[0]), int(mdegree))
+        if xdomain is None:
+            xdomain = (pixels.min(), pixels.max())
+        if mdomain is None:
+            mdomain = (orders.min(), orders.max())
+        design = cls._design(orders, pixels, degree, xdomain, mdomain)
+        target = orders * wavelengths
+        used = np.ones(len(orders), dtype=bool)
+        if used.sum() <= design.shape[1]:
+            raise ValueError('{n} lines are not enough to fit a solution of '
+                             'degree {degree}'.format(n=used.sum(),
+                                                      degree=degree))
+        for _ in range(iterations):
+            coefficients = np.linalg.lstsq(design[used], target[used],
+                                           rcond=None)[0]
+            residuals = (design @ coefficients - target) / orders
+            rms = np.std(residuals[used])
+            keep = np.abs(residuals) <= sigma * rms
+            if np.array_equal(keep, used) or keep.sum() <= design.shape[1]:
+                break
+            used = keep
+        coefficients = coefficients.reshape(degree[0] + 1, degree[1] + 1)
+        solution = cls(coefficients, xdomain, mdomain, chip=chip, mode=mode,
+                       rms=float(np.std(residuals[used])),
+                       nlines=int(used.sum()))
+        return solution, used
+
+
+def _guess(guess):
+    """
+    Wavelengths of orders and pixels from a WavelengthSolution, or from a
+    dictionary {order: wavelengths}.
+    """
+    if callable(guess):
+        return guess
+
+    def interpolate(orders, pixels):
+        wavelengths = np.full(len(pixels), np.nan)
+        for o in np.unique(orders):
+            if int(o) in guess:
+                table = guess[int(o)]
+                selected = orders == o
+                wavelengths[selected] = np.interp(pixels[selected],
+                                                  np.arange(len(table)),
+                                                  table, left=np.nan,
+                                                  right=np.nan)
+        return wavelengths
+    return interpolate
+
+
+def read_guess(file):
+    """
+    Reads a pickled WavelengthSolution (.pkl), or a pyhrs reduced file.
+    """
+    if Path(file).suffix == '.pkl':
+        with open(str(file), 'rb') as fh:
+            return pickle.load(fh)
+    return pyhrs_wavelengths(file)
+
+
+def fibre_lines(ordershift, fibre='Object'):
+    """
+    Function giving the order of the extracted lines of a fibre, and -1 for
+    those of the other fibre.
+    """
+    parity = 1 if fibre == 'Object' else 0
+
+    def order(lines):
+        lines = np.asarray(lines)
+        return np.where(lines % 2 == parity,
+                        (lines + parity) // 2 + ordershift, -1)
+    return order
+
+
+@timed('wavelength_solution')
+def solve(extracted, linelist, guess, chip, mode='', ordershift=None,
+          fibre='Object', degree=(4, 4), snr=10., tolerances=(3., 1.5, 1.)):
+    """
+    Wavelength solution of extracted ThAr orders (nlines x npixels). The
+    lines are matched with linelist within each of the tolerances (pixels)
+    in turn, starting from guess.
+    """
+    if ordershift is None:
+        ordershift = CHIP_PARAMETERS[chip]['OrderShift']
+    extracted = np.asarray(extracted)
+    lines, positions, heights = find_lines(extracted, snr=snr)
+    orders = fibre_lines(ordershift, fibre)(lines)
+    selected = orders > ordershift
+    orders = orders[selected].astype(np.float64)
+    positions = positions[selected]
+    xdomain = (0, extracted.shape[1] - 1)
+    present = fibre_lines(ordershift, fibre)(np.arange(len(extracted)))
+    present = present[(present > ordershift)
+                      & (np.abs(extracted).sum(axis=1) > 0)]
+    mdomain = (present.min(), present.max())
+    predict = _guess(guess)
+    solution = None
+    for tolerance in tolerances:
+        predicted = predict(orders, positions)
+        dispersion = np.abs(predict(orders, positions + 0.5)
+                            - predict(orders, positions - 0.5))
+        known = np.isfinite(predicted) & np.isfinite(dispersion)
+        index, distance = linelist.nearest(np.where(known, predicted, 0.))
+        matched = known & (distance <= tolerance * dispersion)
+        # One detection per reference line, the closest one.
+        candidates = np.flatnonzero(matched)
+        ranking = candidates[np.lexsort((distance[candidates],
+                                         index[candidates]))]
+        first = np.unique(index[ranking], return_index=True)[1]
+        matched[:] = False
+        matched[ranking[first]] = True
+        log.debug('%d lines matched within %.2f pixels', matched.sum(),
+                  tolerance)
+        solution, used = WavelengthSolution.fit(
+            orders[matched], positions[matched],
+            linelist.wavelengths[index[matched]], degree=degree,
+            xdomain=xdomain, mdomain=mdomain, chip=chip, mode=mode)
+        predict = solution
+    log.info('%r', solution)
+    return solution
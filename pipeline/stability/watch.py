@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reduction of a night while it is observed.
+
+    hrs-watch -d /data/20170412 --calibrations reduced/20170411
+
+The data directory is polled, only the headers of the new files are read
+(see FileIndex.scan()), and the science frames are reduced as soon as they
+are written, with calibrations kept in memory. Until the night has its own,
+those of calibrations are used. The products are those of Night, in the
+same files, so hrs-night completes the night without reducing them again.
+"""
+
+# python imports
+from pathlib import Path
+import argparse
+import logging
+import time
+
+# numpy imports
+import numpy as np
+
+# astropy imports
+from astropy.io import fits
+
+# pipeline imports
+from pipeline.stability.index import FileIndex, default_database
+from pipeline.stability.instrument import instrument
+from pipeline.stability.night import dump, load, merge_stage, normalise_stage
+from pipeline.stability.stability import (
+    HRS, Extract, MappedFrame, Order, append_extraction, classify,
+    extraction_frames, master_bias, master_flat, read_extraction)
+
+log = logging.getLogger(__name__)
+
+COLORS = {'HBDET': 'blue', 'HRDET': 'red'}
+
+
+def complete(record, header):
+    """
+    Tells if a file of the index is at least as large as its header and
+    data.
+    """
+    if header is None or record['size'] is None:
+        return False
+    axes = range(1, header.get('NAXIS', 0) + 1)
+    pixels = np.prod([header.get('NAXIS{n}'.format(n=n), 0) for n in axes])
+    return record['size'] >= 2880 + abs(header.get('BITPIX', 16)) // 8 * pixels
+
+
+def oriented(file):
+    """
+    Data of a master frame, trimmed and oriented like HRS.data.
+    """
+    with MappedFrame(file) as frame:
+        return np.float32(frame[:, :])
+
+
+class Watch(object):
+    """
+    Polls a data directory, and reduces the science frames as they are
+    written.
+
+    Parameters:
+    -----------
+    datadir : directory of the frames, and of the master frames.
+
+    outdir : directory of the products. Defaults to datadir.
+
+    calibrations : directory of the products of another night, used until
+                   the night has its own.
+
+    interval : seconds between two polls.
+
+    settle : seconds a file must not have changed for, before it is reduced.
+
+    order, extract, normalise, merge : keyword arguments of Order, Extract,
+                                       Normalise and merge().
+
+    Usage:
+    ------
+
+    watch = Watch('/data/20170412', calibrations='reduced/20170411')
+    watch.run()
+    """
+    def __init__(self,
+                 datadir,
+                 outdir=None,
+                 calibrations=None,
+                 interval=2.,
+                 settle=2.,
+                 order=None,
+                 extract=None,
+                 normalise=None,
+                 merge=None):
+        self.datadir = Path(datadir)
+        self.outdir = Path(outdir) if outdir is not None else self.datadir
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        self.calibrations = None
+        if calibrations is not None:
+            self.calibrations = Path(calibrations)
+        self.interval = interval
+        self.settle = settle
+        self.options = {
+            'order': dict({'fit': 'batched', 'detection': 'fast'},
+                          **(order or {})),
+            'extract': dict({'sparse': True, 'clipping': 'vectorized'},
+                            **(extract or {})),
+            'normalise': dict({'smoother': 'binned'}, **(normalise or {})),
+            'merge': dict(merge or {})}
+        self.index = FileIndex(default_database(self.datadir))
+        # Frames by kind, and those waiting to be complete or reduced.
+        self.frames = {'bias': {}, 'flat': {}}
+        self.pending = set()
+        self.queue = []
+        # Calibrations in memory, with the time they were made or read.
+        self.masterbias = {}
+        self.orders = {}
+        self.wavelengths = {}
+        self.standards = {}
+        self.unnormalised = {}
+        self._stored = {}
+
+    def nightfile(self, frame, kind='extracted'):
+        return self.outdir / '{night}_{kind}.fits'.format(
+            night=Path(frame).stem[:9], kind=kind)
+
+    def stored(self, file):
+        if file not in self._stored:
+            frames = extraction_frames(file) if file.exists() else []
+            self._stored[file] = set(frames)
+        return self._stored[file]
+
+    def _store(self, file, frame, orders, header=None):
+        append_extraction(file, orders, frame, header=header)
+        self.stored(file).add(frame)
+
+    def _calibration(self, name):
+        # The products of the night come first, then those of the other one.
+        for directory in (self.outdir, self.datadir, self.calibrations):
+            if directory is not None and (directory / name).exists():
+                return directory / name
+        return None
+
+    def _newest(self, files):
+        return max((self.index.record(f)['mtime'] or 0) / 1e9 for f in files)
+
+    def _current(self, target, files):
+        # A product on disk that is newer than all the frames.
+        return target.exists() and (not files or self._newest(files)
+                                    <= target.stat().st_mtime)
+
+    def bias(self, chip):
+        """
+        Master bias of a chip, combined again when biases have been taken
+        since, or None.
+        """
+        files = self.frames['bias'].get(chip, [])
+        current = self.masterbias.get(chip)
+        target = self.datadir / '{color}masterbias.fits'.format(
+            color=COLORS[chip])
+        if current is None and self._current(target, files):
+            current = self.masterbias[chip] = (oriented(target),
+                                               target.stat().st_mtime)
+        if files and (current is None or self._newest(files) > current[1]):
+            with instrument.stage('masterbias'):
+                data, header = master_bias(files)
+            fits.writeto(str(target), data, header, overwrite=True)
+            self.masterbias[chip] = (oriented(target), time.time())
+            log.info('Master bias of %s made with %d biases', chip,
+                     len(files))
+        elif current is None:
+            file = self._calibration(target.name)
+            if file is None:
+                return None
+            self.masterbias[chip] = (oriented(file), file.stat().st_mtime)
+        return self.masterbias[chip][0]
+
+    def order(self, chip, mode):
+        """
+        Order of a chip and mode, found again when flats have been taken
+        since, or None.
+        """
+        key = (chip, mode)
+        files = self.frames['flat'].get(key, [])
+        current = self.orders.get(key)
+        target = self.outdir / 'order_{chip}_{mode}.pkl'.format(chip=chip,
+                                                                mode=mode)
+        if current is None and self._current(target, files):
+            current = self.orders[key] = (load(target),
+                                          target.stat().st_mtime)
+        if files and (current is None or self._newest(files) > current[1]):
+            with instrument.stage('masterflat'):
+                data, header = master_flat(files, self.bias(chip))
+            flatfile = self.datadir / '{color}masterflat_{mode}.fits'.format(
+                color=COLORS[chip], mode=mode)
+            fits.writeto(str(flatfile), data, header, overwrite=True)
+            with HRS(hrsfile=flatfile) as flat:
+                order = Order(hrs=flat, **self.options['order'])
+            dump(order, target)
+            self.orders[key] = (order, time.time())
+            log.info('Order of %s %s found on %d flats', chip, mode,
+                     len(files))
+        elif current is None:
+            file = self._calibration(target.name)
+            if file is None:
+                return None
+            self.orders[key] = (load(file), file.stat().st_mtime)
+        return self.orders[key][0]
+
+    def wavelength(self, chip, mode):
+        """
+        Wavelength solution of a chip and mode, loaded again when its file
+        changes, or None to use the pyhrs files.
+        """
+        key = (chip, mode)
+        file = self._calibration('wavelength_{chip}_{mode}.pkl'.format(
+            chip=chip, mode=mode))
+        if file is None:
+            return None
+        current = self.wavelengths.get(key)
+        if current is None or current[1] != (file, file.stat().st_mtime):
+            self.wavelengths[key] = (load(file),
+                                     (file, file.stat().st_mtime))
+        return self.wavelengths[key][0]
+
+    def poll(self):
+        """
+        Scans the directory once, and reduces the science frames that are
+        ready. Returns the names of the frames reduced.
+        """
+        with instrument.stage('scan'):
+            self.pending.update(self.index.scan(self.datadir, paths=True))
+        now = time.time()
+        for path in sorted(self.pending):
+            record = self.index.record(path)
+            if record is None:
+                self.pending.discard(path)
+                continue
+            header = self.index.header(path)
+            if ((record['mtime'] or 0) / 1e9 > now - self.settle
+                    or not complete(record, header)):
+                continue
+            self.pending.discard(path)
+            if not header.get('NAXIS'):
+                # The products of the night have no image.
+                continue
+            self._classify(Path(path), record)
+        reduced = []
+        waiting = []
+        for path, record in self.queue:
+            try:
+                if self._reduce(path, record):
+                    reduced.append(path.stem)
+                else:
+                    waiting.append((path, record))
+            except Exception:
+                log.exception('%s could not be reduced', path.name)
+        self.queue = waiting
+        return reduced
+
+    def _classify(self, path, record):
+        chip = record['DETNAM']
+        if not chip:
+            chip = 'HBDET' if path.name.startswith('H') else 'HRDET'
+        mode = (record['OBSMODE'] or 'UNKNOWN').split()[0]
+        for kind in classify(record):
+            if kind == 'bias':
+                self.frames['bias'].setdefault(chip, []).append(path)
+            elif kind == 'flat':
+                self.frames['flat'].setdefault((chip, mode), []).append(path)
+            elif kind in ('science', 'specphot'):
+                self.queue.append((path, dict(record, chip=chip, mode=mode,
+                                              kind=kind)))
+            log.info('%s: %s %s %s', path.name, kind, chip, mode)
+
+    def _reduce(self, path, record):
+        """
+        Reduces a science or specphot frame. Returns False if it has to
+        wait for its Order or its wavelengths.
+        """
+        chip, mode, kind = record['chip'], record['mode'], record['kind']
+        frame = path.stem
+        extracted = self.nightfile(path)
+        if frame in self.stored(extracted):
+            orders, header = None, None
+        else:
+            order = self.order(chip, mode)
+            wavelength = self.wavelength(chip, mode)
+            if order is None:
+                return False
+            header = self.index.header(path)
+            # Without a solution, the pyhrs file of the frame is needed.
+            pyhrs = path.parent / ('p' + path.stem + '_obj' + path.suffix)
+            if wavelength is None and not pyhrs.exists():
+                return False
+            start = time.time()
+            # The raw frame is extracted, as in extract_stage() of Night.
+            with instrument.frame(path.name), HRS(hrsfile=path,
+                                                  header=header) as hrs:
+                extract = Extract(order, hrs, extract=True,
+                                  wavelength=wavelength,
+                                  **self.options['extract'])
+            orders = extract.wlcrorders
+            self._store(extracted, frame, orders, header=header)
+            log.info('%s extracted %.1f s after it was written', frame,
+                     time.time() - (record['mtime'] or 0) / 1e9)
+            log.debug('%s reduced in %.2f s', frame, time.time() - start)
+        if kind == 'specphot':
+            if (chip, mode) not in self.standards:
+                if orders is None:
+                    orders = read_extraction(extracted, frame)
+                self.standards[(chip, mode)] = orders
+                # The frames that came before their standard.
+                for other in self.unnormalised.pop((chip, mode), []):
+                    self._normalise(other, chip, mode)
+            return True
+        self._normalise(path, chip, mode, orders, header)
+        return True
+
+    def _normalise(self, path, chip, mode, orders=None, header=None):
+        frame = path.stem
+        normalised = self.nightfile(path, kind='normalised')
+        standard = self.standards.get((chip, mode))
+        if standard is None:
+            self.unnormalised.setdefault((chip, mode), []).append(path)
+            return
+        if frame not in self.stored(normalised):
+            if orders is None:
+                orders, header = read_extraction(self.nightfile(path), frame,
+                                                 header=True)
+            table, header = normalise_stage(path.name, (orders, header),
+                                            standard,
+                                            self.options['normalise'])
+            self._store(normalised, frame, table, header=header)
+        else:
+            table, header = read_extraction(normalised, frame, header=True)
+        merged = self.nightfile(path, kind='merged')
+        if frame not in self.stored(merged):
+            spectrum, header = merge_stage(path.name, (table, header),
+                                           self.options['merge'])
+            self._store(merged, frame, spectrum, header=header)
+
+    def run(self, duration=None):
+        """
+        Polls the directory every interval seconds, for duration seconds or
+        until it is interrupted. Returns the names of the frames reduced.
+        """
+        reduced = []
+        end = time.time() + duration if duration is not None else None
+        try:
+            while end is None or time.time() < end:
+                start = time.time()
+                reduced.extend(self.poll())
+                time.sleep(max(0., self.interval - (time.time() - start)))
+        except KeyboardInterrupt:
+            log.info('Stopped, %d frames reduced', len(reduced))
+        finally:
+            self.index.close()
+        return reduced
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Reduces the HRS frames of a night as they are written')
+    parser.add_argument('-d',
+                        '--datadir',
+                        help='Directory where the frames are written',
+                        default='.')
+    parser.add_argument('-o',
+                        '--outdir',
+                        help='Directory where the products are written. '
+                             'Defaults to datadir',
+                        default=None)
+    parser.add_argument('--calibrations',
+                        help='Products of another night, used until the '
+                             'night has its own',
+                        default=None)
+    parser.add_argument('-i',
+                        '--interval',
+                        type=float,
+                        default=2.,
+                        help='Seconds between two scans of the directory')
+    parser.add_argument('--settle',
+                        type=float,
+                        default=2.,
+                        help='Seconds a file must not have changed for, '
+                             'before it is reduced')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=None,
+                        help='Seconds to watch for. Defaults to until it is '
+                             'interrupted')
+    parser.add_argument('--fit', choices=['astropy', 'batched'],
+                        default='batched')
+    parser.add_argument('--detection', choices=['cwt', 'fast'],
+                        default='fast')
+    parser.add_argument('--clipping', choices=['astropy', 'vectorized'],
+                        default='vectorized')
+    parser.add_argument('--smoother', choices=['lowess', 'binned'],
+                        default='binned')
+    parser.add_argument('-l',
+                        '--log-level',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        default='INFO')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.log_level),
+                        format='%(asctime)s %(name)s %(levelname)s '
+                               '%(message)s')
+    watch = Watch(args.datadir,
+                  outdir=args.outdir,
+                  calibrations=args.calibrations,
+                  interval=args.interval,
+                  settle=args.settle,
+                  order={'fit': args.fit, 'detection': args.detection},
+                  extract={'clipping': args.clipping},
+                  normalise={'smoother': args.smoother})
+    return watch.run(duration=args.duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,14 @@ setup(
         'astropy',
         'scipy',
     ],
+    entry_points={
+        'console_scripts': [
+            'hrs-night = pipeline.stability.night:main',
+            'hrs-drift = pipeline.stability.drift:main',
+            'hrs-rv = pipeline.stability.rv:main',
+            'hrs-watch = pipeline.stability.watch:main',
+        ],
+    },
     include_package_data=True,
     zip_safe=False
 )
\ No newline at end of file
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from pipeline.stability import synthetic
+from pipeline.stability.cache import Cache
+from pipeline.stability.stability import HRS, Extract, Order
+from tests.test_order import fake_flat
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.cache = Cache(self.path / 'cache', maxsize=10 ** 6)
+        self.file = self.path / 'frame.fits'
+        self.file.write_bytes(b'0' * 2880)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_put_get(self):
+        key = self.cache.key('order', files=[self.file], sigma=5.)
+        self.assertNotIn(key, self.cache)
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, np.arange(10))
+        self.assertIn(key, self.cache)
+        np.testing.assert_array_equal(self.cache.get(key), np.arange(10))
+
+    def test_key(self):
+        def order(mode='HIGH', sigma=5.):
+            return self.cache.key('order', files=[self.file],
+                                  header={'OBSMODE': mode},
+                                  keywords=['OBSMODE'], sigma=sigma)
+
+        key = order()
+        self.assertEqual(key, order())
+        self.assertNotEqual(key, order(mode='LOW'))
+        self.assertNotEqual(key, order(sigma=4.))
+        self.assertNotEqual(key, self.cache.key('extract', files=[self.file],
+                                                parents=[key]))
+        self.file.write_bytes(b'1' * 2880)
+        os.utime(str(self.file), ns=(0, 0))
+        self.assertNotEqual(key, order())
+
+    def test_eviction(self):
+        keys = [self.cache.key('extract', frame=i) for i in range(3)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, np.zeros(40000))
+            os.utime(str(self.cache._file(key)), ns=(i, i))
+        # Using the first product makes it the most recent one.
+        self.cache.get(keys[0])
+        self.cache.put(self.cache.key('extract', frame=3), np.zeros(40000))
+        self.assertLessEqual(self.cache.size(), 10 ** 6)
+        self.assertIn(keys[0], self.cache)
+        self.assertNotIn(keys[1], self.cache)
+
+    def test_invalidate(self):
+        order = self.cache.put(self.cache.key('order', sigma=5.), 1)
+        extract = self.cache.put(self.cache.key('extract', parents=[order]), 2)
+        self.cache.invalidate(stage='extract')
+        self.assertIn(order, self.cache)
+        self.assertNotIn(extract, self.cache)
+        self.cache.invalidate()
+        self.assertNotIn(order, self.cache)
+
+    def test_order(self):
+        flat = fake_flat()
+        flat.file = self.file
+        flat.header = {'OBSMODE': flat.mode}
+        with contextlib.redirect_stdout(io.StringIO()):
+            first = Order(flat, fit='batched', detection='fast',
+                          cache=self.cache)
+            with mock.patch.object(Order, 'find_peaks',
+                                   side_effect=AssertionError):
+                second = Order(flat, fit='batched', detection='fast',
+                               cache=self.cache)
+        self.assertEqual(first.cachekey, second.cachekey)
+        np.testing.assert_array_equal(first.extracted, second.extracted)
+
+    def test_extract(self):
+        # A cached extraction leaves the Extract as computing it does.
+        self.cache.maxsize = 10 ** 8
+        files = synthetic.write_night(self.path, chips=('HBDET',), nbias=0,
+                                      nflat=1, nthar=0, nscience=1,
+                                      nspecphot=0, nrows=1024)
+        with HRS(hrsfile=files['flat'][0]) as flat:
+            order = Order(hrs=flat, fit='batched', detection='fast',
+                          cache=self.cache)
+        for extract in (False, True):
+            with HRS(hrsfile=files['science'][0]) as hrs:
+                first = Extract(order, hrs, extract=extract, sparse=True,
+                                cache=self.cache)
+            with HRS(hrsfile=files['science'][0]) as hrs:
+                with mock.patch.object(Extract, 'extraction',
+                                       side_effect=AssertionError):
+                    second = Extract(order, hrs, extract=extract,
+                                     sparse=True, cache=self.cache)
+            np.testing.assert_array_equal(first.orders, second.orders)
+            if extract:
+                pd.testing.assert_frame_equal(first.worders, second.worders)
+                pd.testing.assert_frame_equal(first.wlcrorders,
+                                              second.wlcrorders)
+            else:
+                self.assertIsNone(first.worders)
+                self.assertIsNone(second.worders)
+
+
+if __name__ == '__main__':
+    unittest.main()
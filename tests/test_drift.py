@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import os
+import pickle
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.stability import synthetic
+from pipeline.stability.drift import (Drift, DriftSeries, cross_correlate,
+                                      fibres, main, thar_frames)
+from pipeline.stability.stability import HRS, Order
+
+
+def lines(shift=0., norders=6, npixels=2048, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.arange(npixels)
+    orders = np.full((norders, npixels), 100.)
+    for o in range(norders):
+        centers = rng.uniform(50, npixels - 50, 40)
+        for c, a in zip(centers, rng.uniform(1000, 20000, 40)):
+            orders[o] += a * np.exp(-0.5 * ((x - c - shift) / 1.5) ** 2)
+    return orders
+
+
+class TestCrossCorrelate(unittest.TestCase):
+
+    def test_subpixel(self):
+        reference = lines()
+        frames = np.stack([lines(shift) for shift in (0., 0.37, -2.81, 6.5)])
+        shifts, peaks = cross_correlate(frames, reference)
+        self.assertEqual(shifts.shape, (4, 6))
+        expected = np.repeat([[0.], [0.37], [-2.81], [6.5]], 6, axis=1)
+        np.testing.assert_allclose(shifts, expected, atol=0.01)
+        self.assertTrue(np.all(peaks > 0.95))
+
+    def test_empty(self):
+        reference = lines()
+        frame = lines(1.2)
+        frame[2] = 0.
+        shifts, peaks = cross_correlate(frame, reference, maxshift=5.)
+        self.assertTrue(np.isnan(shifts[2]) and np.isnan(peaks[2]))
+        # Beyond maxshift, nothing is found.
+        shifts, peaks = cross_correlate(lines(8.), reference, maxshift=5.)
+        self.assertTrue(np.all(np.isnan(shifts)))
+
+    def test_fibres(self):
+        obj, sky = fibres(np.arange(9.))
+        np.testing.assert_array_equal(obj, [1, 3, 5, 7])
+        np.testing.assert_array_equal(sky, [2, 4, 6, 8])
+
+
+class TestDrift(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        flat = synthetic.write_frame(self.path / 'H201704120001.fits', 'flat',
+                                     chip='HBDET', nrows=512)
+        with HRS(flat) as hrs, contextlib.redirect_stdout(io.StringIO()):
+            order = Order(hrs=hrs, fit='batched', detection='fast')
+        self.orderfile = self.path / 'order_HBDET_HIGH.pkl'
+        with open(str(self.orderfile), 'wb') as fh:
+            pickle.dump(order, fh)
+        self.drifts = [0.6, 0., -1.3]
+        # Written in another order than the time of the frames.
+        times = ('21:00:00', '19:00:00', '20:00:00')
+        for number, drift, time in zip((4, 2, 3), self.drifts, times):
+            name = 'H20170412000{n}.fits'.format(n=number)
+            synthetic.write_frame(self.path / name, 'thar', chip='HBDET',
+                                  nrows=512, seed=number, drift=drift,
+                                  time=time)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_measure(self):
+        files = thar_frames([self.path])[('HBDET', 'HIGH')]
+        frames = ['H201704120002', 'H201704120003', 'H201704120004']
+        self.assertEqual([f.stem for f in files], frames)
+        drift = Drift(self.orderfile, self.path / 'drift.fits', batch=2)
+        self.assertEqual(drift.measure(files), 3)
+        series = drift.series.read()
+        self.assertEqual(list(series.File), frames)
+        np.testing.assert_allclose(series.Drift, [0., -1.3, 0.6], atol=0.02)
+        self.assertEqual(drift.series.reference()[1], 'H201704120002')
+        shifts = drift.series.shifts('Sky')
+        self.assertEqual(shifts.columns[0], 84)
+        np.testing.assert_allclose(shifts.median(axis=1), [0., -1.3, 0.6],
+                                   atol=0.02)
+        # The frames that are in the series are not measured again.
+        again = Drift(self.orderfile, self.path / 'drift.fits')
+        self.assertEqual(again.measure(files), 0)
+
+    def test_dates(self):
+        self.assertEqual(thar_frames([self.path], start='2017-04-13'), {})
+        frames = thar_frames([self.path], end='2017-04-12')
+        self.assertEqual(len(frames[('HBDET', 'HIGH')]), 3)
+
+    def test_reference(self):
+        # A reference given relative to another directory is found, one that
+        # is not a ThAr frame is an error.
+        reference = os.path.relpath(str(self.path / 'H201704120003.fits'))
+        argv = ['-d', str(self.path), '-o', str(self.path),
+                '--orders', str(self.path), '-w', '0', '-l', 'ERROR']
+        self.assertEqual(main(argv + ['--reference', reference]),
+                         {('HBDET', 'HIGH'): 3})
+        series = DriftSeries(self.path / 'drift_HBDET_HIGH.fits')
+        self.assertEqual(series.reference()[1], 'H201704120003')
+        flat = str(self.path / 'H201704120001.fits')
+        with self.assertRaises(SystemExit):
+            with contextlib.redirect_stderr(io.StringIO()):
+                main(argv + ['--reference', flat])
+
+    def test_new_series(self):
+        with self.assertRaises(ValueError):
+            DriftSeries(self.path / 'drift.fits').append(
+                {c: [] for c in DriftSeries.columns})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import pathlib
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from pipeline.stability.stability import (
+    Extract, ExtractionOperator, TraceModel, append_extraction, clip_cosmics,
+    extraction_frames, pyhrs_wavelengths, read_extraction)
+
+
+def fake_positions(norders=12, ncols=1024, step=50, halfwidth=8.3):
+    X = step * (np.arange(ncols // step - 1) + 1)
+    positions = np.zeros((norders, len(X), 3))
+    for o in range(norders):
+        center = 30 + 45 * o + 10 * np.sin(X / ncols * 3) + 0.002 * X
+        positions[o, :, 0] = center - halfwidth
+        positions[o, :, 1] = center
+        positions[o, :, 2] = center + halfwidth
+    return positions
+
+
+class TestExtractionOperator(unittest.TestCase):
+
+    def setUp(self):
+        self.step = 50
+        self.positions = fake_positions(step=self.step)
+        self.trace = TraceModel(self.positions, self.step)
+        self.data = np.random.default_rng(1).normal(100, 10, (600, 1024))
+
+    def test_matches_column_extraction(self):
+        orderposition = types.SimpleNamespace(step=self.step, trace=self.trace)
+        hrs = types.SimpleNamespace(mode='MEDIUM', data=self.data)
+        with contextlib.redirect_stdout(io.StringIO()):
+            reference = Extract(orderposition=orderposition,
+                                hrsscience=hrs).orders
+        operator = ExtractionOperator.from_trace(
+            self.trace, self.data.shape, mode='MEDIUM', fractional=False)
+        np.testing.assert_allclose(operator(self.data), reference)
+
+    def test_fractional_weights(self):
+        operator = ExtractionOperator.from_trace(self.trace, self.data.shape)
+        flat = operator(np.ones_like(self.data))
+        # The first two orders are not extracted, the others get the exact
+        # width of the order.
+        np.testing.assert_allclose(flat[:2], 0)
+        np.testing.assert_allclose(flat[2:], 16.6)
+
+    def test_stack(self):
+        operator = ExtractionOperator.from_trace(self.trace, self.data.shape)
+        stack = operator(np.stack([self.data, 2 * self.data]))
+        self.assertEqual(stack.shape, (2, 12, 1024))
+        np.testing.assert_allclose(stack[1], 2 * operator(self.data))
+
+
+class TestTraceModel(unittest.TestCase):
+
+    def setUp(self):
+        self.positions = fake_positions(norders=40)
+        self.x = 50 * (np.arange(self.positions.shape[1]) + 1)
+
+    def test_fit(self):
+        trace = TraceModel(self.positions, 50)
+        np.testing.assert_allclose(trace(self.x), self.positions, atol=0.05)
+        self.assertEqual(trace.grid(1024).shape, (40, 1024, 3))
+
+    def test_outliers(self):
+        positions = self.positions.copy()
+        positions[15, 3] += 40
+        positions[17] = np.nan
+        trace = TraceModel(positions, 50)
+        np.testing.assert_allclose(trace(self.x), self.positions, atol=0.05)
+
+
+class TestCosmicRays(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        tables = []
+        for order, length in ((53, 3269), (54, 4040), (55, 4040)):
+            sky, obj = rng.normal(100, 5, length), rng.normal(1000, 30, length)
+            sky[rng.integers(0, length, 10)] += 500
+            obj[rng.integers(0, length, 10)] += 5000
+            tables.append(pd.DataFrame({'Wavelength': np.arange(length),
+                                        'Object': obj,
+                                        'Sky': sky,
+                                        'Order': order}))
+        self.orders = pd.concat(tables, ignore_index=True)
+
+    def clipped(self, clipping):
+        extract = Extract.__new__(Extract)
+        extract.clipping = clipping
+        return extract._cosmicrays(self.orders)
+
+    def test_vectorized(self):
+        clipped = self.clipped('vectorized')
+        self.assertEqual(list(clipped.columns[-2:]),
+                         ['CosmicRaysSky', 'CosmicRaysObject'])
+        self.assertGreaterEqual(clipped.CosmicRaysSky.isna().sum(), 30)
+        self.assertLess(np.nanmax(clipped.CosmicRaysObject), 1300)
+        np.testing.assert_array_equal(clipped.Sky, self.orders.Sky)
+
+    def test_matches_sigma_clip(self):
+        reference = self.clipped('astropy')
+        cube = np.full((3, 4040), np.nan)
+        for i, order in enumerate((53, 54, 55)):
+            values = self.orders.Object[self.orders.Order == order].values
+            cube[i, :len(values)] = values
+        mask = clip_cosmics(cube, std='std')
+        np.testing.assert_array_equal(
+            mask[np.isfinite(cube)], reference.CosmicRaysObject.isna().values)
+
+
+class TestWavelength(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        directory = pathlib.Path(self.tmp.name)
+        # The pyhrs table has one row per pixel, the orders are not contiguous.
+        orders = np.concatenate([np.full(3269, 53), np.full(4040, 55),
+                                 np.full(4040, 54), np.full(100, 56)])
+        wavelength = np.arange(len(orders), dtype=np.float64)
+        table = fits.BinTableHDU.from_columns([
+            fits.Column(name='Wavelength', format='D', array=wavelength),
+            fits.Column(name='Order', format='I', array=orders)])
+        pyhrsfile = directory / 'pR201701010001_obj.fits'
+        fits.HDUList([fits.PrimaryHDU(), table]).writeto(str(pyhrsfile))
+        self.orders, self.wavelength = orders, wavelength
+        self.extract = Extract.__new__(Extract)
+        self.extract.hrsfile = types.SimpleNamespace(
+            file=directory / 'R201701010001.fits', chip='HRDET', ordershift=52)
+        self.extracted = np.random.default_rng(0).normal(size=(12, 4096))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_columns(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            dex = self.extract._wavelength(self.extracted)
+        self.assertEqual(list(dex.columns),
+                         ['Wavelength', 'Object', 'Sky', 'Order'])
+        # Order 56 does not have the length of the extraction, it is skipped.
+        self.assertEqual(list(dex.Order.unique()), [55, 54, 53])
+        self.assertEqual(len(dex), 3269 + 2 * 4040)
+        for o, length in ((53, 3269), (54, 4040), (55, 4040)):
+            part = dex[dex.Order == o]
+            line = 2 * (o - 52)
+            np.testing.assert_array_equal(part.Wavelength,
+                                          self.wavelength[self.orders == o])
+            np.testing.assert_array_equal(part.Sky,
+                                          self.extracted[line, :length])
+            np.testing.assert_array_equal(part.Object,
+                                          self.extracted[line - 1, :length])
+
+    def test_cached(self):
+        pyhrsfile = self.extract._pyhrsfile()
+        first = pyhrs_wavelengths(pyhrsfile)
+        with mock.patch('pipeline.stability.stability.fits.open') as opened:
+            self.assertIs(pyhrs_wavelengths(pyhrsfile), first)
+        opened.assert_not_called()
+
+    def test_missing(self):
+        hrsfile = self.extract.hrsfile
+        hrsfile.file = hrsfile.file.with_name('R201701010002.fits')
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(self.extract._wavelength(self.extracted))
+
+
+class TestBinaryOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = pathlib.Path(self.tmp.name) / 'R20170101_extracted.fits'
+        rng = np.random.default_rng(5)
+        tables = []
+        for order, length in ((55, 4040), (54, 4040), (53, 3269)):
+            sky, obj = rng.normal(100, 5, length), rng.normal(1000, 30, length)
+            tables.append(pd.DataFrame({
+                'Wavelength': 5000. + order + np.arange(length) / 100,
+                'Object': obj,
+                'Sky': sky,
+                'Order': order,
+                'CosmicRaysSky': np.where(sky > 110, np.nan, sky),
+                'CosmicRaysObject': obj}))
+        self.orders = pd.concat(tables, ignore_index=True)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        header = fits.Header({'OBJECT': 'HD 1', 'DATE-OBS': '2017-01-01'})
+        append_extraction(self.file, self.orders, 'R201701010001',
+                          header=header)
+        pd.testing.assert_frame_equal(
+            read_extraction(self.file, 'R201701010001'), self.orders)
+        header = fits.getheader(str(self.file), 'R201701010001')
+        self.assertEqual(header['OBJECT'], 'HD 1')
+
+    def test_append(self):
+        append_extraction(self.file, self.orders, 'R201701010001')
+        second = self.orders.assign(Object=self.orders.Object * 2)
+        append_extraction(self.file, second, 'R201701010002')
+        frames = ['R201701010001', 'R201701010002']
+        self.assertEqual(extraction_frames(self.file), frames)
+        pd.testing.assert_frame_equal(
+            read_extraction(self.file, 'R201701010002'), second)
+        # Saving a frame again replaces its table.
+        append_extraction(self.file, second, 'R201701010001')
+        self.assertEqual(extraction_frames(self.file), frames)
+        pd.testing.assert_frame_equal(
+            read_extraction(self.file, 'R201701010001'), second)
+
+    def test_save(self):
+        extract = Extract.__new__(Extract)
+        extract.output = 'fits'
+        extract.wlcrorders = self.orders
+        extract.hrsfile = types.SimpleNamespace(
+            file=pathlib.Path('R201701010003.fits'), header=fits.Header(),
+            chip='HRDET', name='HD 1')
+        with contextlib.redirect_stdout(io.StringIO()):
+            extract.save(file=self.file)
+        self.assertEqual(extraction_frames(self.file), ['R201701010003'])
+
+
+if __name__ == '__main__':
+    unittest.main()
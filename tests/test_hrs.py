@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import copy
+import pickle
+import tempfile
+import tracemalloc
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from astropy.io import fits
+from astropy.visualization import ZScaleInterval
+
+from pipeline.stability import stability
+from pipeline.stability.stability import HRS
+
+
+def write_frame(path, chip='HBDET', dtype=np.float32, nrows=64):
+    header = fits.Header()
+    header['DATASEC'] = '[5:74,1:{nrows}]'.format(nrows=nrows)
+    header['DETNAM'] = chip
+    header['OBSMODE'] = 'HIGH RESOLUTION'
+    header['OBSTYPE'] = 'Science'
+    header['OBJECT'] = 'HD 1234'
+    data = np.random.default_rng(0).normal(1000, 10, (nrows, 80)).astype(dtype)
+    fits.writeto(str(path), data, header, overwrite=True)
+    return data
+
+
+class TestHRS(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = Path(self.tmp.name) / 'H201704120001.fits'
+        self.raw = write_frame(self.file)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_header_only(self):
+        with mock.patch.object(stability.fits, 'open',
+                               side_effect=AssertionError):
+            hrs = HRS(self.file)
+            self.assertEqual(hrs.shape, (64, 70))
+            self.assertEqual(hrs.name, 'HD 1234')
+        header = hrs.header
+        with mock.patch.object(stability, 'read_header',
+                               side_effect=AssertionError):
+            self.assertEqual(HRS(self.file, header=header).chip, 'HBDET')
+
+    def test_lazy_data(self):
+        with HRS(self.file) as hrs:
+            self.assertIsNone(hrs._hdulist)
+            np.testing.assert_array_equal(hrs.data, self.raw[::-1, 4:74])
+            # The orientation is a view of the memory-mapped data.
+            self.assertTrue(np.shares_memory(hrs.data, hrs.hdulist[0].data))
+            self.assertEqual(hrs.data.shape, hrs.shape)
+        self.assertIsNone(hrs._hdulist)
+        self.assertIsNone(hrs._data)
+
+    def test_statistics(self):
+        trimmed = self.raw[:, 4:74]
+        with HRS(self.file) as hrs:
+            self.assertAlmostEqual(hrs.mean, trimmed.mean(), places=3)
+            self.assertAlmostEqual(hrs.std, trimmed.std(), places=3)
+            np.testing.assert_allclose((hrs.dataminzs, hrs.datamaxzs),
+                                       ZScaleInterval().get_limits(hrs.data))
+            hrs.data = hrs.data + 100
+            self.assertAlmostEqual(hrs.mean, trimmed.mean() + 100, places=3)
+
+    def test_pickle(self):
+        hrs = HRS(self.file)
+        hrs.data
+        copy = pickle.loads(pickle.dumps(hrs))
+        self.assertIsNone(copy._data)
+        np.testing.assert_array_equal(copy.data, hrs.data)
+        hrs.close()
+        copy.close()
+
+
+class TestArithmetic(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = Path(self.tmp.name) / 'H201704120001.fits'
+        write_frame(self.file, dtype=np.int16, nrows=1024)
+        self.hrs = HRS(self.file)
+        self.reference = np.array(self.hrs.data)
+
+    def tearDown(self):
+        self.hrs.close()
+        self.tmp.cleanup()
+
+    def test_operators(self):
+        other = copy.copy(self.hrs)
+        other.data = np.full(self.hrs.shape, 1005, dtype=np.int16)
+        difference = self.hrs - other
+        expected = np.clip(self.reference.astype(float) - 1005, 0, None)
+        expected = expected.astype(np.int16)
+        np.testing.assert_array_equal(difference.data, expected)
+        self.assertEqual(difference.data.dtype, self.reference.dtype)
+        np.testing.assert_array_equal((self.hrs + 5).data, self.reference + 5)
+        np.testing.assert_allclose((self.hrs / 2).data, self.reference / 2)
+        np.testing.assert_array_equal(self.hrs.data, self.reference)
+
+    def test_inplace(self):
+        hrs = self.hrs
+        data = hrs._writable()
+        before = hrs.mean
+        tracemalloc.start()
+        hrs -= 990
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertIs(hrs.data, data)
+        # The old operators made several float64 copies of the frame.
+        self.assertLess(peak, data.size * 8)
+        expected = np.clip(self.reference - 990, 0, None)
+        np.testing.assert_array_equal(hrs.data, expected)
+        self.assertNotAlmostEqual(hrs.mean, before)
+        hrs /= 2
+        self.assertEqual(hrs.data.dtype, np.float32)
+        np.testing.assert_allclose(hrs.data, expected / 2)
+
+    def test_divide(self):
+        # / and /= give the same frame.
+        flat = np.linspace(0.5, 1.5, self.hrs.shape[1])
+        divided = self.hrs / flat
+        self.hrs /= flat
+        self.assertEqual(divided.data.dtype, self.hrs.data.dtype)
+        np.testing.assert_array_equal(divided.data, self.hrs.data)
+
+    def test_out(self):
+        out = np.empty(self.hrs.shape, dtype=np.float32)
+        result = self.hrs.subtract(1000., out=out, clip=False)
+        self.assertIs(result.data, out)
+        np.testing.assert_allclose(out, self.reference - 1000.)
+
+    def test_calibrate(self):
+        bias = np.full(self.hrs.shape, 995.)
+        flat = np.linspace(0.5, 1.5, self.hrs.shape[1])
+        calibrated = self.hrs.calibrate(bias, flat, rows=7)
+        self.assertEqual(calibrated.data.dtype, np.float32)
+        expected = np.clip(self.reference - 995., 0, None) / flat
+        np.testing.assert_allclose(calibrated.data, expected, rtol=1e-6)
+        # In place, on a floating point frame.
+        data = self.hrs._writable(np.float32)
+        self.assertIs(self.hrs.calibrate(bias, flat, out=data).data, data)
+        np.testing.assert_allclose(data, calibrated.data, rtol=1e-6)
+        with self.assertRaises(ValueError):
+            self.hrs.calibrate(bias,
+                               out=np.empty(self.hrs.shape, dtype=np.int32))
+
+    def test_calibrate_file(self):
+        # An unsigned frame is stored with BZERO, astropy would scale a copy
+        # of it.
+        file = Path(self.tmp.name) / 'H201704120002.fits'
+        raw = write_frame(file, dtype=np.uint16)
+        bias = np.full((64, 70), 995.)
+        flat = np.linspace(0.5, 1.5, 70)
+        expected = np.clip(raw[::-1, 4:74] - 995., 0, None) / flat
+        with HRS(file) as hrs:
+            calibrated = hrs.calibrate(bias, flat, rows=5)
+            self.assertIsNone(hrs._data)
+        self.assertEqual(calibrated.data.dtype, np.float32)
+        np.testing.assert_allclose(calibrated.data, expected, rtol=1e-6)
+        out = np.empty((64, 70), dtype=np.float32)
+        self.assertIs(stability.calibrate_frame(file, bias, flat, out=out),
+                      out)
+        np.testing.assert_allclose(out, expected, rtol=1e-6)
+        with self.assertRaises(ValueError):
+            stability.calibrate_frame(file, out=np.empty((70, 64),
+                                                         dtype=np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
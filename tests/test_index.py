@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from astropy.io import fits
+
+from pipeline.stability import index
+from pipeline.stability.index import FileIndex, read_header
+from pipeline.stability.stability import ListOfFiles
+
+
+def write_frame(path, propid, **keywords):
+    header = fits.Header()
+    header['PROPID'] = propid
+    header['DATE-OBS'] = '2017-04-12'
+    header['TIME-OBS'] = '20:00:00'
+    for key, value in keywords.items():
+        header[key] = value
+    fits.writeto(str(path), np.zeros((10, 10), dtype=np.int16), header,
+                 overwrite=True)
+
+
+class TestFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        write_frame(self.path / 'H201704120001.fits', 'CAL_BIAS')
+        write_frame(self.path / 'R201704120002.fits', 'CAL_FLAT',
+                    OBSMODE='HIGH RESOLUTION')
+        write_frame(self.path / 'H201704120003.fits', 'CAL_STABLE')
+        write_frame(self.path / 'R201704120004.fits', '2017-1-SCI-001')
+        (self.path / 'pR201704120004_obj.fits').write_bytes(b'')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_header(self):
+        header = read_header(self.path / 'R201704120002.fits')
+        self.assertEqual(header['OBSMODE'], 'HIGH RESOLUTION')
+        self.assertNotIn('XTENSION', header)
+
+    def test_incremental(self):
+        database = self.path / 'index.sqlite'
+        with FileIndex(database) as fi:
+            self.assertEqual(fi.scan(self.path), 4)
+            self.assertEqual(fi.scan(self.path), 0)
+            write_frame(self.path / 'H201704120005.fits', 'CAL_BIAS')
+            os.remove(str(self.path / 'H201704120003.fits'))
+            self.assertEqual(fi.scan(self.path), 1)
+            self.assertEqual(len(fi.records(self.path)), 4)
+        # The index persists between runs.
+        with FileIndex(database) as fi:
+            self.assertEqual(fi.scan(self.path), 0)
+            header = fi.header(self.path / 'R201704120002.fits')
+            self.assertEqual(header['OBSMODE'], 'HIGH RESOLUTION')
+
+    def test_listoffiles(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            lof = ListOfFiles(self.path)
+
+            def names(files):
+                return [f.name for f in files]
+
+            self.assertEqual(names(lof.bias), ['H201704120001.fits'])
+            self.assertEqual(names(lof.flat), ['R201704120002.fits'])
+            self.assertEqual(names(lof.thar), ['H201704120003.fits'])
+            self.assertEqual(names(lof.science), ['R201704120004.fits'])
+            self.assertEqual(names(lof.object), ['pR201704120004_obj.fits'])
+            # Building it again does not read any header.
+            with mock.patch.object(index, 'read_header',
+                                   side_effect=AssertionError):
+                ListOfFiles(self.path)
+            write_frame(self.path / 'redmasterbias.fits', 'CAL_BIAS')
+            lof.update(self.path / 'redmasterbias.fits')
+        self.assertEqual(lof.bias[-1].name, 'redmasterbias.fits')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import json
+import pathlib
+import tempfile
+import tracemalloc
+import unittest
+
+import numpy as np
+
+from pipeline.stability.instrument import Instrument
+
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_stages(self):
+        instrument = Instrument()
+        with instrument.frame('R201701010001.fits'):
+            with instrument.stage('extract'):
+                with instrument.stage('cosmicrays'):
+                    sum(range(10000))
+        records = instrument.report('R201701010001.fits')['stages']
+        self.assertEqual([r['stage'] for r in records],
+                         ['total/extract/cosmicrays', 'total/extract',
+                          'total'])
+        for record in records:
+            self.assertGreaterEqual(record['wall'], 0)
+            self.assertGreaterEqual(record['cpu'], 0)
+            self.assertIsNone(record['peak'])
+
+    def test_outside_frame(self):
+        instrument = Instrument()
+        with instrument.stage('find_peaks'):
+            pass
+        self.assertEqual(instrument.records, {})
+
+    def test_memory(self):
+        instrument = Instrument(memory=True)
+        with instrument.frame('R201701010001.fits'):
+            with instrument.stage('small'):
+                np.ones(1000)
+            with instrument.stage('large'):
+                np.ones(10 ** 6)
+        report = instrument.report('R201701010001.fits')
+        records = {r['stage']: r for r in report['stages']}
+        self.assertGreaterEqual(records['total/large']['peak'], 8 * 10 ** 6)
+        self.assertLess(records['total/small']['peak'], 10 ** 5)
+        self.assertGreaterEqual(records['total']['peak'],
+                                records['total/large']['peak'])
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_write(self):
+        instrument = Instrument(profile=True)
+        with instrument.frame('R201701010001.fits'):
+            with instrument.stage('extract'):
+                pass
+        files = instrument.write(self.path)
+        self.assertEqual(sorted(f.name for f in files),
+                         ['R201701010001.prof', 'R201701010001.timing.json'])
+        self.assertEqual(instrument.records, {})
+        # A stage of the same frame run later (in another process) is added
+        # to the report.
+        with instrument.frame('R201701010001.fits'):
+            with instrument.stage('normalise'):
+                pass
+        instrument.write(self.path)
+        with open(str(self.path / 'R201701010001.timing.json')) as fh:
+            report = json.load(fh)
+        self.assertEqual([s['stage'] for s in report['stages']],
+                         ['total/extract', 'total', 'total/normalise',
+                          'total'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import tempfile
+import tracemalloc
+import unittest
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from pipeline.stability.stability import (HRS, ListOfFiles, MappedFrame,
+                                          Master, combine)
+
+
+def write_bias(path, chip, seed, shape=(64, 80), propid='CAL_BIAS', level=0,
+               exptime=0.):
+    header = fits.Header()
+    header['PROPID'] = propid
+    header['EXPTIME'] = exptime
+    header['DATE-OBS'] = '2017-04-12'
+    header['TIME-OBS'] = '20:00:00'
+    header['DATASEC'] = '[5:74,1:64]'
+    header['DETNAM'] = chip
+    header['OBSMODE'] = 'HIGH RESOLUTION'
+    header['OBSTYPE'] = 'Bias'
+    header['OBJECT'] = 'Bias' if propid == 'CAL_BIAS' else 'Flat field'
+    data = np.random.default_rng(seed).normal(900 + level, 5, shape)
+    data = data.astype(np.uint16)
+    data[seed % shape[0], 10] = 60000
+    fits.writeto(str(path), data, header, overwrite=True)
+
+
+class TestMasterBias(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        for i in range(5):
+            blue = 'H2017041200{i:02d}.fits'.format(i=i)
+            red = 'R2017041200{i:02d}.fits'.format(i=i + 10)
+            write_bias(self.path / blue, 'HBDET', i)
+            write_bias(self.path / red, 'HRDET', i + 10)
+        self.blue = sorted(self.path.glob('H*.fits'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_mapped_frame(self):
+        with MappedFrame(self.blue[0]) as frame:
+            with contextlib.redirect_stdout(io.StringIO()):
+                hrs = HRS(self.blue[0])
+            np.testing.assert_array_equal(frame[:, :], hrs.data)
+            self.assertEqual(frame.shape, (64, 70))
+
+    def test_combine(self):
+        frames = [MappedFrame(b) for b in self.blue]
+        stack = np.stack([f[:, :] for f in frames])
+        # A tiny memory budget forces the combination one row at a time.
+        np.testing.assert_allclose(combine(frames, memory=1),
+                                   stack.mean(axis=0), rtol=1e-6)
+        np.testing.assert_allclose(combine(frames, method='median'),
+                                   np.median(stack, axis=0))
+        clipped = combine(frames, method='sigmaclip', sigma=2.)
+        self.assertLess(clipped.max(), 1000)
+        for frame in frames:
+            frame.close()
+
+    def test_memory(self):
+        frames = [MappedFrame(b) for b in self.blue]
+        tracemalloc.start()
+        combine(frames, memory=30000)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(peak, 30000 + 2 * 64 * 70 * 4)
+        for frame in frames:
+            frame.close()
+
+    def test_makemasterbias(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            lof = ListOfFiles(self.path)
+            Master.makemasterbias(lof, method='median')
+        biases = np.stack([MappedFrame(b)[:, :] for b in self.blue])
+        expected = np.median(biases, axis=0)
+        # The master bias is in the layout of the raw frames, HRS trims and
+        # orients it like a bias.
+        raw = fits.getdata(str(self.path / 'bluemasterbias.fits'))
+        self.assertEqual(raw.shape, (64, 80))
+        with contextlib.redirect_stdout(io.StringIO()):
+            master = HRS(self.path / 'bluemasterbias.fits')
+            bias = HRS(self.blue[0])
+        self.assertEqual(master.data.shape, bias.data.shape)
+        self.assertEqual(master.data.dtype.kind, 'f')
+        self.assertEqual(master.data.dtype.itemsize, 4)
+        np.testing.assert_allclose(master.data, expected, rtol=1e-6)
+        self.assertIn(self.path / 'redmasterbias.fits', lof.bias)
+
+
+class TestMasterFlat(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        for i in range(5):
+            blue = 'H2017041200{i:02d}.fits'.format(i=i)
+            red = 'R2017041200{i:02d}.fits'.format(i=i + 10)
+            write_bias(self.path / blue, 'HBDET', i)
+            write_bias(self.path / red, 'HRDET', i + 10)
+        for i in range(3):
+            flat = 'H2017041201{i:02d}.fits'.format(i=i)
+            write_bias(self.path / flat, 'HBDET', i + 20, propid='CAL_FLAT',
+                       level=1000 * (i + 1), exptime=i + 1.)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_makemasterflat(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            lof = ListOfFiles(self.path)
+            Master.makemasterbias(lof)
+            Master.makemasterflat(lof, memory=1)
+            masterflat = HRS(self.path / 'bluemasterflat_HIGH.fits')
+        masterbias = MappedFrame(self.path / 'bluemasterbias.fits')[:, :]
+        flats = sorted(self.path.glob('H20170412010*.fits'))
+        normalised = [(MappedFrame(f)[:, :] - masterbias) / (i + 1)
+                      for i, f in enumerate(flats)]
+        expected = np.median(np.stack(normalised), axis=0)
+        np.testing.assert_allclose(masterflat.data, expected, rtol=1e-5)
+        self.assertEqual(masterflat.name, 'Flat field')
+        self.assertIn(self.path / 'bluemasterflat_HIGH.fits', lof.flat)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from pipeline.stability import synthetic
+from pipeline.stability.merge import MergeOperator, log_grid, merge, taper
+from pipeline.stability.night import Night
+from pipeline.stability.stability import append_extraction, read_extraction
+
+
+def spectrum(wavelength):
+    return 1 + 0.3 * np.sin(wavelength / 3.)
+
+
+def orders(norders=5, length=2048, overlap=200):
+    # Orders in decreasing order, as Extract writes them, each one
+    # overlapping the next by overlap pixels.
+    tables = []
+    for k in range(norders):
+        pixels = np.arange(length) + k * (length - overlap)
+        wavelength = 5000 * np.exp(1e-5 * pixels)
+        tables.append(pd.DataFrame({'Wavelength': wavelength,
+                                    'Normalised': spectrum(wavelength),
+                                    'Order': 100 - k}))
+    return pd.concat(tables[::-1], ignore_index=True)
+
+
+def reference(table, grid):
+    # The orders interpolated one by one, with the tapers as weights.
+    numerator, denominator = np.zeros(len(grid)), np.zeros(len(grid))
+    for o, rows in table.groupby('Order'):
+        inside = ((grid >= rows.Wavelength.min())
+                  & (grid <= rows.Wavelength.max()))
+        w = np.interp(grid, rows.Wavelength, taper(len(rows)))
+        flux = np.interp(grid, rows.Wavelength, rows.Normalised)
+        numerator += np.where(inside, w * flux, 0)
+        denominator += np.where(inside, w, 0)
+    return numerator / denominator
+
+
+class TestMergeOperator(unittest.TestCase):
+
+    def setUp(self):
+        self.table = orders()
+        self.operator = self.merge_operator()
+
+    def merge_operator(self, **options):
+        return MergeOperator(self.table.Wavelength.values,
+                             self.table.Order.values, **options)
+
+    def test_grid(self):
+        grid = self.operator.grid
+        np.testing.assert_allclose(np.diff(np.log(grid)), 1e-5, rtol=1e-6)
+        self.assertAlmostEqual(grid[0], 5000.)
+        self.assertLessEqual(grid[-1], self.table.Wavelength.max())
+        size = 1 + int(np.log(5001. / 5000) / np.log1p(10. / 299792.458))
+        self.assertEqual(len(log_grid(5000., 5001., 10.)), size)
+
+    def test_merge(self):
+        merged = self.operator(self.table.Normalised.values)
+        grid = self.operator.grid
+        np.testing.assert_allclose(merged, spectrum(grid), atol=1e-6)
+        np.testing.assert_allclose(merged, reference(self.table, grid),
+                                   atol=1e-6)
+
+    def test_stack(self):
+        stack = np.stack([self.table.Normalised.values * k
+                          for k in (1., 2., 0.5)])
+        merged = self.operator(stack)
+        self.assertEqual(merged.shape, (3, len(self.operator.grid)))
+        np.testing.assert_allclose(merged[1], 2 * self.operator(stack[0]))
+        with self.assertRaises(ValueError):
+            self.operator(stack[:, 1:])
+
+    def test_invalid(self):
+        flux = self.table.Normalised.values.copy()
+        # A pixel of an order that overlaps with the next one, and a whole
+        # order.
+        flux[10] = np.nan
+        flux[self.table.Order.values == 98] = np.nan
+        merged = self.operator(flux)
+        grid = self.operator.grid
+        finite = np.isfinite(merged)
+        np.testing.assert_allclose(merged[finite], spectrum(grid[finite]),
+                                   atol=1e-6)
+        covered = np.zeros(len(grid), dtype=bool)
+        for o, rows in self.table[self.table.Order != 98].groupby('Order'):
+            covered |= ((grid >= rows.Wavelength.min())
+                        & (grid <= rows.Wavelength.max()))
+        np.testing.assert_array_equal(np.isfinite(merged), covered)
+
+    def test_weights(self):
+        flux = self.table.Normalised.values + (self.table.Order.values == 100)
+        uniform = self.merge_operator(weighting='uniform')(flux)
+        # Only the order 100 contributes: its weight is 0 elsewhere.
+        weights = (self.table.Order.values == 100).astype(float)
+        only = self.merge_operator(weighting=weights)(flux)
+        covered = np.isfinite(only)
+        np.testing.assert_allclose(only[covered],
+                                   spectrum(self.operator.grid[covered]) + 1,
+                                   atol=1e-6)
+        self.assertTrue(np.all(uniform[covered] <= only[covered] + 1e-9))
+        with self.assertRaises(ValueError):
+            self.merge_operator(weighting='blaze')
+
+
+class TestMerge(unittest.TestCase):
+
+    def test_table(self):
+        table = orders()
+        merged, operator = merge(table)
+        self.assertEqual(list(merged.columns), ['Wavelength', 'Normalised'])
+        self.assertTrue(operator.matches(table))
+        again, same = merge(orders(), operator=operator)
+        self.assertIs(same, operator)
+        shifted = table.assign(Wavelength=table.Wavelength * 1.0001)
+        self.assertIsNot(merge(shifted, operator=operator)[1], operator)
+        with self.assertRaises(ValueError):
+            merge(table, columns=('Object',))
+        # A merged spectrum is stored as a single row.
+        with tempfile.TemporaryDirectory() as tmp:
+            file = Path(tmp) / 'merged.fits'
+            append_extraction(file, merged, 'FRAME')
+            read = read_extraction(file, 'FRAME')
+        pd.testing.assert_frame_equal(read, merged)
+
+    def test_night(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp)
+            synthetic.write_night(path, chips=('HBDET',), nbias=1, nflat=1,
+                                  nthar=0, nscience=1, nspecphot=1,
+                                  nrows=1024)
+            with contextlib.redirect_stdout(io.StringIO()):
+                night = Night(path, workers=0,
+                              order={'fit': 'batched', 'detection': 'fast'},
+                              extract={'sparse': True,
+                                       'clipping': 'vectorized'},
+                              normalise={'smoother': 'binned'},
+                              merge={'velocity': 2.})
+                report = night.run()
+            self.assertEqual(report['failed'], [])
+            merges = [n for n in report['run'] if n.startswith('merge-')]
+            frame = merges[0][len('merge-'):]
+            merged, header = read_extraction(path / 'H20170412_merged.fits',
+                                             frame, header=True)
+        self.assertEqual(header['DATE-OBS'], '2017-04-12')
+        self.assertEqual(list(merged.columns), ['Wavelength', 'Normalised'])
+        np.testing.assert_allclose(np.diff(np.log(merged.Wavelength)),
+                                   np.log1p(2. / 299792.458))
+        self.assertGreater(np.isfinite(merged.Normalised).mean(), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
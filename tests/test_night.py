@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import pathlib
+import tempfile
+import unittest
+
+from pipeline.stability.night import Night, Stage
+
+
+def square(x):
+    return x * x
+
+
+def fail():
+    raise ValueError('no flat')
+
+
+class TestNight(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outputs = {}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def night(self, workers=0):
+        night = Night.__new__(Night)
+        night.workers = workers
+        night.stages = {}
+        night.instrumentation = {'timings': None, 'memory': False,
+                                 'profile': False}
+        return night
+
+    def store(self, name):
+        def finish(product):
+            self.outputs[name] = product
+        return finish
+
+    def graph(self, night, failing=False):
+        night.add(Stage('order', fail if failing else square, (3,),
+                        finish=self.store('order'),
+                        done=lambda: 'order' in self.outputs))
+        for frame in range(4):
+            name = 'extract-{frame}'.format(frame=frame)
+
+            def args(frame=frame):
+                return (self.outputs['order'] + frame,)
+
+            night.add(Stage(name, square, args, depends=['order'],
+                            finish=self.store(name),
+                            done=lambda name=name: name in self.outputs))
+        night.add(Stage('normalise-0', square, (2,),
+                        depends=['extract-0', 'extract-1'],
+                        finish=self.store('normalise-0')))
+        return night
+
+    def run_night(self, night):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return night.run()
+
+    def test_serial(self):
+        report = self.run_night(self.graph(self.night()))
+        stages = ['order', 'normalise-0']
+        stages += ['extract-%d' % f for f in range(4)]
+        self.assertEqual(sorted(report['run']), sorted(stages))
+        self.assertEqual(report['run'][0], 'order')
+        self.assertEqual(report['run'][-1], 'normalise-0')
+        self.assertEqual(self.outputs['extract-3'], 144)
+
+    def test_pool(self):
+        report = self.run_night(self.graph(self.night(workers=2)))
+        self.assertEqual(len(report['run']), 6)
+        self.assertEqual([self.outputs['extract-%d' % f] for f in range(4)],
+                         [81, 100, 121, 144])
+
+    def test_failure(self):
+        report = self.run_night(self.graph(self.night(), failing=True))
+        self.assertEqual(report['failed'], ['order'])
+        self.assertEqual(len(report['skipped']), 5)
+        self.assertEqual(self.outputs, {})
+
+    def test_resume(self):
+        self.outputs = {'order': 9, 'extract-0': 81, 'extract-2': 121}
+        report = self.run_night(self.graph(self.night()))
+        self.assertEqual(report['done'], ['extract-0', 'extract-2', 'order'])
+        self.assertEqual(sorted(report['run']),
+                         ['extract-1', 'extract-3', 'normalise-0'])
+
+    def test_nightfile(self):
+        night = self.night()
+        night.outdir = pathlib.Path(self.tmp.name)
+        extracted = night.nightfile(pathlib.Path('R201701010012.fits'))
+        self.assertEqual(extracted.name, 'R20170101_extracted.fits')
+        normalised = night.nightfile('H201701010012.fits', kind='normalised')
+        self.assertEqual(normalised.name, 'H20170101_normalised.fits')
+
+
+if __name__ == '__main__':
+    unittest.main()
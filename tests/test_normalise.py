@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import types
+import unittest
+
+import numpy as np
+import pandas as pd
+from statsmodels.api import nonparametric
+
+from pipeline.stability.stability import Normalise, binned_continuum
+
+
+def fake_extraction(norders=6, length=2048, seed=0):
+    rng = np.random.default_rng(seed)
+    tables = []
+    x = np.arange(length)
+    for o in range(norders):
+        blaze = 1000 * np.exp(-0.5 * ((x - length / 2) / (length / 3)) ** 2)
+        blaze += 100
+        flux = blaze * (1 + rng.normal(0, 0.01, length))
+        flux[rng.integers(0, length, 5)] *= 0.5
+        tables.append(pd.DataFrame({'Wavelength': 5000 + 30 * o + x * 0.01,
+                                    'Object': flux,
+                                    'Sky': flux / 10,
+                                    'Order': 100 - o,
+                                    'CosmicRaysObject': flux,
+                                    'CosmicRaysSky': flux / 10}))
+    return types.SimpleNamespace(
+        wlcrorders=pd.concat(tables, ignore_index=True))
+
+
+def normalise(science, specphot, **options):
+    return Normalise(science, specphot, **options).normalised.wlcrorders
+
+
+class TestNormalise(unittest.TestCase):
+
+    def setUp(self):
+        self.science = fake_extraction(seed=1)
+        self.specphot = fake_extraction(seed=2)
+
+    def test_binned_continuum(self):
+        x = np.linspace(0, 1, 1650)[::-1]
+        truth = 1 + np.sin(3 * x)
+        y = truth + np.random.default_rng(0).normal(0, 0.01, x.size)
+        np.testing.assert_allclose(binned_continuum(x, y), truth, atol=0.02)
+
+    def test_lowess(self):
+        normalised = normalise(self.science, self.specphot)
+        rows = self.specphot.wlcrorders.Order == 99
+        spec = self.specphot.wlcrorders[rows]
+        parts = (slice(None, 1650), slice(1650, None))
+        expected = np.concatenate([
+            nonparametric.lowess(spec.Object.values[part],
+                                 spec.Wavelength.values[part], frac=0.05,
+                                 return_sorted=False)
+            for part in parts])
+        crobject = self.science.wlcrorders.CosmicRaysObject[rows]
+        np.testing.assert_allclose(normalised.FlatField[rows],
+                                   crobject / expected)
+        self.assertEqual(list(normalised.columns[-3:]),
+                         ['FlatField', 'Normalised', 'oshape'])
+        # The first two orders and the last one are not deblazed.
+        first = normalised.Order == 100
+        np.testing.assert_array_equal(normalised.Normalised[first],
+                                      normalised.CosmicRaysObject[first])
+
+    def test_binned_pool(self):
+        serial = normalise(fake_extraction(seed=1), self.specphot,
+                           smoother='binned')
+        pool = normalise(fake_extraction(seed=1), self.specphot,
+                         smoother='binned', processes=2)
+        pd.testing.assert_frame_equal(serial, pool)
+        middle = serial.Order.isin([98, 97, 96])
+        self.assertLess(np.abs(np.median(serial.Normalised[middle]) - 1), 0.01)
+
+    def test_mismatch(self):
+        # The standard lacks the order 95, and its order 97 is shorter than
+        # the one of the science frame.
+        table = self.specphot.wlcrorders
+        short = table[(table.Order == 97)].index[-10:]
+        self.specphot.wlcrorders = table[(table.Order != 95)].drop(short)
+        logger = 'pipeline.stability.stability'
+        with self.assertLogs(logger, 'WARNING') as logs:
+            normalised = normalise(self.science, self.specphot,
+                                   smoother='binned')
+        self.assertIn('97, 95', logs.output[0])
+        missing = normalised.Order.isin([97, 95])
+        self.assertTrue(normalised.FlatField[missing].isna().all())
+        self.assertTrue(np.isfinite(normalised.FlatField[~missing]).all())
+        shorter = normalised.Order == 97
+        self.assertTrue(normalised.Normalised[shorter].isna().all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import types
+import unittest
+
+import numpy as np
+import numpy.ma as ma
+from scipy.signal import find_peaks_cwt, savgol_filter
+
+from pipeline.stability.stability import Order, fit_gaussians
+
+
+def fake_flat(nrows=600, ncols=500, norders=6, spacing=80, fibre=22,
+              sigma=3.0):
+    y = np.arange(nrows)[:, None]
+    x = np.arange(ncols)[None, :]
+    data = np.random.default_rng(0).normal(300, 20, (nrows, ncols))
+    for o in range(norders):
+        center = (60 + spacing * o + 100 * ((x - ncols / 2) / ncols) ** 2
+                  + 0.01 * x)
+        for f in (0, fibre):
+            data += 20000 * np.exp(-0.5 * ((y - center - f) / sigma) ** 2)
+    return types.SimpleNamespace(name='Flat field', mode='HIGH RESOLUTION',
+                                 data=data, xpix=ncols)
+
+
+def fake_centers(x):
+    return np.rint(60 + 100 * ((x - 250) / 500) ** 2 + 0.01 * x).astype(int)
+
+
+def column_peaks(frame, step):
+    # The detection of the orders column after column, as Order.find_peaks()
+    # did before it was batched.
+    temp = []
+    for pixel in np.arange(step, frame.data.shape[1], step):
+        test = frame.data[:, pixel]
+        b, c = np.histogram(np.abs(test))
+        t = ma.array(test, mask=test < c[1])
+        xp = find_peaks_cwt(savgol_filter(t, 37, 3), widths=np.arange(1, 20))
+        temp.append(xp[~t[xp].mask].copy())
+    size = max([len(i) for i in temp])
+    peaks = np.ones((size, len(temp)), dtype=int)
+    for index in range(len(temp)):
+        temp[index].resize(size, refcheck=False)
+        peaks[:, index] = temp[index]
+    return peaks
+
+
+class TestBatchedFit(unittest.TestCase):
+
+    def setUp(self):
+        self.order = Order.__new__(Order)
+        self.order.hrs = fake_flat()
+        self.order.step = 50
+        self.order.sigma = 5.0
+
+    def test_matches_astropy(self):
+        x = np.arange(1, 9) * 50
+        centers = fake_centers(x)
+        batched = fit_gaussians(self.order.hrs.data, centers, x)
+        for k, a in enumerate(centers):
+            reference = self.order._gaussian_fit(a, k)
+            np.testing.assert_allclose(batched[k], reference.parameters,
+                                       atol=5e-3)
+
+    def test_initial_guess(self):
+        # The closed form guess alone, on a stack of cuts that is not 3 long:
+        # numpy >= 2 reads a (m, 3) right-hand side of solve() as a matrix.
+        x = np.arange(1, 9) * 50
+        centers = fake_centers(x)
+        guess = fit_gaussians(self.order.hrs.data, centers, x, niter=0)
+        self.assertEqual(guess.shape, (8, 3))
+        np.testing.assert_allclose(guess[:, 1], centers, atol=1.)
+        np.testing.assert_allclose(guess[:, 2], 3., atol=0.5)
+
+    def test_positions(self):
+        self.order.fit = 'batched'
+        op = np.array([[140, 140, 0], [162, 162, 590]])
+        positions, fit = self.order.find_orders(op)
+        self.assertEqual(positions.shape, (2, 3, 3))
+        np.testing.assert_allclose(positions[:, :2, 1], fit[:, :2, 1])
+        np.testing.assert_allclose(positions[:, :2, 2] - positions[:, :2, 0],
+                                   10 * fit[:, :2, 2])
+        # Padded and out of frame cuts are flagged as failed fits.
+        self.assertTrue(np.isnan(positions[:, 2]).all())
+
+
+class TestFindPeaks(unittest.TestCase):
+
+    def peaks(self, **kwargs):
+        order = Order.__new__(Order)
+        order.step = 50
+        order.detection = 'cwt'
+        order.processes = None
+        order.spversion = '1.0'
+        order.got_flat = True
+        for key, value in kwargs.items():
+            setattr(order, key, value)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return order.find_peaks(fake_flat())
+
+    def test_fast(self):
+        peaks = self.peaks(detection='fast')
+        self.assertEqual(peaks.shape, (12, 9))
+        x = np.arange(1, 10) * 50
+        expected = (60 + 80 * np.arange(6)[:, None]
+                    + 100 * ((x - 250) / 500) ** 2 + 0.01 * x)
+        np.testing.assert_allclose(peaks[::2], expected, atol=2)
+        np.testing.assert_allclose(peaks[1::2], expected + 22, atol=2)
+
+    def test_cwt(self):
+        np.testing.assert_array_equal(self.peaks(),
+                                      column_peaks(fake_flat(), 50))
+
+    def test_cwt_pool(self):
+        np.testing.assert_array_equal(self.peaks(processes=2), self.peaks())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,16 +3,159 @@
 # -*- coding: utf-8 -*-
 
 
+import contextlib
+import io
+import tempfile
 import unittest
-from pipeline.stability import set_parameters
-from astropy.io import fits
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from pipeline.stability import synthetic
+from pipeline.stability.stability import (HRS, ListOfFiles, Order, decimate,
+                                          pyramid)
 
 
 class TestFitsFiles(unittest.TestCase):
 
-    def test_set_parameters():
-        file = '../R201704120017.fits'
-        parameters = set_parameters(file)
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parameters(self):
+        for chip, xpix, ordershift in (('HBDET', 2048, 83),
+                                       ('HRDET', 4096, 52)):
+            file = synthetic.write_frame(self.path / 'frame.fits', 'science',
+                                         chip=chip, nrows=128)
+            with HRS(file) as hrs:
+                self.assertEqual(hrs.chip, chip)
+                self.assertEqual(hrs.xpix, xpix)
+                self.assertEqual(hrs.ordershift, ordershift)
+                self.assertEqual(hrs.data.shape, (128, xpix))
+                self.assertEqual(hrs.mode, 'HIGH RESOLUTION')
+
+    def test_orientation(self):
+        # The frames are written in the orientation of the detector, HRS
+        # puts the orders back in place.
+        centers = synthetic.order_centers('HBDET', nrows=512, norders=5)
+        file = synthetic.write_frame(self.path / 'flat.fits', 'flat',
+                                     chip='HBDET', nrows=512)
+        with HRS(file) as hrs:
+            column = hrs.data[:, 1024]
+        rows = np.rint(centers[:, :, 1024]).astype(int).ravel()
+        self.assertTrue(np.all(column[rows] > 5000))
+        self.assertLess(np.median(column), 1000)
+
+    def test_night(self):
+        files = synthetic.write_night(self.path, nbias=2, nflat=1, nthar=1,
+                                      nscience=2, nspecphot=1, nrows=64)
+        with contextlib.redirect_stdout(io.StringIO()):
+            lof = ListOfFiles(self.path)
+        self.assertEqual(lof.bias, sorted(files['bias']))
+        self.assertEqual(lof.flat, sorted(files['flat']))
+        self.assertEqual(lof.thar, sorted(files['thar']))
+        self.assertEqual(lof.science, sorted(files['science']))
+        self.assertEqual(lof.specphot, sorted(files['specphot']))
+        self.assertEqual(len(lof.object), 6)
+
+
+class TestSyntheticOrders(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        file = synthetic.write_frame(
+            Path(self.tmp.name) / 'H201704120001.fits', 'flat', chip='HBDET',
+            nrows=1024)
+        self.flat = HRS(file)
+        self.centers = synthetic.order_centers('HBDET', nrows=1024, norders=10)
+
+    def tearDown(self):
+        self.flat.close()
+        self.tmp.cleanup()
+
+    def order(self, detection):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return Order(hrs=self.flat, fit='batched', detection=detection)
+
+    def test_fast_matches_cwt(self):
+        reference = self.order('cwt').orderguess
+        fast = self.order('fast').orderguess
+        # The detectors are not the same: cwt is pulled by the smoothing, but
+        # it finds the same orders.
+        for column in range(reference.shape[1]):
+            expected = reference[:, column][reference[:, column] > 0]
+            detected = fast[:, column][fast[:, column] > 0]
+            distance = np.abs(expected[:, None] - detected[None, :])
+            distance = distance.min(axis=1)
+            self.assertGreaterEqual(np.mean(distance <= 5), 0.9)
+
+    def test_positions(self):
+        order = self.order('fast')
+        columns = order.step * (np.arange(order.extracted.shape[1]) + 1)
+        centers = self.centers[:, :, columns].reshape(-1, len(columns))
+        expected = np.sort(centers, axis=0)
+        found = np.sort(order.extracted[..., 1], axis=0)[:len(expected)]
+        # The fibres are 22 rows apart, and each fit is pulled a little
+        # towards the other fibre.
+        self.assertLess(np.nanmedian(np.abs(found - expected)), 5)
+
+
+class TestViewer(unittest.TestCase):
+
+    def test_pyramid(self):
+        data = np.arange(4096 * 2050, dtype=np.uint16).reshape(2050, 4096)
+        levels = pyramid(data, size=1024)
+        self.assertEqual([level.shape for level in levels],
+                         [(2050, 4096), (1025, 2048), (512, 1024)])
+        self.assertIs(levels[0], data)
+        self.assertAlmostEqual(levels[1][3, 5], data[6:8, 10:12].mean(),
+                               places=2)
+
+    def test_decimate(self):
+        y = np.random.RandomState(0).normal(size=4096)
+        y[1234] = 50
+        x, values = decimate(y, 300)
+        self.assertEqual(len(values), 600)
+        self.assertEqual(values.max(), 50)
+        self.assertEqual(values.min(), y.min())
+        self.assertTrue(np.all(np.diff(x) >= 0))
+        # A short line is not changed.
+        x, values = decimate(y[:500], 300)
+        np.testing.assert_array_equal(values, y[:500])
+
+    def test_plot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = synthetic.write_frame(Path(tmp) / 'R201704120001.fits',
+                                         'flat', chip='HRDET', nrows=2048)
+            with HRS(file) as hrs:
+                fig = Figure(figsize=(9.6, 6.4))
+                FigureCanvasAgg(fig)
+                hrs.plot(fig, size=512)
+                fig.canvas.draw()
+                self.assertEqual(hrs.plot1.get_array().shape, (256, 512))
+                hrs._zoom(SimpleNamespace(inaxes=hrs.ax1, xdata=10.2,
+                                          ydata=1000))
+                window = np.ma.filled(hrs.plot2.get_array(), np.nan)
+                self.assertTrue(np.all(np.isnan(window[:, :89])))
+                np.testing.assert_array_equal(window[:, 90:],
+                                              hrs.data[900:1100, :110])
+                hrs._plot(SimpleNamespace(inaxes=hrs.ax1, xdata=2000,
+                                          ydata=1000, button=1))
+                self.assertEqual(np.max(hrs.cut3.get_ydata()),
+                                 np.max(hrs.data[:, 2000]))
+                # Zooming in on the main panel shows the frame itself, only
+                # where it is seen.
+                hrs.ax1.set_xlim(999.5, 1199.5)
+                hrs.ax1.set_ylim(1199.5, 999.5)
+                np.testing.assert_array_equal(hrs.plot1.get_array(),
+                                              hrs.data[1000:1200, 1000:1200])
+
 
 if __name__ == '__main__':
     unittest.main()
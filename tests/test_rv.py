@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from pipeline.stability import synthetic
+from pipeline.stability.rv import (
+    LineMask, MaskOperator, RadialVelocity, combine, fit_ccf, order_snr,
+    science_frames, velocity_grid)
+from pipeline.stability.stability import append_extraction
+
+
+def ccf(orders, operator):
+    values, continuum = operator(orders.Normalised.values)
+    snr = order_snr(orders)
+    weights = np.array([snr[o] for o in operator.orders])
+    return combine(values, continuum, weights)
+
+
+class TestFitCCF(unittest.TestCase):
+
+    def test_gaussians(self):
+        v = velocity_grid(0., 30., 0.5)
+        centres = np.array([[-3.21], [0.], [7.77]])
+        sigma = np.array([[3.], [4.], [5.]])
+        profiles = 1.2 - 0.4 * np.exp(-0.5 * ((v - centres) / sigma) ** 2)
+        empty = np.full((1, len(v)), np.nan)
+        flat = np.ones((1, len(v)))
+        rv, fwhm, contrast = fit_ccf(v,
+                                     np.concatenate([profiles, empty, flat]))
+        np.testing.assert_allclose(rv[:3], centres[:, 0], atol=1e-6)
+        np.testing.assert_allclose(fwhm[:3], 2.3548200450309493 * sigma[:, 0],
+                                   rtol=1e-6)
+        np.testing.assert_allclose(contrast[:3], 0.4 / 1.2, rtol=1e-6)
+        self.assertTrue(np.isnan(rv[3:]).all())
+
+
+class TestMaskOperator(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mask = LineMask(*synthetic.stellar_lines('HBDET'))
+        cls.orders = synthetic.normalised_orders('HBDET', velocity=12.345)
+        cls.velocities = velocity_grid(0., 40., 1.)
+        cls.operator = MaskOperator(cls.orders.Wavelength.values,
+                                    cls.orders.Order.values, cls.mask,
+                                    cls.velocities)
+
+    def test_velocity(self):
+        rv, fwhm, contrast = fit_ccf(self.velocities,
+                                     ccf(self.orders, self.operator))
+        self.assertAlmostEqual(float(rv), 12.345, delta=0.005)
+        values, continuum = self.operator(self.orders.Normalised.values)
+        self.assertEqual(values.shape, (40, len(self.velocities)))
+        self.assertEqual(list(self.operator.orders), list(range(123, 83, -1)))
+        orders, _, _ = fit_ccf(self.velocities, values)
+        np.testing.assert_allclose(orders, 12.345, atol=0.02)
+
+    def test_noise(self):
+        noisy = synthetic.normalised_orders('HBDET', velocity=-3.21, snr=50,
+                                            seed=3)
+        self.assertTrue(self.operator.matches(noisy))
+        rv, fwhm, contrast = fit_ccf(self.velocities,
+                                     ccf(noisy, self.operator))
+        self.assertAlmostEqual(float(rv), -3.21, delta=0.02)
+        self.assertGreater(contrast, 0.1)
+
+    def test_stack(self):
+        flux = self.orders.Normalised.values.copy()
+        flux[5000:5100] = np.nan
+        stack = np.stack([self.orders.Normalised.values, flux])
+        values, continuum = self.operator(stack)
+        single, _ = self.operator(flux)
+        self.assertEqual(values.shape, (2, 40, len(self.velocities)))
+        np.testing.assert_allclose(values[1], single)
+        # The missing pixels are left out of the continuum: the CCF is still
+        # normalised.
+        difference = np.abs(values[1, :, 0] - values[0, :, 0])
+        self.assertLess(np.nanmax(difference), 0.05)
+        with self.assertRaises(ValueError):
+            self.operator(flux[1:])
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = Path(tmp) / 'mask.txt'
+            np.savetxt(str(file), [[5000.0, 5000.2, 0.5],
+                                   [4000.0, 4000.1, 0.2]])
+            mask = LineMask.read(file)
+            np.testing.assert_allclose(mask.wavelengths, [4000.05, 5000.1])
+            np.testing.assert_allclose(mask.weights, [0.2, 0.5])
+            np.savetxt(str(file), [[5000.0, 0.5]])
+            self.assertEqual(len(LineMask.read(file)), 1)
+
+
+class TestRadialVelocity(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.mask = self.path / 'mask.txt'
+        np.savetxt(str(self.mask),
+                   np.column_stack(synthetic.stellar_lines('HBDET')))
+        self.velocities = {'H201704120005': 1.5,
+                           'H201704120006': -2.25,
+                           'H201704120007': 0.}
+        for k, (frame, velocity) in enumerate(self.velocities.items()):
+            header = fits.Header({'OBJECT': 'HD 000001',
+                                  'DATE-OBS': '2017-04-12',
+                                  'TIME-OBS': '2{k}:00:00'.format(k=2 - k),
+                                  'OBSMODE': 'HIGH RESOLUTION'})
+            orders = synthetic.normalised_orders('HBDET', velocity=velocity,
+                                                 snr=100, seed=k)
+            append_extraction(self.path / 'H20170412_normalised.fits', orders,
+                              frame, header=header)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_measure(self):
+        frames = science_frames([self.path])[('HBDET', 'HIGH')]
+        names = ['H201704120007', 'H201704120006', 'H201704120005']
+        self.assertEqual([f for file, f in frames], names)
+        rv = RadialVelocity(self.mask, self.path / 'rv.fits', span=30.,
+                            step=1., batch=2)
+        self.assertEqual(rv.measure(frames), 3)
+        series = rv.series.read()
+        self.assertEqual(list(series.File), names)
+        np.testing.assert_allclose(series.RV, [0., -2.25, 1.5], atol=0.02)
+        self.assertTrue((series.Error < 0.02).all())
+        self.assertEqual(list(rv.series.orders()), list(range(123, 83, -1)))
+        np.testing.assert_allclose(
+            np.nanmedian(np.stack(series.Orders), axis=1), [0., -2.25, 1.5],
+            atol=0.02)
+        again = RadialVelocity(self.mask, self.path / 'rv.fits')
+        self.assertEqual(again.measure(frames), 0)
+
+    def test_pool(self):
+        frames = science_frames([self.path], end='2017-04-12')
+        frames = frames[('HBDET', 'HIGH')]
+        rv = RadialVelocity(self.mask, self.path / 'rv.fits', span=30.,
+                            step=1., workers=2, batch=1)
+        self.assertEqual(rv.measure(frames), 3)
+        np.testing.assert_allclose(rv.series.read().RV, [0., -2.25, 1.5],
+                                   atol=0.02)
+        self.assertEqual(science_frames([self.path], start='2017-04-13'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from pipeline.stability.series import (TimeSeries, command_line, mjd,
+                                       worker_map)
+
+
+class Series(TimeSeries):
+    extension = 'TEST'
+    formats = [('File', '32A', None),
+               ('DATE-OBS', '10A', None),
+               ('TIME-OBS', '16A', None),
+               ('Value', 'D', 'km/s'),
+               ('Values', '{n}E', None)]
+    columns = [name for name, format, unit in formats]
+
+
+def rows(names, times, value):
+    return {'File': names,
+            'DATE-OBS': ['2017-04-12'] * len(names),
+            'TIME-OBS': times,
+            'Value': np.full(len(names), value),
+            'Values': np.full((len(names), 3), value)}
+
+
+_offset = None
+
+
+def _initialise(offset):
+    global _offset
+    _offset = offset
+
+
+def _add(x, y):
+    return x + y + _offset
+
+
+class TestTimeSeries(unittest.TestCase):
+
+    def test_append(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            series = Series(Path(tmp) / 'series' / 'test.fits')
+            self.assertEqual(series.frames(), set())
+            self.assertIsNone(series.header())
+            self.assertEqual(len(series.read()), 0)
+            header = fits.Header({'DETNAM': 'HRDET', 'OBJECT': 'HD 1'})
+            first = rows(['B', 'A'], ['21:00:00', '20:00:00'], 1.)
+            series._write(*series._merge(first, header))
+            # A frame measured again replaces the old one.
+            second = rows(['B', 'C'], ['21:00:00', '22:00:00'], 2.)
+            series._write(*series._merge(second))
+            self.assertEqual(series.frames(), {'A', 'B', 'C'})
+            self.assertEqual(series.header()['DETNAM'], 'HRDET')
+            self.assertNotIn('OBJECT', series.header())
+            read = series.read()
+            self.assertEqual(list(read.File), ['A', 'B', 'C'])
+            np.testing.assert_array_equal(read.Value, [1., 2., 2.])
+            np.testing.assert_array_equal(np.stack(read.Values)[:, 0],
+                                          [1., 2., 2.])
+            self.assertEqual(str(read.index[0]), '2017-04-12 20:00:00')
+            with fits.open(str(series.file)) as hdulist:
+                columns = hdulist['TEST'].columns
+                self.assertEqual(columns['Value'].unit, 'km/s')
+                self.assertEqual(columns['Values'].format, '3E')
+
+    def test_mjd(self):
+        np.testing.assert_allclose(mjd(['2017-04-12'], ['12:00:00']),
+                                   [57855.5])
+
+
+class TestWorkerMap(unittest.TestCase):
+
+    def test_pool(self):
+        iterables = ([1, 2, 3], [10, 20, 30])
+        serial = list(worker_map(_add, iterables, _initialise, (100,)))
+        self.assertEqual(serial, [111, 122, 133])
+        pool = list(worker_map(_add, iterables, _initialise, (100,),
+                               workers=2))
+        self.assertEqual(pool, serial)
+
+    def test_command_line(self):
+        parser = command_line('Test', 'data', 'out', 'workers')
+        args = parser.parse_args(['-d', 'a', 'b', '-w', '0'])
+        self.assertEqual(args.datadir, ['a', 'b'])
+        self.assertEqual((args.outdir, args.workers, args.start,
+                          args.log_level), ('.', 0, None, 'INFO'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import pickle
+import tempfile
+import unittest
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from pipeline.stability import synthetic
+from pipeline.stability.night import Night
+from pipeline.stability.stability import (HRS, Extract, Order, getshape,
+                                          getshapes, read_extraction)
+from pipeline.stability.thar import (LineList, WavelengthSolution, find_lines,
+                                     solve)
+
+try:
+    from numpy.exceptions import RankWarning
+except ImportError:
+    # numpy < 1.25
+    RankWarning = np.RankWarning
+
+
+def fake_orders(norders=12, length=2048, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.arange(length)
+    blaze = 1e4 * np.sinc(1.2 * (x - length / 2) / length) ** 2
+    orders = np.stack([blaze * (0.8 + 0.01 * k) + rng.normal(0, 20, length)
+                       for k in range(norders)])
+    # Emission lines on a few orders.
+    for k in range(0, norders, 3):
+        starts = rng.integers(0, length - 10, 5)
+        orders[k, starts[:, None] + np.arange(5)] += 5e4
+    return orders
+
+
+class TestGetShapes(unittest.TestCase):
+
+    def reference(self, orders):
+        with warnings.catch_warnings():
+            # np.polyfit() warns that a degree 11 fit on thousands of pixels
+            # is poorly conditioned.
+            warnings.simplefilter('ignore', RankWarning)
+            return np.stack([getshape(orders[k], orders[k + 2])
+                             for k in range(len(orders) - 2)])
+
+    def test_neighbours(self):
+        for length in (2048, 4040):
+            orders = fake_orders(length=length)
+            np.testing.assert_allclose(getshapes(orders),
+                                       self.reference(orders), rtol=1e-8,
+                                       atol=1e-6)
+
+    def test_pairs(self):
+        orders = fake_orders()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RankWarning)
+            reference = [getshape(a, b)
+                         for a, b in zip(orders[:3], orders[5:8])]
+        np.testing.assert_allclose(getshapes(orders[:3], orders[5:8]),
+                                   reference, rtol=1e-8, atol=1e-6)
+
+    def test_single(self):
+        orders = fake_orders(norders=2)
+        self.assertEqual(getshapes(orders[0], orders[1]).shape, (1, 2048))
+
+
+class TestLineList(unittest.TestCase):
+
+    def test_nearest(self):
+        linelist = LineList([5000., 4000., 4500., 4001.])
+        index, distance = linelist.nearest([3990., 4000.6, 4400., 6000.])
+        np.testing.assert_array_equal(linelist.wavelengths[index],
+                                      [4000., 4001., 4500., 5000.])
+        np.testing.assert_allclose(distance, [10., 0.4, 100., 1000.])
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = Path(tmp) / 'thar.dat'
+            file.write_text('# ThAr\n4500.5 100\n4000.25 20\n')
+            linelist = LineList.read(file)
+        np.testing.assert_array_equal(linelist.wavelengths, [4000.25, 4500.5])
+        np.testing.assert_array_equal(linelist.intensities, [20, 100])
+
+
+class TestWavelengthSolution(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        path = Path(cls.tmp.name)
+        flat = synthetic.write_frame(path / 'H201704120001.fits', 'flat',
+                                     chip='HBDET', nrows=1024)
+        thar = synthetic.write_frame(path / 'H201704120002.fits', 'thar',
+                                     chip='HBDET', nrows=1024)
+        with contextlib.redirect_stdout(io.StringIO()), HRS(flat) as hrs:
+            order = Order(hrs=hrs, fit='batched', detection='fast')
+        with HRS(thar) as hrs:
+            cls.extracted = Extract(order, hrs, sparse=True).orders
+        cls.linelist = LineList(*synthetic.thar_linelist('HBDET'))
+        cls.truth = {o: synthetic.wavelengths('HBDET', o)
+                     for o in range(84, 94)}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_fit(self):
+        x = np.tile(np.linspace(0, 2047, 50), 6)
+        m = np.repeat(np.arange(84., 90.), 50)
+        wavelengths = 4.7e5 * (1 + (x - 1024) / 81920 + 1e-9 * (x - 1024) ** 2
+                               + 1e-4 * (m - 86)) / m
+        solution, used = WavelengthSolution.fit(m, x, wavelengths,
+                                                degree=(3, 2), chip='HBDET')
+        self.assertTrue(used.all())
+        self.assertLess(solution.rms, 1e-8)
+        np.testing.assert_allclose(solution(m, x), wavelengths, rtol=1e-12)
+        self.assertEqual(len(solution.grid()[85]), 2048)
+
+    def test_lines(self):
+        lines, positions, heights = find_lines(self.extracted)
+        # The lines of the object fibre of order 86 (line 5).
+        found = np.sort(positions[lines == 5])
+        expected = synthetic.thar_lines('HBDET', 86)[0]
+        expected = expected[(expected > 10) & (expected < 2038)]
+        distance = np.abs(expected[:, None] - found[None, :]).min(axis=1)
+        # The others are blended with a close line.
+        self.assertGreater(np.mean(distance < 0.05), 0.6)
+
+    def test_solve(self):
+        # The guess is wrong by more than a pixel, and has a scale error.
+        guess = {}
+        for o, w in self.truth.items():
+            scale = 1.2 + 2e-4 * (np.arange(len(w)) - 1000)
+            guess[o] = w + np.gradient(w) * scale
+        solution = solve(self.extracted, self.linelist, guess, 'HBDET',
+                         'HIGH RESOLUTION')
+        self.assertGreater(solution.nlines, 200)
+        grid = solution.grid()
+        for o in range(86, 93):
+            error = np.abs(grid[o] - self.truth[o])
+            error /= np.gradient(self.truth[o])
+            self.assertLess(error.max(), 0.05)
+        # The solution is a guess for the next nights.
+        copy = pickle.loads(pickle.dumps(solution))
+        again = solve(self.extracted, self.linelist, copy, 'HBDET')
+        self.assertLess(abs(again.rms - solution.rms), 1e-3)
+
+
+class TestNightCalibration(unittest.TestCase):
+
+    def test_night(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp)
+            synthetic.write_night(path, chips=('HBDET',), nbias=1, nflat=1,
+                                  nthar=1, nscience=1, nspecphot=0,
+                                  nrows=1024)
+            linelist = path / 'thar.dat'
+            np.savetxt(str(linelist),
+                       np.column_stack(synthetic.thar_linelist('HBDET')))
+            with contextlib.redirect_stdout(io.StringIO()):
+                night = Night(path, workers=0,
+                              order={'fit': 'batched', 'detection': 'fast'},
+                              extract={'sparse': True,
+                                       'clipping': 'vectorized'},
+                              wavelength={'linelist': linelist})
+                report = night.run()
+            self.assertIn('wavelength-HBDET-HIGH', report['run'])
+            self.assertEqual(report['failed'], [])
+            self.assertTrue((path / 'wavelength_HBDET_HIGH.pkl').exists())
+            orders = read_extraction(path / 'H20170412_extracted.fits',
+                                     'H201704120004')
+        for o in range(86, 93):
+            wavelength = orders.Wavelength[orders.Order == o].values
+            error = np.abs(wavelength - synthetic.wavelengths('HBDET', o))
+            error /= np.gradient(wavelength)
+            self.assertLess(error.max(), 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
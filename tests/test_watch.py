@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+
+import contextlib
+import io
+import os
+import pickle
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from pipeline.stability import synthetic
+from pipeline.stability.index import FileIndex
+from pipeline.stability.night import Night
+from pipeline.stability.stability import (classify, extraction_frames,
+                                          read_extraction)
+from pipeline.stability.watch import Watch, complete
+
+
+def age(path, seconds):
+    # Sets the mtime of a file seconds in the past.
+    moment = time.time() - seconds
+    os.utime(str(path), (moment, moment))
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.files = synthetic.write_night(self.path, chips=('HBDET',),
+                                           nbias=1, nflat=1, nthar=0,
+                                           nscience=2, nspecphot=1,
+                                           nrows=1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_poll(self):
+        watch = Watch(self.path, outdir=self.path / 'reduced', settle=0.)
+        reduced = watch.poll()
+        frames = self.files['science'] + self.files['specphot']
+        self.assertEqual(sorted(reduced), sorted(f.stem for f in frames))
+        self.assertEqual(watch.queue, [])
+        reduced = self.path / 'reduced'
+        # The master frames are next to the raw frames, where Master writes
+        # them and Night looks for them.
+        self.assertTrue((self.path / 'bluemasterbias.fits').exists())
+        self.assertTrue((self.path / 'bluemasterflat_HIGH.fits').exists())
+        self.assertTrue((reduced / 'order_HBDET_HIGH.pkl').exists())
+        science = sorted(f.stem for f in self.files['science'])
+        extracted = extraction_frames(reduced / 'H20170412_extracted.fits')
+        self.assertEqual(sorted(extracted), sorted(f.stem for f in frames))
+        normalised = extraction_frames(reduced / 'H20170412_normalised.fits')
+        self.assertEqual(sorted(normalised), science)
+        merged, header = read_extraction(reduced / 'H20170412_merged.fits',
+                                         science[0], header=True)
+        self.assertEqual(header['DATE-OBS'], '2017-04-12')
+        self.assertGreater(np.isfinite(merged.Normalised).mean(), 0.5)
+        # Nothing is reduced again, by this watch or by the next one.
+        self.assertEqual(watch.poll(), [])
+        watch = Watch(self.path, outdir=reduced, settle=0.)
+        self.assertEqual(watch.poll(), [])
+
+    def test_night(self):
+        # The frames reduced live are the frames hrs-night reduces.
+        Watch(self.path, outdir=self.path / 'watch', settle=0.).poll()
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = Night(self.path, outdir=self.path / 'night', workers=0,
+                           order={'fit': 'batched', 'detection': 'fast'},
+                           extract={'sparse': True, 'clipping': 'vectorized'},
+                           normalise={'smoother': 'binned'}).run()
+        self.assertEqual(report['failed'], [])
+        # The master frames made live are not combined again.
+        self.assertIn('masterbias', report['done'])
+        self.assertIn('masterflat', report['done'])
+        for frame in self.files['science'] + self.files['specphot']:
+            for kind in ('extracted', 'normalised'):
+                if kind == 'normalised' and frame in self.files['specphot']:
+                    continue
+                name = 'H20170412_{kind}.fits'.format(kind=kind)
+                watch, wheader = read_extraction(self.path / 'watch' / name,
+                                                 frame.stem, header=True)
+                night, nheader = read_extraction(self.path / 'night' / name,
+                                                 frame.stem, header=True)
+                pd.testing.assert_frame_equal(watch, night)
+                self.assertEqual(wheader['TIME-OBS'], nheader['TIME-OBS'])
+
+    def test_settle(self):
+        watch = Watch(self.path, outdir=self.path / 'reduced', settle=60.)
+        self.assertEqual(watch.poll(), [])
+        self.assertEqual(len(watch.pending), 5)
+        for f in sum(self.files.values(), []):
+            age(f, 120)
+        # The files have changed: they are read again and are old enough now.
+        self.assertEqual(len(watch.poll()), 3)
+        self.assertEqual(watch.pending, set())
+
+    def test_waiting(self):
+        # Without flats there is no Order: the frames wait for one.
+        flat = self.files['flat'][0]
+        moved = self.path / 'flat.fits'
+        flat.rename(moved)
+        watch = Watch(self.path, outdir=self.path / 'reduced', settle=0.)
+        self.assertEqual(watch.poll(), [])
+        self.assertEqual(len(watch.queue), 3)
+        moved.rename(flat)
+        self.assertEqual(len(watch.poll()), 3)
+        self.assertEqual(watch.queue, [])
+
+    def test_calibrations(self):
+        Watch(self.path, outdir=self.path / 'previous', settle=0.).poll()
+        # A night that only has science frames is reduced with the
+        # calibrations of the previous one.
+        tonight = self.path / 'tonight'
+        tonight.mkdir()
+        for f in self.files['science'] + self.files['specphot']:
+            f.rename(tonight / f.name)
+            obj = 'p' + f.stem + '_obj.fits'
+            (self.path / obj).rename(tonight / obj)
+        watch = Watch(tonight, calibrations=self.path / 'previous', settle=0.)
+        self.assertEqual(len(watch.poll()), 3)
+        self.assertFalse((tonight / 'order_HBDET_HIGH.pkl').exists())
+
+    def test_rebuild(self):
+        watch = Watch(self.path, outdir=self.path / 'reduced', settle=0.)
+        watch.poll()
+        bias = watch.bias('HBDET')
+        order, made = watch.orders[('HBDET', 'HIGH')]
+        self.assertIs(watch.bias('HBDET'), bias)
+        self.assertIs(watch.order('HBDET', 'HIGH'), order)
+        # A new bias and a new flat, taken later in the night.
+        time.sleep(0.01)
+        synthetic.write_frame(self.path / 'H201704120010.fits', 'bias',
+                              chip='HBDET', nrows=1024, seed=10)
+        synthetic.write_frame(self.path / 'H201704120011.fits', 'flat',
+                              chip='HBDET', nrows=1024, seed=11)
+        watch.poll()
+        self.assertEqual(len(watch.frames['bias']['HBDET']), 2)
+        self.assertIsNot(watch.bias('HBDET'), bias)
+        self.assertIsNot(watch.order('HBDET', 'HIGH'), order)
+        self.assertGreater(watch.orders[('HBDET', 'HIGH')][1], made)
+
+    def test_wavelength(self):
+        # A solution written during the watch (by hrs-night) is used from
+        # then on.
+        watch = Watch(self.path, outdir=self.path / 'reduced', settle=0.)
+        self.assertIsNone(watch.wavelength('HBDET', 'HIGH'))
+        file = self.path / 'reduced' / 'wavelength_HBDET_HIGH.pkl'
+        with open(str(file), 'wb') as fh:
+            pickle.dump({'solution': 1}, fh)
+        self.assertEqual(watch.wavelength('HBDET', 'HIGH'), {'solution': 1})
+        age(file, 60)
+        with open(str(file), 'wb') as fh:
+            pickle.dump({'solution': 2}, fh)
+        self.assertEqual(watch.wavelength('HBDET', 'HIGH'), {'solution': 2})
+
+
+class TestClassify(unittest.TestCase):
+
+    def test_kinds(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = synthetic.write_night(tmp, chips=('HRDET',), nbias=1,
+                                          nflat=1, nthar=1, nscience=1,
+                                          nspecphot=1, nrows=256,
+                                          pyhrs=False)
+            index = FileIndex(Path(tmp) / 'index.sqlite')
+            changed = index.scan(tmp, paths=True)
+            written = sum(files.values(), [])
+            self.assertEqual(sorted(changed), sorted(str(f) for f in written))
+            self.assertEqual(index.scan(tmp, paths=True), [])
+            for kind in ('bias', 'flat', 'thar', 'science', 'specphot'):
+                record = index.record(files[kind][0])
+                self.assertEqual(classify(record), [kind])
+                self.assertTrue(complete(record, index.header(files[kind][0])))
+            self.assertEqual(classify({'PROPID': 'CAL_BIAS'}), [])
+            # A frame that is still being written.
+            header = index.header(files['science'][0])
+            self.assertFalse(complete(dict(record, size=2880 * 2), header))
+            self.assertFalse(complete(record, None))
+            index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()